@@ -0,0 +1,260 @@
+"""
+Loads an analytics export into NumPy arrays and prints which subreddits
+drive comments, which providers show up most, and how the score of a
+comment relates to the number of movies in the post
+
+$ python analysis/load.py export-20261019-120000-*.zip
+$ python analysis/load.py exports/20261019-120000     # the unzipped chunks
+
+Start an export with /tasks/export. A finished export is downloaded
+in parts, zips of up to 20 chunks of a kind, which /tasks/exports
+lists for every run. Load all the parts together. Use load_export
+from other scripts to get the tables:
+
+    tables = load_export(glob.glob('export-20261019-120000-*.zip'))
+    posts = tables['Post']
+    posts['subreddit'].decode()[posts['commented'] == 1]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import zipfile
+import optparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'))
+
+from columnar import read_chunk
+
+"""
+A string column: int32 codes into the dictionary, -1 when missing
+"""
+class Strings(object):
+    def __init__(self, codes, dictionary):
+        self.codes = codes
+        self.dictionary = dictionary
+
+    def decode(self):
+        return np.append(self.dictionary, None)[self.codes]
+
+    def counts(self, mask=None):
+        codes = self.codes if mask is None else self.codes[mask]
+        return np.bincount(codes[codes >= 0], minlength=len(self.dictionary))
+
+"""
+A column of string lists: row i has the codes offsets[i]:offsets[i + 1]
+"""
+class StringLists(object):
+    def __init__(self, offsets, codes, dictionary):
+        self.offsets = offsets
+        self.codes = codes
+        self.dictionary = dictionary
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def rows(self):
+        # The row of every code
+        return np.repeat(np.arange(len(self.offsets) - 1), self.lengths())
+
+    def counts(self, weights=None):
+        if weights is not None:
+            weights = weights[self.rows()]
+        return np.bincount(self.codes, weights=weights, minlength=len(self.dictionary))
+
+"""
+Merges the dictionary of a chunk into the one of the table. Returns the
+codes of the chunk translated to the table's codes
+"""
+def merge_codes(codes, dictionary, merged):
+    mapping = np.array([merged.setdefault(value, len(merged)) for value in dictionary] + [-1], dtype=np.int32)
+    return mapping[codes]
+
+def read_block(body, column, name):
+    offset, length, dtype = column['blocks'][name]
+    dtype = np.dtype(dtype)
+    if length == 0:
+        return np.zeros(0, dtype)
+    return np.frombuffer(body, dtype, length // dtype.itemsize, offset)
+
+def column_values(header, body, column, dictionaries):
+    column_type = column['type']
+    if column_type in ['int', 'time']:
+        values = read_block(body, column, 'values')
+        nulls = read_block(body, column, 'nulls').astype(bool) if 'nulls' in column['blocks'] else np.zeros(len(values), bool)
+        if column_type == 'time':
+            values = values.astype('datetime64[s]')
+            values[nulls] = np.datetime64('NaT')
+            return values, None
+        return values, nulls
+    if column_type in ['float', 'bool']:
+        return read_block(body, column, 'values'), None
+    merged = dictionaries.setdefault(column['name'], {})
+    codes = merge_codes(read_block(body, column, 'codes'), column['dictionary'], merged)
+    if column_type == 'str':
+        return codes, None
+    return (read_block(body, column, 'offsets'), codes), None
+
+def dictionary_array(merged):
+    values = np.empty(len(merged), dtype=object)
+    for value, code in merged.items():
+        values[code] = value
+    return values
+
+"""
+Builds a table, a dict of column name -> array, from the chunks of a
+kind. Ints with missing values are masked arrays, times are datetime64
+with NaT, bools are int8 with -1 when missing, and strings are Strings
+or StringLists
+"""
+def build_table(chunks):
+    parts = {}
+    nulls = {}
+    types = {}
+    dictionaries = {}
+    for header, body in chunks:
+        for column in header['columns']:
+            values, column_nulls = column_values(header, body, column, dictionaries)
+            types[column['name']] = column['type']
+            parts.setdefault(column['name'], []).append(values)
+            if column_nulls is not None:
+                nulls.setdefault(column['name'], []).append(column_nulls)
+    table = {}
+    for name, column_type in types.items():
+        if column_type == 'strs':
+            offsets = [np.zeros(1, np.int32)]
+            start = 0
+            for chunk_offsets, codes in parts[name]:
+                offsets.append(chunk_offsets[1:] + start)
+                start += len(codes)
+            table[name] = StringLists(
+                np.concatenate(offsets),
+                np.concatenate([codes for _, codes in parts[name]]),
+                dictionary_array(dictionaries[name])
+            )
+        elif column_type == 'str':
+            table[name] = Strings(np.concatenate(parts[name]), dictionary_array(dictionaries[name]))
+        elif column_type == 'int':
+            values = np.concatenate(parts[name])
+            mask = np.concatenate(nulls[name])
+            table[name] = np.ma.MaskedArray(values, mask) if mask.any() else values
+        else:
+            table[name] = np.concatenate(parts[name])
+    return table
+
+"""
+Yields the name and data of every chunk file in the zip or directory
+"""
+def chunk_files(path):
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zipped:
+            for name in zipped.namelist():
+                yield name, zipped.read(name)
+    else:
+        for name in os.listdir(path):
+            if name.endswith('.col'):
+                with open(os.path.join(path, name), 'rb') as chunk:
+                    yield name, chunk.read()
+
+"""
+Returns kind -> table for every kind in the export, from a zip or
+directory, or a list of them like the parts of a download
+"""
+def load_export(paths):
+    if not isinstance(paths, (list, tuple)):
+        paths = [paths]
+    files = sorted(item for path in paths for item in chunk_files(path))
+    chunks = {}
+    for name, data in files:
+        header, body = read_chunk(data)
+        if header['rows']:
+            chunks.setdefault(header['kind'], []).append((header, body))
+    return dict((kind, build_table(kind_chunks)) for kind, kind_chunks in chunks.items())
+
+def row_count(table):
+    column = next(iter(table.values()))
+    if isinstance(column, Strings):
+        return len(column.codes)
+    if isinstance(column, StringLists):
+        return len(column.offsets) - 1
+    return len(column)
+
+"""
+Returns the codes of the k largest counts
+"""
+def top(counts, k):
+    return [code for code in np.argsort(counts)[::-1][:k] if counts[code] > 0]
+
+"""
+Returns the index in the table of every name, or -1 if it isn't there
+"""
+def lookup(names, table_names):
+    if not len(table_names):
+        return np.full(len(names), -1)
+    order = np.argsort(table_names)
+    positions = np.searchsorted(table_names[order], names)
+    positions = np.minimum(positions, len(order) - 1)
+    found = order[positions]
+    return np.where(table_names[found] == names, found, -1)
+
+def print_subreddits(posts, k):
+    commented = posts['commented'] == 1
+    counts = posts['subreddit'].counts(commented)
+    seen = posts['subreddit'].counts()
+    print("Subreddits by comments (of posts seen):")
+    for code in top(counts, k):
+        print("  %-30s %8d (%d)" % (posts['subreddit'].dictionary[code], counts[code], seen[code]))
+
+def print_providers(posts, movies, k):
+    providers = movies['providers']
+    counts = providers.counts()
+    print("Providers by movies listed:")
+    for code in top(counts, k):
+        print("  %-30s %8d" % (providers.dictionary[code], counts[code]))
+    # How often each movie was mentioned in a post we commented on
+    commented = (posts['commented'] == 1).astype(float)
+    mentions = posts['movies'].counts(commented)
+    movie_ids = movies['imdb_id'].decode().astype(str)
+    index = lookup(posts['movies'].dictionary.astype(str), movie_ids)
+    weights = np.zeros(len(movie_ids))
+    np.add.at(weights, index[index >= 0], mentions[index >= 0])
+    counts = providers.counts(weights)
+    print("Providers by movie mentions in commented posts:")
+    for code in top(counts, k):
+        print("  %-30s %8d" % (providers.dictionary[code], counts[code]))
+
+def print_score_by_movies(posts, comments):
+    index = lookup(comments['post'].decode().astype(str), posts['name'].decode().astype(str))
+    scores = comments['score']
+    valid = (index >= 0) & ~np.ma.getmaskarray(scores) & (comments['deleted'] != 1)
+    movie_counts = np.asarray(posts['movie_count'])[index[valid]]
+    scores = np.asarray(scores)[valid].astype(float)
+    if not len(scores):
+        print("No scored comments")
+        return
+    totals = np.bincount(movie_counts, weights=scores)
+    counts = np.bincount(movie_counts)
+    print("Comment score by movies in the post:")
+    for movie_count in np.nonzero(counts)[0]:
+        print("  %3d movies: %6d comments, mean score %.2f" % (movie_count, counts[movie_count], totals[movie_count] / counts[movie_count]))
+    if len(scores) > 1 and movie_counts.std() > 0 and scores.std() > 0:
+        print("  correlation %.3f" % np.corrcoef(movie_counts, scores)[0, 1])
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog export.zip|directory ...")
+    parser.add_option('-k', type='int', default=10, help="how many subreddits and providers to list")
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("Give the export zips or directory")
+    tables = load_export(args)
+    for kind, table in sorted(tables.items()):
+        print("%s: %d rows" % (kind, row_count(table)))
+    if 'Post' in tables:
+        print_subreddits(tables['Post'], options.k)
+        if 'Movies' in tables:
+            print_providers(tables['Post'], tables['Movies'], options.k)
+        if 'Comment' in tables:
+            print_score_by_movies(tables['Post'], tables['Comment'])
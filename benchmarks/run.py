@@ -0,0 +1,244 @@
+"""
+Runs the benchmarks of the pure CPU hot paths and compares them to
+the stored baseline. Exits with 1 when a benchmark got slower, or
+allocates more, by more than the tolerance
+
+$ python benchmarks/run.py                 # compare to benchmarks/baseline.json
+$ python benchmarks/run.py --save          # store the results as the new baseline
+$ python benchmarks/run.py --filter format_new_post --tolerance 0.1
+
+Every benchmark is timed as the best of several runs, right after a
+fixed calibration loop, and compared by its score: its calls per second
+divided by the calibration's. So a machine that's busier or slower as a
+whole doesn't show up as a regression, and a regression is measured
+again before it's reported
+
+Allocations are counted through the garbage collector, which works on
+any Python: the peak number of container objects (lists, dicts,
+instances and so on) alive during a call, and how many are still alive
+after it, result included. With tracemalloc (Python 3, or the
+pytracemalloc build on Python 2) the allocated blocks and peak bytes
+are measured too
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import optparse
+
+from suite import build_cases
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# How long each timed run of a benchmark should take
+MIN_RUN_TIME = 0.2
+REPEAT = 7
+# How many more times a regression is measured before it counts
+CONFIRM = 2
+METRICS = ['peak_objects', 'kept_objects', 'alloc_blocks', 'alloc_peak']
+
+"""
+A fixed mix of the dict, list and string work the benchmarks do,
+timed as the unit the scores are relative to
+"""
+def calibration():
+    parts = {}
+    for i in xrange(200):
+        key = 'tt%07d' % i
+        parts[key] = [key.upper(), i * 2]
+    return ' '.join(sorted(parts))
+
+def timed(func, calls):
+    start = time.time()
+    for i in xrange(calls):
+        func()
+    return time.time() - start
+
+"""
+Returns how many calls of the function take about MIN_RUN_TIME
+"""
+def calls_per_run(func):
+    calls = 1
+    while timed(func, calls) < MIN_RUN_TIME / 10:
+        calls *= 10
+    return max(int(calls * MIN_RUN_TIME / max(timed(func, calls), 1e-6)), 1)
+
+"""
+Returns the calls per second of the benchmark and its score, the calls
+per second relative to the calibration loop. The two are timed in turns,
+so both see the same load on the machine, and the fastest run of each
+is kept
+"""
+def measure_score(func):
+    unit_calls = calls_per_run(calibration)
+    calls = calls_per_run(func)
+    unit_best = best = None
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(REPEAT):
+            unit_best = min(unit_best, timed(calibration, unit_calls)) if unit_best is not None else timed(calibration, unit_calls)
+            best = min(best, timed(func, calls)) if best is not None else timed(func, calls)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    calls_per_sec = calls / max(best, 1e-9)
+    return calls_per_sec, calls_per_sec / (unit_calls / max(unit_best, 1e-9))
+
+"""
+Returns the peak number of container objects alive during a single
+call and the number still alive after it. With the collector off its
+count of objects only changes on allocations and deallocations, and
+it's sampled on every line the call runs
+"""
+def measure_objects(func):
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    gc.collect()
+    peak = [0]
+    def trace(frame, event, arg):
+        peak[0] = max(peak[0], gc.get_count()[0])
+        return trace
+    start = gc.get_count()[0]
+    sys.settrace(trace)
+    try:
+        ret = func()
+    finally:
+        sys.settrace(None)
+        kept = gc.get_count()[0] - start
+        if gc_enabled:
+            gc.enable()
+    del ret
+    return max(peak[0] - start, kept), kept
+
+"""
+Returns the number of memory blocks allocated and the peak
+bytes allocated during a single call, or None without tracemalloc
+"""
+def measure_allocations(func):
+    if tracemalloc is None:
+        return None, None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        ret = func()
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'lineno') if stat.count_diff > 0)
+    del ret
+    return blocks, peak
+
+def run(name_filter=None):
+    results = {}
+    for name, case, func in build_cases():
+        if name_filter and name_filter not in name:
+            continue
+        # The first call fills caches, like the compiled regexes
+        func()
+        peak_objects, kept_objects = measure_objects(func)
+        blocks, peak = measure_allocations(func)
+        calls_per_sec, score = measure_score(func)
+        results['%s/%s' % (name, case)] = {
+            'calls_per_sec' : round(calls_per_sec, 1),
+            'score'         : round(score, 4),
+            'peak_objects'  : peak_objects,
+            'kept_objects'  : kept_objects,
+            'alloc_blocks'  : blocks,
+            'alloc_peak'    : peak
+        }
+    return results
+
+def is_slower(result, base, tolerance):
+    return base.get('score') is not None and result['score'] < base['score'] * (1 - tolerance)
+
+"""
+Measures the benchmarks that look slower than the baseline again, and
+keeps their best score, so a single noisy run isn't a regression
+"""
+def confirm_slower(results, baseline, tolerance):
+    funcs = dict(('%s/%s' % (name, case), func) for name, case, func in build_cases())
+    for i in range(CONFIRM):
+        slower = [key for key, result in results.items() if key in baseline and is_slower(result, baseline[key], tolerance)]
+        for key in slower:
+            calls_per_sec, score = measure_score(funcs[key])
+            if score > results[key]['score']:
+                results[key].update(calls_per_sec=round(calls_per_sec, 1), score=round(score, 4))
+
+"""
+Returns a line for every benchmark that got worse than the baseline
+"""
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if is_slower(result, base, tolerance):
+            regressions.append("%s: score %.4f (%.1f calls/s), baseline %.4f (%.1f calls/s)" % (
+                key, result['score'], result['calls_per_sec'], base['score'], base['calls_per_sec']
+            ))
+        for metric in METRICS:
+            if result[metric] is not None and base.get(metric) is not None and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append("%s: %s %d, baseline %d" % (key, metric, result[metric], base[metric]))
+    return regressions
+
+def report(results, baseline):
+    print "%-36s %12s %10s %9s %9s %9s %10s %12s" % (
+        'benchmark', 'calls/s', 'score', 'change', 'peak objs', 'kept objs', 'blocks', 'peak bytes'
+    )
+    for key, result in sorted(results.items()):
+        base = baseline.get(key)
+        change = ''
+        if base and base.get('score'):
+            change = "%+.1f%%" % ((result['score'] / base['score'] - 1) * 100)
+        print "%-36s %12.1f %10.4f %9s %9s %9s %10s %12s" % ((
+            key, result['calls_per_sec'], result['score'], change
+        ) + tuple(result[metric] if result[metric] is not None else '-' for metric in METRICS))
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--save', action='store_true', help="store the results as the baseline")
+    parser.add_option('--baseline', default=BASELINE)
+    parser.add_option('--tolerance', type='float', default=0.25, help="allowed slowdown or extra allocations, 0.25 is 25%")
+    parser.add_option('--filter', help="only run benchmarks with this in the name")
+    options, args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    results = run(options.filter)
+    if not options.save:
+        confirm_slower(results, baseline, options.tolerance)
+    report(results, baseline)
+    if options.save:
+        baseline.update(results)
+        with open(options.baseline, 'w') as baseline_file:
+            json.dump({
+                'python'  : platform.python_version(),
+                'machine' : platform.platform(),
+                'saved'   : time.strftime('%Y-%m-%d %H:%M:%S'),
+                'results' : baseline
+            }, baseline_file, indent=1, sort_keys=True)
+        print "Saved the baseline to %s" % options.baseline
+        sys.exit(0)
+    if not baseline:
+        print "No baseline at %s. Run with --save to store one" % options.baseline
+        sys.exit(0)
+    regressions = find_regressions(results, baseline, options.tolerance)
+    if regressions:
+        print "\n%d regressions:" % len(regressions)
+        for regression in regressions:
+            print "  " + regression
+        sys.exit(1)
+    print "\nNo regressions against the baseline"
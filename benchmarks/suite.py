@@ -0,0 +1,118 @@
+"""
+The benchmark cases. Each benchmark is built for a small, a typical
+and a worst case post from the fixtures of reddit listings, OMDb
+responses and MediaHound sources in benchmarks/fixtures
+"""
+
+import os
+import sys
+import json
+import copy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'))
+
+from parsing import parse_text_for_imdb_ids, make_post_digest, parse_movie_fields, normalize_sources
+from formatting import sort_method_types, format_new_post
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Reddit caps self posts at 40000 characters
+MAX_SELFTEXT = 40000
+MAX_LISTING = 100
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as fixture:
+        return fixture.read()
+
+"""
+A self post at the length limit, packed with IMDB links
+"""
+def worst_case_post(post, index):
+    post = copy.deepcopy(post)
+    link = "Have you seen [this one](http://www.imdb.com/title/tt%07d/) yet? " % (100000 + index)
+    post['data']['selftext'] = (link * (MAX_SELFTEXT / len(link) + 1))[:MAX_SELFTEXT]
+    post['data']['name'] = 't3_worst%d' % index
+    return post
+
+def worst_case_sources(content, copies=10):
+    ret = []
+    for i in range(copies):
+        for source in copy.deepcopy(content):
+            source['object']['metadata']['name'] += ' %d' % i
+            for medium in source['context']['mediums']:
+                for method in medium['methods']:
+                    method['formats'] = method['formats'] * 2
+            ret.append(source)
+    return ret
+
+def movie_obj(imdb_id, omdb, sources):
+    media_types, friendly_names, method_types = normalize_sources(sources)
+    return {
+        'imdb_id'        : imdb_id,
+        'imdb_title'     : omdb['Title'],
+        'imdb_rating'    : omdb['imdbRating'],
+        'tomatoMeter'    : omdb['tomatoMeter'],
+        'rottentomatoes' : omdb['tomatoURL'],
+        'mhid'           : 'mh%s' % imdb_id,
+        'mh_title'       : omdb['Title'],
+        'mh_altId'       : 'mhmov-%s' % imdb_id,
+        'media_types'    : media_types,
+        'exclude'        : not sources
+    }, friendly_names, method_types
+
+def movies_data(count, omdb, sources):
+    ret = {'movies': [], 'friendly_names': [], 'media_types': []}
+    for i in range(count):
+        movie, friendly_names, method_types = movie_obj('tt%07d' % i, omdb, sources)
+        ret['movies'].append(movie)
+        ret['friendly_names'].extend(friendly_names)
+        ret['media_types'].extend(method_types)
+    ret['friendly_names'] = list(set(ret['friendly_names']))
+    ret['media_types'] = sort_method_types(ret['media_types'])
+    return ret
+
+def link_sources(post):
+    data = post['data']
+    return [data['selftext'], data['url'], data['title']]
+
+def listing_digests(raw):
+    return [make_post_digest(post) for post in json.loads(raw)['data']['children']]
+
+"""
+Returns a list of (benchmark name, case, function taking no arguments)
+"""
+def build_cases():
+    raw_listing = load_fixture('reddit_listing.json')
+    listing = json.loads(raw_listing)['data']['children']
+    omdb = json.loads(load_fixture('omdb.json'))
+    sources = json.loads(load_fixture('mediahound_sources.json'))['content']
+
+    small_post = listing[0]
+    worst_listing = [worst_case_post(listing[i % len(listing)], i) for i in range(MAX_LISTING)]
+    raw_worst_listing = json.dumps({'kind': 'Listing', 'data': {'children': worst_listing}})
+    worst_sources = worst_case_sources(sources)
+    method_types = ['Subscription', 'Rent', 'Purchase', 'Free', 'Rent', 'Subscription', 'Purchase'] * 3
+
+    small_data = movies_data(1, omdb['movie'], sources[:1])
+    typical_data = movies_data(3, omdb['movie'], sources)
+    worst_data = movies_data(20, omdb['movie'], worst_sources)
+
+    return [
+        ('parse_text_for_imdb_ids', 'small', lambda: parse_text_for_imdb_ids(small_post['data']['title'])),
+        ('parse_text_for_imdb_ids', 'typical', lambda: [parse_text_for_imdb_ids(text) for post in listing for text in link_sources(post)]),
+        ('parse_text_for_imdb_ids', 'worst', lambda: parse_text_for_imdb_ids(worst_listing[0]['data']['selftext'])),
+        ('make_post_digest', 'small', lambda: make_post_digest(small_post)),
+        ('make_post_digest', 'typical', lambda: [make_post_digest(post) for post in listing]),
+        ('make_post_digest', 'worst', lambda: [make_post_digest(post) for post in worst_listing]),
+        ('listing_digests', 'typical', lambda: listing_digests(raw_listing)),
+        ('listing_digests', 'worst', lambda: listing_digests(raw_worst_listing)),
+        ('parse_movie_fields', 'small', lambda: parse_movie_fields(omdb['series'])),
+        ('parse_movie_fields', 'typical', lambda: parse_movie_fields(omdb['movie'])),
+        ('normalize_sources', 'small', lambda: normalize_sources(sources[:1])),
+        ('normalize_sources', 'typical', lambda: normalize_sources(sources)),
+        ('normalize_sources', 'worst', lambda: normalize_sources(worst_sources)),
+        ('sort_method_types', 'typical', lambda: sort_method_types(method_types)),
+        ('format_new_post', 'small', lambda: format_new_post(small_data)),
+        ('format_new_post', 'typical', lambda: format_new_post(typical_data)),
+        ('format_new_post', 'worst', lambda: format_new_post(worst_data))
+    ]
@@ -0,0 +1,46 @@
+"""
+Compares the HTTP transports off App Engine: a new connection for
+every request, kept alive connections, and concurrent requests on
+the thread pool. Run it from the repo root so config.yaml is found
+
+$ python benchmarks/transport.py http://www.omdbapi.com/?i=tt0111161 100
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'))
+
+from transport import PooledTransport, TransportError
+
+def run_sequential(transport, url, count):
+    errors = 0
+    for i in range(count):
+        try:
+            transport.fetch(url)
+        except TransportError:
+            errors += 1
+    return errors
+
+def run_concurrent(transport, url, count):
+    results = transport.fetch_many([{'url': url} for i in range(count)])
+    return len([result for result in results if isinstance(result, TransportError)])
+
+def report(name, run, transport, url, count):
+    start = time.time()
+    errors = run(transport, url, count)
+    elapsed = time.time() - start
+    print "%-12s %6d requests in %6.2fs  %8.1f req/s  %d errors" % (
+        name, count, elapsed, count / elapsed, errors
+    )
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    url = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    report('unpooled', run_sequential, PooledTransport(pooled=False), url, count)
+    report('pooled', run_sequential, PooledTransport(), url, count)
+    report('concurrent', run_concurrent, PooledTransport(), url, count)
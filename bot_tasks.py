@@ -7,6 +7,12 @@ import re
 import json
 import textwrap
 import traceback
+import hashlib
+import time
+import uuid
+import contextlib
+import zipfile
+import StringIO
 
 from protorpc import messages
 from protorpc import message_types
@@ -15,12 +21,27 @@ from google.appengine.ext import ndb
 from google.appengine.api import taskqueue
 from google.appengine.ext.ndb import msgprop
 
-from modules.reddit import Reddit
+from modules.reddit import Reddit, BudgetExhausted, reddit_lane, PASSIVE_LANE, SUMMON_LANE
 from modules.imdb import IMDB
 from modules.mediahound import MediaHound
-from modules import parse_text_for_imdb_ids, parse_text_for_rt_ids, rotten_tomatoes_2_imdb
+from modules.poller import poll_subreddits
+from modules.stats import record_mentions, rollup_mentions, get_top_movies, ROLLUP_SIZE, WINDOWS as MENTION_WINDOWS
+from modules import retention
+from modules import migrations
+from modules import export
+from modules.revisions import add_revision, get_revision_body
+from modules.scheduling import schedule_comment, schedule_retry, unschedule_comment, DELETE_THRESHOLD, REVIEW_DAYS
+from modules.comment_index import index_comment, unindex_comment, live_comments, set_snapshot_version
+from modules.availability import is_fresh, update_snapshot
+from modules.formatting import sort_method_types, format_new_post
+from modules.storage import get_repository
+from modules.profiling import ProfilingMiddleware
+from modules.latency import start_timings, record_latencies, rollup_latencies, latency_report, WINDOWS as LATENCY_WINDOWS
+from modules.eligibility import record_skipped, skipped_report
+from modules.throughput import record_throughput, throughput_report
+from modules import parse_text_for_imdb_ids, parse_text_for_rt_ids, rotten_tomatoes_2_imdb, make_post_digest, is_post_digest
 
-from modules.models import Movies, MovieTypes, Post, Comment, CommentRevisions, IgnoreList, Whitelisted, Blacklisted
+from modules.models import MovieTypes, Post, Comment, WikiPage, InboxMessage, RetentionSweep, MigrationStatus, ExportRun, MovieComments, Profile
 
 REDDIT_PM_IGNORE   = "http://www.reddit.com/message/compose/?to={username}&subject=IGNORE%20ME&message=[IGNORE%20ME](http://i.imgur.com/s2jMqQN.jpg\)".format(username=config.reddit['user'])
 REDDIT_PM_REMEMBER = "http://www.reddit.com/message/compose/?to={username}&subject=REMEMBER%20ME&message=I%20made%20a%20mistake%20I%27m%20sorry,%20will%20you%20take%20me%20back".format(username=config.reddit['user'])
@@ -33,6 +54,9 @@ MAINTAINER_LINK    = "http://www.reddit.com/message/compose/?to=stevenviola"
 SOURCE_CODE        = "https://github.com/stevenviola/moviesbot"
 NO_BREAK_SPACE = u'&nbsp;'
 MAX_MESSAGE_LENGTH = 10000
+# Batches share one IN query per eligibility list, which
+# the datastore allows at most 30 values in
+MAX_POST_BATCH_SIZE = 30
 
 SIG_LINKS = [
     '[](#bot)',
@@ -48,15 +72,32 @@ SIG_LINKS = [
     '[](#bot)'
 ]
 
+"""
+The footer of our comments. The delete link names the post we reply
+to, which is known before the comment exists, so the comment is
+posted once and never edited to fill in its own name
+"""
+def comment_footer(post_name):
+    return ('\n---\n' + ' ^| '.join(['^' + a for a in SIG_LINKS])).replace('{thing_id}', post_name)
+
+# The stages of the comment pipeline, in order
+PIPELINE_STAGES = ['parsed', 'resolved', 'rendered', 'submitted', 'recorded']
+# How long a task holds a post before another one may take it over,
+# as long as a task may run
+PROCESSING_LEASE = datetime.timedelta(minutes=10)
+
 class PostObject:
-    def __init__(self,post_id,post=None):
+    def __init__(self,post_id,post=None,post_key=None):
         self.post_id = post_id
         self.movies_list = []
-        post_key = self.get_post_key()
+        # Stage timestamps, set by the task handlers
+        self.timings = None
+        if post_key is None:
+            post_key = self.get_post_key()
         if post_key:
             logging.info("Data already in DB. Populating the object from DB")
             # This post is already in the DB
-            self.populate_data()
+            self.populate_data(post_key)
         else:
             if not post:
                 logging.debug("Post data was not provided and not in DB. Need to lookup in DB")
@@ -71,41 +112,23 @@ class PostObject:
             else:
                 logging.debug("Post data provided. Skipping another API request")
                 logging.debug(post)
-            if 'kind' in post:
-                self.kind = post['kind']
-            elif 'kind' in post['data']:
-                self.kind = post['data']
-            else:
+            if not is_post_digest(post):
+                logging.info("Need to search the full post data for IMDB links")
+                post = make_post_digest(post)
+            if not post['kind']:
                 logging.error("This post has no kind")
-                logging.debug(post_results)
                 # Throw an issue. a post needs a kind
-            self.author    = post['data']['author']
-            self.post_date = datetime.datetime.fromtimestamp(int(post['data']['created_utc']))
-            self.subreddit = post['data']['subreddit']
-            self.name      = post['data']['name']
+            self.kind      = post['kind']
+            self.author    = post['author']
+            self.post_date = datetime.datetime.fromtimestamp(post['created_utc'])
+            self.subreddit = post['subreddit']
+            self.name      = post['name']
+            self.permalink = post['permalink']
+            self.movies_list = post['movies']
             self.commented   = False
             self.processing  = False
-            self.link_sources = {}
-            if self.kind == 't3':
-                # this is a post
-                self.permalink = post['data']['permalink']
-                self.link_sources['selftext'] = post['data']['selftext']
-                self.link_sources['url'] = post['data']['url']
-                self.link_sources['title'] = post['data']['title']
-            elif self.kind == 't1':
-                # This is a comment
-                self.permalink = None
-                self.link_sources['body'] = post['data']['body']
-            logging.info("Need to search the link_sources for IMDB links")
-            for link_source in self.link_sources:
-                logging.debug(link_source)
-                self.movies_list += parse_text_for_imdb_ids(self.link_sources[link_source])
-                #self.movies_list += rotten_tomatoes_2_imdb(parse_text_for_rt_ids(self.link_sources[link_source]))
-            # Cast the list to a set, and then back to a list to get unique movie ids
-            self.movies_list = list(set(self.movies_list))
-            self.movies = []
-            for movie in self.movies_list:
-                self.movies.append(ndb.Key(Movies, movie))
+            self.stage       = 'parsed'
+            self.checkpoint  = {}
             logging.debug(self.movies_list)
             logging.info("Post of kind %s had id of %s, submitted on %s to the %s subreddit by %s." % (
                 self.kind,
@@ -125,20 +148,22 @@ class PostObject:
     # Returns the key for the post in the DB
     def add_post_to_db(self):
         logging.debug("Adding %s to the datastore now" % self.name)
-        post_key = Post(
+        repository.put(repository.new('Post',
             id          = self.name,
             post_kind   = self.kind,
             name        = self.name,
-            movies      = self.movies,
             movies_list = self.movies_list,
             post_date   = self.post_date,
             author      = self.author,
             permalink   = self.permalink,
-            subreddit   = self.subreddit
-        ).put()
+            subreddit   = self.subreddit,
+            stage       = self.stage
+        ))
+        record_mentions(self.movies_list, self.subreddit)
 
-    def populate_data(self):
-        post_key = self.get_post_key()
+    def populate_data(self,post_key=None):
+        if post_key is None:
+            post_key = self.get_post_key()
         if post_key:
             self.kind        = post_key.post_kind
             self.movies_list = post_key.movies_list
@@ -148,15 +173,18 @@ class PostObject:
             self.permalink   = post_key.permalink
             self.subreddit   = post_key.subreddit
             self.commented   = post_key.commented
-            self.processing  = post_key.processing 
-            logging.debug("Got back %s from NDB, so setting self.movies_list to %s" % (post_key.movies,self.movies_list))
+            self.processing  = post_key.processing_until is not None and post_key.processing_until > datetime.datetime.now()
+            # Posts stored before the pipeline had stages start over
+            self.stage       = post_key.stage or 'parsed'
+            self.checkpoint  = post_key.checkpoint or {}
+            logging.debug("Got back %s from NDB, so setting self.movies_list to %s" % (post_key.movies_list,self.movies_list))
             logging.debug("Got back %s from NDB, so setting self.author to %s" % (post_key.author,self.author))
             logging.debug("Got back %s from NDB, so setting self.subreddit to %s" % (post_key.subreddit,self.subreddit))
         else:
             logging.error("Post Key not found. Can not update anything")
 
     def get_post_key(self):
-        key = ndb.Key(Post, self.post_id).get()
+        key = repository.get_post(self.post_id)
         if key:
             logging.debug("Post key in DB")
             logging.debug(key)
@@ -165,94 +193,129 @@ class PostObject:
             logging.debug("Post key is not in the DB")
             return None
 
-    def add_comment_to_post(self,comment_id,body):
+    def add_comment_to_post(self,comment_id,body,movies):
         post_key = self.get_post_key()
         if post_key:
-            comment_key = Comment(
+            comment = Comment(
                 id = comment_id,
-                parent = post_key.key,
+                parent = ndb.Key(Post, self.name),
                 name = comment_id,
                 score = 1,
-                revision = 0
-            ).put()
-            comment_rev_key = CommentRevisions(
-                id = '0',
-                parent = comment_key,
-                body = body
-            ).put()
+                revision = 0,
+                movies = movies,
+                post_date = datetime.datetime.now()
+            )
+            comment_key = schedule_comment(comment).put()
+            add_revision(comment_key, 0, body)
             post_key.commented = True
-            post_key.put()
+            post_key.timings = self.timings
+            repository.put(post_key)
             # Repopulate the data from the DB
             self.populate_data()
         else:
             logging.error("Post Key not found. Can not update with comment")
 
-    def set_processing(self,processing):
+    def reached(self,stage):
+        return PIPELINE_STAGES.index(self.stage) >= PIPELINE_STAGES.index(stage)
+
+    """
+    Records that the stage is finished, along with what it produced
+    """
+    def save_stage(self,stage,**results):
+        post_key = self.get_post_key()
+        if post_key:
+            checkpoint = dict(post_key.checkpoint or {})
+            checkpoint.update(results)
+            post_key.stage = stage
+            post_key.checkpoint = checkpoint
+            repository.put(post_key)
+            self.stage = stage
+            self.checkpoint = checkpoint
+        else:
+            logging.error("Post Key not found. Can not save the %s stage" % stage)
+
+    def reset_stages(self):
         post_key = self.get_post_key()
         if post_key:
-            post_key.processing = processing
-            post_key.put()
+            post_key.stage = 'parsed'
+            post_key.checkpoint = {}
+            repository.put(post_key)
+        self.stage = 'parsed'
+        self.checkpoint = {}
+
+    """
+    Takes the post for the owner, unless another owner holds it and its
+    lease hasn't run out. The owner is the task name, which stays the
+    same when a task is retried, so a retry takes back its own post.
+    Returns whether the post was taken
+    """
+    def take_lease(self,owner):
+        now = datetime.datetime.now()
+        def take(post_key):
+            if post_key is None:
+                return False
+            if post_key.processing_owner not in [None, owner] and post_key.processing_until and post_key.processing_until > now:
+                return False
+            post_key.processing_owner = owner
+            post_key.processing_until = now + PROCESSING_LEASE
+            return True
+        taken = repository.update('Post', self.post_id, take)
+        if taken:
             # Repopulate the data from the DB
             self.populate_data()
-        else:
-            logging.error("Post Key not found. Can not set processing")
+        return taken
 
-def is_author_ignored(author):
-    author_ignored = IgnoreList.query(ndb.AND(
-        IgnoreList.author == author,
-        IgnoreList.ignored == True
-    )).fetch()
+    def release_lease(self,owner):
+        def release(post_key):
+            if post_key is None or post_key.processing_owner != owner:
+                return False
+            post_key.processing_owner = None
+            post_key.processing_until = None
+            return True
+        repository.update('Post', self.post_id, release)
+        self.processing = False
+
+"""
+The ignore list, whitelist and blacklist entries for the authors and
+subreddits of a batch of posts, looked up with one query each instead
+of one per post
+"""
+class EligibilityLists:
+    def __init__(self,authors,subreddits):
+        authors = list(set(authors))
+        subreddits = list(set(subreddits))
+        self.ignored = repository.ignored_authors(authors)
+        self.listed = {}
+        for list_type in ['white','black']:
+            self.listed[list_type] = repository.listed_subreddits(list_type, subreddits)
+
+def is_author_ignored(author,lists=None):
+    if lists is not None:
+        return author in lists.ignored
+    author_ignored = repository.ignored_authors([author])
     if not author_ignored:
         return False
     else:
         return True
 
 def author_ignore_key(author):
-    author_ignored = IgnoreList.query(IgnoreList.author == author).get()
+    author_ignored = repository.ignore_entry(author)
     if not author_ignored:
         return False
     else:
         return author_ignored
 
-def is_listed(list_type,subreddit):
+def is_listed(list_type,subreddit,lists=None):
     logging.debug("Checking to see if %s is %slisted" % (subreddit,list_type))
-    if list_type is 'white':
-        entity = Whitelisted
-    elif list_type is 'black':
-        entity = Blacklisted
-    else:
+    if lists is not None:
+        return subreddit in lists.listed.get(list_type, set())
+    if list_type not in ['white','black']:
         return False
-    if entity:
-        listed = entity.query(entity.subreddit == subreddit).get()
-        if listed:
-            logging.debug("%s is %slisted. Returning True" % (subreddit,list_type))
-            return True
+    if repository.listed_subreddits(list_type, [subreddit]):
+        logging.debug("%s is %slisted. Returning True" % (subreddit,list_type))
+        return True
     return False
 
-def uniform_types(method_type):
-    ret = method_type
-    if method_type == 'broker':
-        ret ='subscription'
-    elif method_type == 'rental':
-        ret ='rent'
-    elif method_type == 'adSupported':
-        ret ='subscription'
-    return ret.title()
-
-def sort_method_types(method_types):
-    ret = []
-    # These are method types we care about
-    ordered_types = ['Subscription', 'Rent', 'Purchase']
-    for i in ordered_types:
-        if i in method_types:
-            ret.append(i.title())
-    # Append any unmatched methods:
-    unmatched = [x.title() for x in method_types if x not in ordered_types]
-    if unmatched:
-        logging.debug(unmatched)
-        ret.extend(list(set(unmatched)))
-    return ret
-
 def lookup_movie_data(movies):
     for imdb_id in movies:
         imdb_obj = IMDB(imdb_id)
@@ -275,73 +338,86 @@ def lookup_movie_data(movies):
         
 
 
+"""
+Looks up the information about a single movie. Returns a tuple of
+the movie dictionary, the friendly medium names and the method types
+found for it, or None if the movie shouldn't be listed
+"""
+def get_single_movie_data(imdb_id):
+    logging.debug("Looking up information for IMDB id: %s" %imdb_id)
+    friendly_names = []
+    method_types = []
+    # Lookup IMDB name
+    imdb_obj = IMDB(imdb_id)
+    if imdb_obj.movie_data.Type != MovieTypes.movie:
+        logging.info("Skipping non movie link: %s. Type is: %s" %
+            (imdb_id, imdb_obj.movie_data.Type)
+        )
+        return None
+    imdb_title = imdb_obj.movie_data.Title
+    imdb_release = imdb_obj.movie_data.DVD
+    if imdb_release and datetime.datetime.now() < imdb_release:
+        logging.info("Looks like the DVD hasn't come out yet. Perhaps we should not include this movie") 
+    if not imdb_title:
+        logging.warning("Couldn't get IMDB info for IMDB id: %s" %imdb_id)
+        return None
+    movie_obj = {}
+    movie_obj['imdb_rating'] = imdb_obj.movie_data.imdbRating
+    movie_obj['imdb_id'] = imdb_id
+    movie_obj['imdb_title'] = imdb_title
+    movie_obj['tomatoMeter'] = imdb_obj.movie_data.tomatoMeter
+    movie_obj['rottentomatoes'] = imdb_obj.movie_data.tomatoURL
+    movie_obj['media_types'] = {}
+    movie_obj['exclude'] = True
+    mhid = imdb_obj.movie_data.mhid
+    if mhid:
+        movie_obj['mhid'] = mhid
+        movie_obj['mh_title'] = imdb_obj.movie_data.mh_name
+        movie_obj['mh_altId'] = imdb_obj.movie_data.mh_altId
+        snapshot = repository.get_snapshot(imdb_id)
+        if not is_fresh(snapshot, mhid):
+            mh_sources = mh.graph_media(mhid,'sources')
+            # The task that fetched the shared sources may have rebuilt the snapshot already
+            latest = repository.get_snapshot(imdb_id, use_cache=False)
+            if is_fresh(latest, mhid):
+                snapshot = latest
+            elif mh_sources is not None:
+                snapshot = update_snapshot(imdb_id, mhid, mh_sources['content'])
+            elif snapshot is not None:
+                logging.warning("Couldn't get the MediaHound sources for %s. Using the snapshot from %s" % (imdb_id,snapshot.built))
+        if snapshot is None:
+            logging.error("No availability snapshot for %s" % imdb_id)
+            return movie_obj, friendly_names, method_types
+        logging.debug("Using version %d of the availability snapshot for %s" % (snapshot.version,imdb_id))
+        movie_obj['exclude'] = snapshot.exclude
+        movie_obj['media_types'] = snapshot.media_types
+        friendly_names = snapshot.friendly_names
+        method_types = snapshot.method_types
+    return movie_obj, friendly_names, method_types
+
 """
 Takes a list of IMDB ids and returns array of dictionaries
-with the information about each movie
+with the information about each movie. A dictionary passed
+as cache is used to share the lookups between posts
 """
-def get_movie_data(movies):
+def get_movie_data(movies,cache=None):
     if not movies:
         return False
-    media_types = config.mediatypes
+    if cache is None:
+        cache = {}
     movies_ret = {}
     movies_ret['movies'] = []
     movies_ret['friendly_names'] = []
     movies_ret['media_types'] = []
     for imdb_id in movies:
-        logging.debug("Looking up information for IMDB id: %s" %imdb_id)
-        movie_obj = {}
-        # Lookup IMDB name
-        imdb_obj = IMDB(imdb_id)
-        if imdb_obj.movie_data.Type != MovieTypes.movie:
-            logging.info("Skipping non movie link: %s. Type is: %s" %
-                (imdb_id, imdb_obj.movie_data.Type)
-            )
-            continue
-        imdb_title = imdb_obj.movie_data.Title
-        imdb_release = imdb_obj.movie_data.DVD
-        if imdb_release and datetime.datetime.now() < imdb_release:
-            logging.info("Looks like the DVD hasn't come out yet. Perhaps we should not include this movie") 
-        if not imdb_title:
-            logging.warning("Couldn't get IMDB info for IMDB id: %s" %imdb_id)
+        if imdb_id not in cache:
+            cache[imdb_id] = get_single_movie_data(imdb_id)
+        if cache[imdb_id] is None:
             continue
-        movie_obj = {}
-        movie_obj['imdb_rating'] = imdb_obj.movie_data.imdbRating
-        movie_obj['imdb_id'] = imdb_id
-        movie_obj['imdb_title'] = imdb_title
-        movie_obj['tomatoMeter'] = imdb_obj.movie_data.tomatoMeter
-        movie_obj['rottentomatoes'] = imdb_obj.movie_data.tomatoURL
-        movie_obj['media_types'] = {}
-        movie_obj['exclude'] = True
-        if imdb_obj.movie_data.mhid:
-            movie_obj['mhid'] = imdb_obj.movie_data.mhid
-            movie_obj['mh_title'] = imdb_obj.movie_data.mh_name
-            movie_obj['mh_altId'] = imdb_obj.movie_data.mh_altId
-            mh_sources = mh.graph_media(imdb_obj.movie_data.mhid,'sources')
-            movie_obj['exclude'] = not mh_sources['content']
-            for mh_object in mh_sources['content']:
-                if 'allMediums' in mh_object['object'] and mh_object['object']['allMediums']:
-                    movies_ret['friendly_names'].extend(mh_object['object']['allMediums'])
-                    media_provider = mh_object['object']['metadata']['name']
-                    logging.debug("Found media from: %s" % media_provider)
-                    for medium in mh_object['context']['mediums']:
-                        for method in medium['methods']:
-                            method_type = uniform_types(method['type'])
-                            logging.debug("Type is %s" % method['type'])
-                            movies_ret['media_types'].append(method_type)
-                            if method_type not in movie_obj['media_types']:
-                                movie_obj['media_types'][method_type] = {}
-                            for format in method['formats']:
-                                url = format['launchInfo']['view']['http']
-                                if 'price' in format:
-                                    price = format['price']
-                                else:
-                                    price = 0
-                                if media_provider not in movie_obj['media_types'][method_type] or price < movie_obj['media_types'][method_type][media_provider]['price']:
-                                    movie_obj['media_types'][method_type][media_provider] = {
-                                        'url'  : url,
-                                        'price': price
-                                    }
+        movie_obj, friendly_names, method_types = cache[imdb_id]
         movies_ret['movies'].append(movie_obj)
+        movies_ret['friendly_names'].extend(friendly_names)
+        movies_ret['media_types'].extend(method_types)
     movies_ret['friendly_names'] = list(set(movies_ret['friendly_names']))
     movies_ret['media_types'] = sort_method_types(movies_ret['media_types'])
     logging.debug(movies_ret)
@@ -354,21 +430,24 @@ Given a post, determines if we should comment
 - Returns False if we shouldn't comment on post
 """
 
-def should_comment(post,forced=False,summoned=False):
+def should_comment(post,forced=False,summoned=False,lists=None):
+    return is_eligible(post.author,post.subreddit,forced,summoned,lists)
+
+def is_eligible(author,subreddit,forced=False,summoned=False,lists=None):
     # If forced, return true
     if forced is True:
         logging.info("Forced is true. I don't care about anything else. Should comment")
         return True
     # If summoned and subreddit isn't blacklisted, return True
-    elif summoned is True and is_listed('black',post.subreddit) is False:
+    elif summoned is True and is_listed('black',subreddit,lists) is False:
         logging.info("I was summoned and the subreddit is not blacklisted. Should comment")
         return True
     # If user is on ignore list, return false
-    elif is_author_ignored(post.author):
+    elif is_author_ignored(author,lists):
         logging.info("Author is on the ignore list. Should not comment")
         return False
     # If subreddit is on whitelist, return true
-    elif is_listed('white',post.subreddit) is True:
+    elif is_listed('white',subreddit,lists) is True:
         logging.info("Subreddit is on the whitelist. Should comment")
         return True
     else:
@@ -376,46 +455,62 @@ def should_comment(post,forced=False,summoned=False):
         return False
 
 """
-Given a post and movies data, need to do the following:
-- format comment
+Given a post, need to do the following:
+- resolve the movies and render the comment
 - reply to the post
+Each stage is checkpointed on the post, so a retry resumes at
+the first unfinished one. Errors are raised for the task to retry
 """
-def comment_on_post(post, summoned=False):
-    name = post.name
+def comment_on_post(post, summoned=False, movie_cache=None):
     movies_list = post.movies_list
-    # Set this post to processing
-    logging.debug("Setting processing to True")
-    post.set_processing(True)
     try:
+        if post.reached('submitted'):
+            logging.info("%s was already submitted as %s. Resuming at the recording" % (post.name,post.checkpoint['comment_name']))
+            finish_comment(post)
         # If we got valid movie data back
-        if movies_list is not None:
+        elif movies_list is not None:
             logging.info(movies_list)
-            # We should comment on this post
-            movies_data = get_movie_data(movies_list)
-            if len(movies_data['movies']) > 0:
-                comment_text = format_new_post(movies_data)
-                # If the comment text has info
-                if comment_text is not False and ( len(movies_data['media_types']) > 0 or summoned is True ):
-                    submit_comment(post,comment_text)
-                elif summoned is True:
-                    logging.critical("This condition shouldn't happen. Investigate why this was called")
-                    comment_text = "Sorry, I couldn't find any links to streaming, rental, or purchase sites. Perhaps the movie is too new\n"
-                    submit_comment(post,comment_text)
-                else:
-                    logging.info("No links to provide to the user, and not summoned. Not commenting")
-            elif summoned is True:
-                logging.info("No movie data was found for post but I was summoned. Need to update with sad comment")
-                comment_text = "Sorry, I was unable to find any movies in this post\n"
+            comment_text = render_comment(post,summoned,movie_cache)
+            if comment_text is not None:
                 submit_comment(post,comment_text)
-            else:
-                logging.info("No movie data and not summoned. Not commenting")
         else:
             logging.debug("No movies to comment on. Reply skipping.")
     except Exception, e:
-        logging.critical("Encountered error when processing post. Abort: %s" % traceback.print_exc());
-    # Unset processing
-    post.set_processing(False)
-    logging.debug("Processing set to False")
+        logging.critical("Encountered error when processing post %s at the %s stage: %s" % (post.name,post.stage,traceback.format_exc()))
+        raise
+
+"""
+Returns the text of the comment for the post, or None if we
+shouldn't comment. The movie data and the text are checkpointed
+"""
+def render_comment(post, summoned=False, movie_cache=None):
+    if post.reached('rendered'):
+        logging.info("Using the comment rendered for %s by an earlier attempt" % post.name)
+        return post.checkpoint['comment_text']
+    if post.reached('resolved'):
+        movies_data = post.checkpoint['movies_data']
+    else:
+        movies_data = get_movie_data(post.movies_list,movie_cache)
+        post.save_stage('resolved',movies_data=movies_data)
+    comment_text = None
+    if movies_data and len(movies_data['movies']) > 0:
+        formatted = format_new_post(movies_data)
+        # If the comment text has info
+        if formatted is not False and ( len(movies_data['media_types']) > 0 or summoned is True ):
+            comment_text = formatted
+        elif summoned is True:
+            logging.critical("This condition shouldn't happen. Investigate why this was called")
+            comment_text = "Sorry, I couldn't find any links to streaming, rental, or purchase sites. Perhaps the movie is too new\n"
+        else:
+            logging.info("No links to provide to the user, and not summoned. Not commenting")
+    elif summoned is True:
+        logging.info("No movie data was found for post but I was summoned. Need to update with sad comment")
+        comment_text = "Sorry, I was unable to find any movies in this post\n"
+    else:
+        logging.info("No movie data and not summoned. Not commenting")
+    if comment_text is not None:
+        post.save_stage('rendered',comment_text=comment_text)
+    return comment_text
 
 def pm_summon(message):
     missing_link_error = "I can't find a valid reddit link in the message body"
@@ -449,131 +544,87 @@ def pm_summon(message):
     movies_list = parse_text_for_imdb_ids(body)
     if movies_list is None:
         return "Couldn't find any IMDB links in your message"
-    if post.processing:
+    # Named after the message, so a retry of the message takes back its own post
+    owner = 'pm-%s' % message['name']
+    if not post.take_lease(owner):
         return "This post is currently processing. Try back in a few minutes"
-    lookup_movie_data(movies_list)
-    movies_data = get_movie_data(movies_list)
-    logging.debug(movies_data)
-    if movies_data is False or len(movies_data['movies']) == 0:
-        return "Couldn't find any movies in your message"
-    comment_text = format_new_post(movies_data)
-    submit_comment(post,comment_text)
+    try:
+        lookup_movie_data(movies_list)
+        movies_data = get_movie_data(movies_list)
+        logging.debug(movies_data)
+        if movies_data is False or len(movies_data['movies']) == 0:
+            return "Couldn't find any movies in your message"
+        comment_text = format_new_post(movies_data)
+        submit_comment(post,comment_text,movies_list)
+    finally:
+        post.release_lease(owner)
     return "Hooray! that comment has been posted for you"
 
 """
-Replies to a post with the comment text provided
-Adds the reply to the DB and edits the comment for the delete button
+Replies to a post with the comment text provided, and adds the
+reply to the DB. It's a single write, the footer is final already.
+Submitting is idempotent: the attempt is recorded before the reply is
+posted, and a retry after an attempt that may have gone through looks
+for our reply before posting another one
 """
-def submit_comment(post,comment_text):
+def submit_comment(post,comment_text,movies=None):
     name = post.name
-    footer = '\n---\n' + ' ^| '.join(['^' + a for a in SIG_LINKS])
-    comment_text += footer
-    new_post_result =  reddit.post_to_reddit(name,comment_text,'comment')
-    # If the comment was posted sucessfully
-    if new_post_result:
-        if not new_post_result['json']['errors']:
-            # get the name of the comment
-            comment_name = new_post_result['json']['data']['things'][0]['data']['name']
-            logging.info("Adding to the db. Will not comment on this post again")
-            post.add_comment_to_post(comment_name,comment_text)
-            update_comment(name,comment_name,comment_text)
-        else:
-            # Set comment id to 0 and let this get put in the DB, so we don't try it again
+    if movies is None:
+        movies = post.movies_list
+    comment_text += comment_footer(name)
+    comment_name = None
+    if post.checkpoint.get('submitting'):
+        comment_name = reddit.find_reply(name,post.permalink)
+        if comment_name is not None:
+            logging.info("An earlier attempt already replied to %s with %s. Not posting again" % (name,comment_name))
+    if comment_name is None:
+        post.save_stage(post.stage,submitting=True)
+        # Not resent on a connection error, since it may have gone through
+        new_post_result =  reddit.post_to_reddit(name,comment_text,'comment',recursive=False)
+        # If the comment was posted sucessfully
+        if not new_post_result:
+            # The task is retried, and the retry checks for our reply before posting
+            raise Exception("Couldn't comment on %s. Not marking this as commented in DB" % name)
+        if new_post_result['json']['errors']:
+            post.save_stage(post.stage,submitting=False)
             logging.error("Received the following error when trying to comment: %s" % new_post_result['json']['errors'])
-    else:
-        logging.error("Couldn't comment. Not marking this as commented in DB")
+            return
+        # get the name of the comment
+        comment_name = new_post_result['json']['data']['things'][0]['data']['name']
+    if post.timings is not None:
+        post.timings['commented'] = time.time()
+    post.save_stage('submitted',submitting=False,comment_name=comment_name,submitted_text=comment_text,movies=movies)
+    finish_comment(post)
+
+"""
+Records the submitted comment
+"""
+def finish_comment(post):
+    name = post.name
+    comment_name = post.checkpoint['comment_name']
+    comment_text = post.checkpoint['submitted_text']
+    logging.info("Adding to the db. Will not comment on this post again")
+    post.add_comment_to_post(comment_name,comment_text,post.checkpoint['movies'])
+    comment_key = ndb.Key(Post, name, Comment, comment_name)
+    failed = index_comment(post.checkpoint['movies'], comment_key)
+    if failed:
+        queue_index_comment(comment_key, failed)
+    post.save_stage('recorded')
+    if post.timings is not None and not record_latencies(post.timings, post.subreddit):
+        queue_record_latencies(post)
 
+"""
+Edits our comment to the body given, which includes the footer
+"""
 def update_comment(post_id,comment_id,body):
     comment_key = ndb.Key(Post, post_id, Comment, comment_id)
     comment = comment_key.get()
     rev = comment.revision+1;
-    updated_comment_text = body.format(thing_id=comment_id)
-    reddit.post_to_reddit(comment_id,updated_comment_text,'editusertext')
-    comment_rev_key = CommentRevisions(
-        id = str(rev),
-        parent = comment_key,
-        body = updated_comment_text
-    ).put()
+    reddit.post_to_reddit(comment_id,body,'editusertext')
+    add_revision(comment_key, rev, body)
     comment.revision = rev
     comment.put()
 
-def format_new_post(movies_data):
-    media_types = movies_data['media_types']
-    friendly_names = movies_data['friendly_names']
-    pulral = ''
-    if len(movies_data['movies']) > 1:
-        pulral = 's'
-    if len(friendly_names) == 0:
-        ret_line = ["Sorry, no streaming, rental, or purchase links found for the following movies:\n\n"]
-    else:
-        ret_line = [
-            "Here's where you can %s the movie%s listed:\n\n" %
-                ('/'.join(friendly_names),pulral)
-        ]
-    heading = ['Title','IMDB','Rotten Tomatoes']
-    heading += media_types
-    seperator = []
-    actual_links = False
-    for index, w in enumerate(heading):
-        sep = "---"
-        if index > 1:
-            sep+=":"
-        seperator.append(sep)
-    ret_line.append(" | ".join(heading))
-    ret_line.append("|".join(seperator))
-    for movie in movies_data['movies']:
-        # If we have details about the movie, but no 
-        # links, then just add a message
-        if movie['exclude'] and 'imdb_title' not in movie:
-            logging.info("We don't have any info, so tell the user we excluded the title")
-#            line.append("No %s options for: %s" % ( ' , '.join(media_types), title ))
-            continue
-        actual_links = True
-        rt_rating = movie['tomatoMeter']
-        if rt_rating is None:
-            rt_rating = 'N/A'
-        else:
-            rt_rating = "{0}%".format(rt_rating)
-        rt_link = movie['rottentomatoes']
-        imdb_rating = movie['imdb_rating']
-        if imdb_rating is None:
-            imdb_rating = 'N/A'
-        imdb_link = "http://www.imdb.com/title/%s/" % movie['imdb_id']
-        if 'mhid' in movie:
-            short_url = "https://nextqueue.com/movie/%s" % movie['mh_altId'][6:]
-            title = movie['mh_title']
-        else:
-            short_url = imdb_link
-            title = movie['imdb_title']
-        line = ["**[%s](%s)**" % (title, short_url)]
-        line.append("[%s](%s)" % (imdb_rating,imdb_link))
-        if rt_link is not None:
-            line.append("[{0}]({1})".format(rt_rating,rt_link))
-        else:
-            line.append(rt_rating)
-        logging.debug(line)
-        for media_type in media_types:
-            if media_type in movie['media_types']:
-                type_strings = []
-                for provider,details in movie['media_types'][media_type].items():
-                    name = provider
-                    if details['price'] > 0:
-                        name = "%s - $%s" % (provider, details['price'])
-                    type_strings.append(
-                        ("[%s](%s)" % ( name, details['url'] )).replace(' ','&nbsp;')
-                    )
-                type_joined = ' &#183; '.join(type_strings)
-            else:
-                type_joined = ''
-            line.append(type_joined)
-        ret_line.append('|'.join(line))
-    # If we don't have streams for any movies, we shouldn't comment
-    # Only return the formatted text if we have useful info
-    if actual_links:
-        return "\n".join(ret_line)
-    else:
-        return False
-
 def ignore_message(message):
     response = None
     author  = message['author']
@@ -613,13 +664,13 @@ def ignore_message(message):
         )
     ignore_key = author_ignore_key(author)
     if not ignore_key:
-        ignore_key = IgnoreList()
+        ignore_key = repository.new('IgnoreList', id=author)
     ignore_key.message_id = message_id
     ignore_key.message_date = date
     ignore_key.body = body
     ignore_key.author = author
     ignore_key.ignored = ignored
-    ignore_key.put()
+    repository.put(ignore_key)
     return response
 
 def add_to_list(message):
@@ -640,24 +691,19 @@ def add_to_list(message):
         # Else, see what they want to do
         if subject == "whitelist":
             list_type = 'white'
-            remove_from_entity = Blacklisted
-            entity = Whitelisted
         elif subject == "blacklist":
             list_type = 'black'
-            remove_from_entity = Whitelisted
-            entity = Blacklisted
         if not is_listed(list_type,subreddit):
-            # Subreddit is not listed
-            entity(
-                subreddit = subreddit,
-                updated_by = author
-            ).put()
-            old_entity = remove_from_entity.query(remove_from_entity.subreddit==subreddit).get()
-            if old_entity:
-                # Delete the entity from the 
-                # other list. We can't have a subreddit on both lists
-                old_entity.key.delete()
+            # Subreddit is not listed. This also takes it off
+            # the other list. We can't have a subreddit on both lists
+            repository.add_listed(list_type,subreddit,author)
             logging.info("%s is now %slisted because of %s" % (subreddit,list_type,author))
+            if getattr(config, 'publish_wiki_on_change', False):
+                taskqueue.add(
+                    url='/tasks/wiki',
+                    method='GET',
+                    params={'lists': 'white,black'}
+                )
             subreddit_mods = "/r/%s" %subreddit
             reply_subject = "%s added to /u/%s %s" % (subreddit_mods,config.reddit['user'],subject)
             response = (
@@ -683,20 +729,29 @@ def delete_message(message):
     thing_name = str(body_regex.group('thing_name'))
     thing_type = body_regex.group('thing_type')
     logging.debug("thing_name: %s; thing_type: %s" % (thing_name,thing_type))
-    # Figure out what the thing they want us to delete is
-    if thing_type != "t1":
-        logging.info("Received Delete request for unknown thing type %s" % thing_type)
+    # Delete links name the post we replied to. Links in comments
+    # made before that name the comment itself
+    if repository.get_post(thing_name):
+        logging.debug("Searching for our comments on the post %s" % thing_name)
+        comments = [comment for comment in Comment.query(ancestor=ndb.Key(Post, thing_name)).fetch() if not comment.deleted]
+    elif thing_type == "t1":
+        logging.debug("Searching for a post with a comment of %s" % thing_name)
+        comments = Comment.query(
+            Comment.name == thing_name,
+        ).fetch()
+    else:
+        logging.info("Received Delete request for unknown thing %s" % thing_name)
         return None
-    # This thing is a comment
-    # Lookup this thing in the DB
-    logging.debug("Searching for a post with a comment of %s" % thing_name)
-    comments = Comment.query(
-        Comment.name == thing_name,
-    ).fetch()
     logging.debug(comments)
     for comment in comments:
         logging.debug(comment)
-        post = comment.key.parent().get()
+        thing_name = comment.key.id()
+        # The post is read through the repository, since with the
+        # sqlite backend it isn't in the datastore
+        post = repository.get_post(comment.key.parent().id())
+        if post is None:
+            logging.error("The post of comment %s is gone. Can't check who the OP is" % thing_name)
+            continue
         original_author = post.author
         # If the author is the same as the author in question
         if original_author == author:
@@ -704,7 +759,10 @@ def delete_message(message):
             # Delete post
             reddit.delete_from_reddit(thing_name)
             comment.deleted = True
+            schedule_comment(comment)
             comment.put()
+            # Comments made before the movies were stored list the ones of the post
+            unindex_comment(comment.movies or post.movies_list, comment.key)
             response =  textwrap.dedent("""
                 Ok, I deleted my comment on your post. Sorry about that.
                 If you never want me to respond to you again, I understand. you can always send
@@ -720,6 +778,102 @@ def delete_message(message):
 
 reddit = Reddit()
 mh = MediaHound()
+repository = get_repository()
+
+def log_payload_sizes(payload_sizes):
+    if not payload_sizes:
+        return
+    logging.info("Enqueued %d post digests. Payload bytes total: %d, average: %d, max: %d" % (
+        len(payload_sizes),
+        sum(payload_sizes),
+        sum(payload_sizes) / len(payload_sizes),
+        max(payload_sizes)
+    ))
+
+def queue_posts(digests,summoned=False):
+    batch_size = min(getattr(config, 'post_batch_size', 1), MAX_POST_BATCH_SIZE)
+    # Summoned posts skip the backlog of passive posts
+    queue_name = 'processSummon' if summoned else 'processPost'
+    payload_sizes = []
+    discovered = time.time()
+    for digest in digests:
+        digest['discovered'] = discovered
+    if batch_size <= 1:
+        for digest in digests:
+            payload_sizes.append(queue_post(digest,summoned))
+    else:
+        for i in range(0, len(digests), batch_size):
+            posts_data = json.dumps(digests[i:i+batch_size])
+            payload_sizes.append(len(posts_data))
+            taskqueue.add(
+                url='/tasks/process_posts',
+                queue_name=queue_name,
+                params={
+                    'summoned':summoned,
+                    'posts_data':posts_data,
+                }
+            )
+    log_payload_sizes(payload_sizes)
+
+"""
+Queues one post to be processed on its own. Returns the payload size
+"""
+def queue_post(digest,summoned=False):
+    post_data = json.dumps(digest)
+    taskqueue.add(
+        url='/tasks/process_post',
+        queue_name='processSummon' if summoned else 'processPost',
+        params={
+            'post': digest['name'],
+            'summoned':summoned,
+            'post_data':post_data,
+        }
+    )
+    return len(post_data)
+
+"""
+The owner of the posts a request takes: the task name, which a retry
+of the task keeps, or a one off name outside of the task queue
+"""
+def lease_owner(request):
+    return request.headers.get('X-AppEngine-TaskName') or uuid.uuid4().hex
+
+"""
+Answers 503 when the reddit budget of the lane runs out, so the task
+queue retries the task later instead of the request waiting for it
+"""
+@contextlib.contextmanager
+def budget_retry(handler):
+    try:
+        yield
+    except BudgetExhausted as e:
+        logging.info("Retrying the task later: %s" % e)
+        handler.response.set_status(503)
+
+"""
+Returns the digests of the posts that are eligible for a comment,
+before anything is queued or looked up. The others are still stored,
+so their mentions are counted and the next search stops at them
+"""
+def drop_ineligible(digests,post_keys):
+    lists = EligibilityLists(
+        [digest['author'] for digest in digests],
+        [digest['subreddit'] for digest in digests]
+    )
+    eligible = []
+    skipped = []
+    for digest, post_key in zip(digests, post_keys):
+        if is_eligible(digest['author'],digest['subreddit'],lists=lists):
+            eligible.append(digest)
+        elif not post_key:
+            skipped.append(digest)
+    for digest in skipped:
+        try:
+            PostObject(digest['name'],digest,False)
+        except Exception, e:
+            logging.error("Couldn't store post %s: %s" % (digest['name'],e))
+    record_skipped(len(skipped), [imdb_id for digest in skipped for imdb_id in digest['movies']])
+    return eligible
 
 def search_process_reddit_posts(query,summoned=False,recursive=True,after=None):
     if after is not None:
@@ -727,22 +881,23 @@ def search_process_reddit_posts(query,summoned=False,recursive=True,after=None):
     else:
         new_query = query
     logging.debug("Searching Reddit with the following query: %s. Summoned is %s" % (new_query,summoned))
-    search_results = reddit.search_reddit(new_query)
+    try:
+        search_results = reddit.search_reddit(new_query)
+    except BudgetExhausted as e:
+        # The next search picks up the posts of the pages left
+        logging.warning("Stopped searching: %s" % e)
+        return
     if search_results:
-        for post in search_results['data']['children']:
-            logging.debug(post)
-            post_id = post['data']['name']
-            if ndb.Key(Post, post_id).get():
-                recursive = False
-            taskqueue.add(
-                url='/tasks/process_post',
-                queue_name='processPost',
-                params={
-                    'post': post_id,
-                    'summoned':summoned,
-                    'post_data':json.dumps(post),
-                }
-            )
+        children = search_results['data']['children']
+        logging.debug(children)
+        post_keys = repository.get_posts([post['data']['name'] for post in children])
+        if any(post_keys):
+            # We've seen this page before. No need to go any further back
+            recursive = False
+        digests = [make_post_digest(post) for post in children]
+        if not summoned:
+            digests = drop_ineligible(digests, post_keys)
+        queue_posts(digests, summoned)
         next_after = search_results['data']['after']
         if recursive and next_after is not None:
             search_process_reddit_posts(
@@ -759,18 +914,36 @@ class search_imdb(webapp2.RequestHandler):
 
 class search_usermention(webapp2.RequestHandler):
     def get(self):
-        search_process_reddit_posts(
-            "title%3A/u/{u}+OR+url%3A/u/{u}+OR+/u/{u}".format(u=config.reddit['user']),
-            summoned=True
-        )
+        with reddit_lane(SUMMON_LANE):
+            search_process_reddit_posts(
+                "title%3A/u/{u}+OR+url%3A/u/{u}+OR+/u/{u}".format(u=config.reddit['user']),
+                summoned=True
+            )
+
+# Polls the new posts and comments of the whitelisted subreddits
+# directly, which finds them sooner than the site wide search
+class poll_whitelisted(webapp2.RequestHandler):
+    def get(self):
+        if not getattr(config, 'poll_whitelisted', False):
+            logging.debug("Polling whitelisted subreddits is turned off")
+            return
+        subreddits = sorted(repository.listed_subreddits('white'))
+        if not subreddits:
+            logging.info("No whitelisted subreddits to poll")
+            return
+        digests = poll_subreddits(reddit, subreddits)
+        if digests:
+            # Drops the posts of ignored authors
+            digests = drop_ineligible(digests, repository.get_posts([digest['name'] for digest in digests]))
+        queue_posts(digests)
 
 class manual_process(webapp2.RequestHandler):
     def get(self,post_id):
         logging.info("Forcing processing on post %s" % post_id)
-        # Add the task to the default queue.
+        # Requested by hand, so it goes in the summon lane
         taskqueue.add(
             url='/tasks/process_post',
-            queue_name='processPost',
+            queue_name='processSummon',
             params={
                 'post': post_id,
                 'forced':True
@@ -788,20 +961,165 @@ class process_post(webapp2.RequestHandler):
         # Check that the post id is formatted properly
         logging.info("Begin processing post with name: %s. Forced is %s and summoned is %s" % (post_id,forced,summoned))
         logging.debug(post_data)
-        post = PostObject(post_id,post_data)
-        if post.processing is False:
-            lookup_movie_data(post.movies_list)
-            if post.commented is False or forced is True:
-                if should_comment(post=post,forced=forced,summoned=summoned):
-                    comment_on_post(post,summoned)
-                else:
-                    logging.info("Determined I shouldn't comment on this post for one reason or another")
+        with reddit_lane(SUMMON_LANE if summoned or forced else PASSIVE_LANE), budget_retry(self):
+            start = time.time()
+            post = PostObject(post_id,post_data)
+            post.timings = start_timings(post_data if post_data and is_post_digest(post_data) else None, post.post_date)
+            # A retried task takes back the post its earlier attempt left processing
+            owner = lease_owner(self.request)
+            if post.take_lease(owner):
+                try:
+                    if post.commented is False or forced is True:
+                        if should_comment(post=post,forced=forced,summoned=summoned):
+                            if forced is True and post.reached('recorded'):
+                                # Comment again from scratch
+                                post.reset_stages()
+                            if not post.reached('resolved'):
+                                lookup_movie_data(post.movies_list)
+                            post.timings['looked_up'] = time.time()
+                            comment_on_post(post,summoned)
+                        else:
+                            logging.info("Determined I shouldn't comment on this post for one reason or another")
+                            record_skipped(1, post.movies_list)
+                    else:
+                        logging.info("I've already commented on this post. Not commenting this time")
+                finally:
+                    post.release_lease(owner)
+            else:
+                logging.info("This post is already being processed")
+            record_throughput('single', 1, time.time() - start)
+
+"""
+Comments on the eligible posts of a batch, sharing the eligibility
+checks and movie lookups. Returns the digests of the posts that failed
+"""
+def comment_on_batch(posts,summoned=False):
+    failed = []
+    lists = EligibilityLists(
+        [post.author for post in posts],
+        [post.subreddit for post in posts]
+    )
+    eligible = []
+    skipped = []
+    for post in posts:
+        if post.commented is not False:
+            logging.info("I've already commented on %s. Not commenting this time" % post.name)
+        elif not should_comment(post=post,summoned=summoned,lists=lists):
+            logging.info("Determined I shouldn't comment on %s for one reason or another" % post.name)
+            skipped.append(post)
+        else:
+            eligible.append(post)
+    posts = eligible
+    movies = list(set(imdb_id for post in posts if not post.reached('resolved') for imdb_id in post.movies_list))
+    record_skipped(len(skipped), [imdb_id for post in skipped for imdb_id in post.movies_list if imdb_id not in movies])
+    logging.info("Looking up %d movies for %d posts" % (len(movies),len(posts)))
+    for imdb_id in movies:
+        try:
+            lookup_movie_data([imdb_id])
+        except Exception, e:
+            logging.error("Couldn't look up %s: %s" % (imdb_id,e))
+    looked_up = time.time()
+    for post in posts:
+        post.timings['looked_up'] = looked_up
+    movie_cache = {}
+    for post in posts:
+        try:
+            comment_on_post(post,summoned,movie_cache)
+        except BudgetExhausted:
+            # The whole task is retried. Posts commented on by then are skipped
+            raise
+        except Exception, e:
+            logging.error("Couldn't comment on %s: %s" % (post.name,traceback.format_exc()))
+            failed.append(post.digest)
+    return failed
+
+# Processes a batch of posts. Reads, eligibility checks and movie
+# lookups are shared by the batch, and comments are submitted one
+# post at a time. A post that fails is queued again on its own, so
+# its retries resume at its checkpoint without redoing the batch
+class process_posts(webapp2.RequestHandler):
+    def post(self):
+        summoned = True if self.request.get('summoned') == 'True' else False
+        digests  = json.loads(self.request.get('posts_data'))
+        logging.info("Begin processing batch of %d posts. Summoned is %s" % (len(digests),summoned))
+        with reddit_lane(SUMMON_LANE if summoned else PASSIVE_LANE), budget_retry(self):
+            start = time.time()
+            post_keys = repository.get_posts([digest['name'] for digest in digests])
+            owner = lease_owner(self.request)
+            posts = []
+            failed = []
+            for digest, post_key in zip(digests, post_keys):
+                try:
+                    timings = start_timings(digest)
+                    # False tells PostObject the post isn't in the DB, without looking again
+                    post = PostObject(digest['name'],digest,post_key or False)
+                    post.timings = timings
+                    post.digest = digest
+                    # Posts another task holds are left to it
+                    if post.take_lease(owner):
+                        posts.append(post)
+                    else:
+                        logging.info("%s is already being processed" % post.name)
+                except Exception, e:
+                    logging.error("Couldn't load post %s: %s" % (digest['name'],e))
+                    failed.append(digest)
+            try:
+                failed.extend(comment_on_batch(posts,summoned))
+            finally:
+                for post in posts:
+                    post.release_lease(owner)
+            for digest in failed:
+                logging.info("Queueing %s to be processed on its own" % digest['name'])
+                queue_post(digest,summoned)
+            record_throughput('batch', len(digests), time.time() - start)
+
+"""
+Handles a single inbox message and returns the reply
+to send back, or None if no reply is needed
+"""
+def handle_message(message):
+    response = None
+    author = message['data']['author']
+    if message['data']['was_comment']:
+        if 'subject' in message['data']:
+            subject = message['data']['subject']
+            if subject == 'username mention':
+                post_id = message['data']['name']
+                logging.info("Got username mention")
+                digest = make_post_digest(message)
+                digest['discovered'] = time.time()
+                post_data = json.dumps(digest)
+                log_payload_sizes([len(post_data)])
+                taskqueue.add(
+                    url='/tasks/process_post',
+                    queue_name='processSummon',
+                    params={
+                        'post'     : post_id,
+                        'summoned' : True,
+                        'post_data': post_data
+                    }
+                )
+            elif subject == 'comment reply':
+                logging.info("Got a comment reply. I don't know how to handle this. I need a human")
             else:
-                logging.info("I've already commented on this post. Not commenting this time")
+                logging.info("Got a comment with subject %s. I need a human." % subject)
+    else:
+        subject = message['data']['subject'].lower()
+        logging.info("Got a message from %s with the subject %s" % (author,subject))
+        if subject in ["ignore me", "remember me"]:
+            response = ignore_message(message['data'])
+        elif subject in ["blacklist","whitelist"]:
+            response = add_to_list(message['data'])
+        elif subject == "delete":
+            response = delete_message(message['data'])
+        elif subject == "process" or subject == "re: process":
+            response = pm_summon(message['data'])
         else:
-            logging.info("This post is already being processed")
+            logging.info("Got a random message. I don't know how to handle this. I need a human.")
+    return response
 
-# Reads unread messages from the inbox. 
+# Reads unread messages from the inbox. Each message is handed
+# to its own task, and then all of them are marked read at once
 class read_messages(webapp2.RequestHandler):
     def get(self):
         logging.info("Getting list of unread messages")
@@ -809,56 +1127,69 @@ class read_messages(webapp2.RequestHandler):
         unread = reddit.get_unread_messages()
         if unread:
             logging.debug("Received the following response for unread messages %s" % unread)
+            names = []
+            tasks = []
             for message in unread['data']['children']:
-                response = None
-                author = message['data']['author']
                 name = message['data']['name']
-                if message['data']['was_comment']:
-                    if 'subject' in message['data']:
-                        subject = message['data']['subject']
-                        if subject == 'username mention':
-                            post_id = message['data']['name']
-                            logging.info("Got username mention")
-                            taskqueue.add(
-                                url='/tasks/process_post',
-                                queue_name='processPost',
-                                params={
-                                    'post'     : post_id,
-                                    'summoned' : True,
-                                    'post_data': json.dumps(message)
-                                }
-                            )
-                        elif subject == 'comment reply':
-                            logging.info("Got a comment reply. I don't know how to handle this. I need a human")
-                        else:
-                            logging.info("Got a comment with subject %s. I need a human." % subject)
-                else:
-                    subject = message['data']['subject'].lower()
-                    logging.info("Got a message from %s with the subject %s" % (author,subject))
-                    if subject in ["ignore me", "remember me"]:
-                        response = ignore_message(message['data'])
-                    elif subject in ["blacklist","whitelist"]:
-                        response = add_to_list(message['data'])
-                    elif subject == "delete":
-                        response = delete_message(message['data'])
-                    elif subject == "process" or subject == "re: process":
-                        response = pm_summon(message['data'])
-                    else:
-                        logging.info("Got a random message. I don't know how to handle this. I need a human.")
-                # Mark message as read
-                if reddit.mark_message_read(name):
-                    if response is not None:
-                        # Reply to the user
-                        reply_subject = "re: %s" %subject
-                        logging.info("Replying with subject: %s and response %s" % (reply_subject,response))
-                        reddit.post_to_reddit(name,response)
+                names.append(name)
+                # Naming the task after the message means a message that
+                # is still unread on the next poll won't be queued twice
+                tasks.append(taskqueue.Task(
+                    name='message-%s' % name,
+                    url='/tasks/process_message',
+                    params={'message': json.dumps(message)}
+                ))
+            if not tasks:
+                logging.info("No unread messages")
+                return
+            queue = taskqueue.Queue('processMessage')
+            for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+                try:
+                    queue.add(tasks[i:i+taskqueue.MAX_TASKS_PER_ADD])
+                except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                    logging.info("Some of these messages were already queued. Skipping those")
+            # Mark messages as read
+            if reddit.mark_message_read(','.join(names)):
+                logging.info("Queued and marked %d messages as read" % len(names))
+            else:
+                logging.error("Couldn't mark %d messages as read" % len(names))
         else:
             logging.error("Error getting unread messages")
 
+class process_message(webapp2.RequestHandler):
+    def post(self):
+        message = json.loads(self.request.get('message'))
+        name = message['data']['name']
+        # Messages are people asking for something, so they get the summon lane
+        with reddit_lane(SUMMON_LANE):
+            inbox_message = InboxMessage.get_by_id(name)
+            if inbox_message is None:
+                response = handle_message(message)
+                inbox_message = InboxMessage(
+                    id = name,
+                    author = message['data']['author'],
+                    response = response,
+                    replied = response is None
+                )
+                inbox_message.put()
+            else:
+                logging.info("Message %s was already handled" % name)
+            if not inbox_message.replied:
+                # Reply to the user
+                logging.info("Replying to %s with response %s" % (name,inbox_message.response))
+                if reddit.post_to_reddit(name,inbox_message.response,recursive=False):
+                    inbox_message.replied = True
+                    inbox_message.put()
+                else:
+                    raise Exception("Couldn't reply to message %s" % name)
+
 class review_comment(webapp2.RequestHandler):
     def post(self):
         comment_id = self.request.get('comment_id')
         post_id    = self.request.get('post_id')
+        # Score checkups don't re-render. That only happens when the
+        # sources of a movie in the comment changed
+        rerender   = False if self.request.get('rerender') == 'False' else True
         logging.info("Need to do a checkup on comment %s" % comment_id)
         comment_key = ndb.Key(Post, post_id, Comment, comment_id)
         logging.debug(comment_key)
@@ -867,100 +1198,534 @@ class review_comment(webapp2.RequestHandler):
             logging.error("Couldn't find comment %s in the DB" % comment_id)
             return None
         comment_revision_num = comment.revision
-        revision_key = ndb.Key(Post, post_id, Comment, comment_id, CommentRevisions, str(comment_revision_num))
         post_results = reddit.api_call("https://oauth.reddit.com/api/info.json?id=%s" % comment_id)
         if post_results:
             if post_results['data']['children']:
                 comment_data = post_results['data']['children'][0]
                 logging.debug("Got back the following data for comment: %s. Data: %s" % (comment_id,comment_data))
                 score = comment_data['data']['score']
+                previous_score = comment.score
                 comment.score = score
                 logging.info("Comment %s has a score of %d" % (comment_id,score))
-                if score < -2: # TODO: Remove this hardcoded threshold
+                if score < DELETE_THRESHOLD:
                     logging.info("Deleting comment %s because of a low score" % comment_id)
                     # This score is less than what we want. Delete the post
                     reddit.delete_from_reddit(comment_id)
                     comment.deleted = True
                     logging.info("Comment %s is deleted" % comment_id)
-                else:
-                    comment_revision = revision_key.get()
-                    if not comment_revision:
-                        logging.error("Couldn't find revision %d for comment %s" % (comment_revision_num,comment_id))
-                        return None
-                    logging.info("Need to check if we should recheck the contents of this post")
-                    post = PostObject(post_id)
-                    orig_text = comment_revision.body
-                    if not post.movies_list:
-                        logging.info("No movies in parent post")
-                        return None
-                    updated_text = format_new_post(get_movie_data(post.movies_list))
-                    if updated_text is not False and len(updated_text) > len(orig_text):
-                        logging.info("The updated text is more than what we originally commented on. Perhaps we should edit the comment")
-                        # Edit the comment, and update the revision in the DB
-                        update_comment(post_id,comment_id,updated_text)
-                        logging.debug("New comment text is %s. Old text was %s" % (updated_text,orig_text))
-                    else:
-                        logging.info("No need to edit the comment since updated text is not longer than what we have")
+                schedule_comment(comment, previous_score)
+                logging.info("Next checkup of comment %s is %s" % (comment_id,comment.next_check if comment.scheduled else 'never'))
+                # Saved before re-rendering, since update_comment saves the new revision
                 comment.put()
+                if comment.deleted:
+                    return None
+                if not rerender:
+                    logging.info("Score checkup only. Not re-rendering comment %s" % comment_id)
+                    return None
+                orig_text = get_revision_body(comment_key, comment_revision_num)
+                if orig_text is None:
+                    logging.error("Couldn't find revision %d for comment %s" % (comment_revision_num,comment_id))
+                    return None
+                logging.info("Need to check if we should recheck the contents of this post")
+                post = PostObject(post_id)
+                # Summoned comments list the movies of the message, not of the post
+                movies = comment.movies or post.movies_list
+                if not movies:
+                    logging.info("No movies in parent post")
+                    return None
+                updated_text = format_new_post(get_movie_data(movies))
+                if updated_text is not False:
+                    updated_text += comment_footer(post_id)
+                if updated_text is not False and len(updated_text) > len(orig_text):
+                    logging.info("The updated text is more than what we originally commented on. Perhaps we should edit the comment")
+                    # Edit the comment, and update the revision in the DB
+                    update_comment(post_id,comment_id,updated_text)
+                    logging.debug("New comment text is %s. Old text was %s" % (updated_text,orig_text))
+                else:
+                    logging.info("No need to edit the comment since updated text is not longer than what we have")
             else:
-                logging.info("No children returned when searching for comment: %s" % comment_id)
+                # The comment is gone from reddit, so there's nothing left to check
+                logging.info("No children returned when searching for comment: %s. Not checking it again" % comment_id)
+                unschedule_comment(comment).put()
         else:
-            logging.error("Unable to get results for comment %s" % comment_id)
-            # Throw error to get out of here
+            schedule_retry(comment)
+            logging.error("Unable to get results for comment %s. Next checkup is %s" % (comment_id,comment.next_check if comment.scheduled else 'never'))
+            comment.put()
 
+# Queues a checkup for every comment that is due for one
 class check_comments(webapp2.RequestHandler):
     def get(self):
-        date_search = datetime.datetime.now() - datetime.timedelta(days=7)
-        comments = Comment.query(ndb.AND(
-            Comment.post_date > date_search,
-            Comment.deleted == False,
-        )).fetch()
-        for comment in comments:
-            logging.debug(comment)
-            post = comment.key.parent().get()
-            logging.debug("The key for this comment is %s and parent is %s" % (comment.key,post.name))
-            taskqueue.add(
+        now = datetime.datetime.now()
+        if self.request.get('backfill') == 'True':
+            schedule_unscheduled_comments(now)
+        comment_keys = Comment.query(ndb.AND(
+            Comment.scheduled == True,
+            Comment.next_check <= now,
+        )).fetch(keys_only=True)
+        tasks = []
+        for comment_key in comment_keys:
+            logging.debug("The key for this comment is %s and parent is %s" % (comment_key,comment_key.parent().id()))
+            tasks.append(taskqueue.Task(
+                # A comment that's still due on the next run isn't queued twice
+                name='review-%s-%s' % (comment_key.id(), now.strftime('%Y%m%d%H%M')),
                 url='/tasks/review_comment',
-                queue_name='reviewComment',
                 params={
-                    'comment_id' : comment.name,
-                    'post_id'    : post.name,
+                    'comment_id' : comment_key.id(),
+                    'post_id'    : comment_key.parent().id(),
+                    'rerender'   : False,
                 }
+            ))
+        queue = taskqueue.Queue('reviewComment')
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            try:
+                queue.add(tasks[i:i+taskqueue.MAX_TASKS_PER_ADD])
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                logging.info("Some of these checkups were already queued. Skipping those")
+        logging.info("Queued %d comment checkups" % len(tasks))
+
+"""
+Puts comments from before the review schedule existed on the schedule
+"""
+def schedule_unscheduled_comments(now):
+    date_search = now - datetime.timedelta(days=REVIEW_DAYS)
+    comments = Comment.query(ndb.AND(
+        Comment.post_date > date_search,
+        Comment.deleted == False,
+    )).fetch()
+    unscheduled = [comment for comment in comments if comment.next_check is None]
+    for comment in unscheduled:
+        schedule_comment(comment, now=now)
+        if comment.scheduled:
+            # Check it on this run
+            comment.next_check = now
+    ndb.put_multi(unscheduled)
+    logging.info("Scheduled %d comments that had no schedule" % len(unscheduled))
+
+"""
+Publishes the whitelist and blacklist wiki pages. A page is only
+sent to reddit when its content differs from what was last published
+"""
+def publish_wiki_lists(list_types=None,force=False):
+    subreddit = config.subreddit
+    for list_type in list_types or ['white','black']:
+        listed_subreddits = sorted(set(
+            "/r/%s/" % item for item in repository.listed_subreddits(list_type)
+        ))
+        content = '\n\n'.join(listed_subreddits)
+        page = "%slisted" % list_type
+        content_hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        published = WikiPage.get_by_id(page)
+        if published and published.content_hash == content_hash and not force:
+            logging.info("The %s wiki is unchanged since %s. Not updating" % (page,published.published))
+            continue
+        reason = "Automated update of %slisted subreddits" % list_type
+        if reddit.update_wiki(subreddit,page,content,reason):
+            WikiPage(id=page, content_hash=content_hash).put()
+            logging.info("Sucessfully updated the %slisted wiki in /r/%s" % (list_type,subreddit))
+        else:
+            logging.error("Error updating the %slisted wiki in /r/%s" % (list_type,subreddit))
+
+def queue_index_comment(comment_key,movies):
+    taskqueue.add(
+        url='/tasks/index_comment',
+        queue_name='reviewComment',
+        params={
+            'comment_id' : comment_key.id(),
+            'post_id'    : comment_key.parent().id(),
+            'movies'     : ','.join(movies)
+        }
+    )
+
+# Indexes a comment under the movies that were too contended
+# when it was submitted. Fails, so it's retried, until it's done
+class index_comment_later(webapp2.RequestHandler):
+    def post(self):
+        comment_key = ndb.Key(Post, self.request.get('post_id'), Comment, self.request.get('comment_id'))
+        failed = index_comment(self.request.get('movies').split(','), comment_key)
+        if failed:
+            raise Exception("Couldn't index comment %s under %s yet" % (comment_key.id(), failed))
+
+def queue_record_latencies(post):
+    taskqueue.add(
+        url='/tasks/record_latencies',
+        queue_name='reviewComment',
+        params={
+            'timings'   : json.dumps(post.timings),
+            'subreddit' : post.subreddit,
+            'recorded'  : time.time()
+        }
+    )
+
+# Records the latencies of a post whose histogram shards were all
+# too contended when it was commented on. Fails, so it's retried,
+# until they're recorded in the hour the post was commented on
+class record_latencies_later(webapp2.RequestHandler):
+    def post(self):
+        recorded = datetime.datetime.fromtimestamp(float(self.request.get('recorded')))
+        if not record_latencies(json.loads(self.request.get('timings')), self.request.get('subreddit'), recorded):
+            raise Exception("Couldn't record the latencies of a post in /r/%s yet" % self.request.get('subreddit'))
+
+def queue_review(comment_key):
+    taskqueue.add(
+        url='/tasks/review_comment',
+        queue_name='reviewComment',
+        params={
+            'comment_id' : comment_key.id(),
+            'post_id'    : comment_key.parent().id(),
+        }
+    )
+
+# Rebuilds the availability snapshot of every movie that has live comments,
+# and only queues reviews for the comments of movies whose snapshot version changed
+class refresh_sources(webapp2.RequestHandler):
+    def get(self):
+        for key in MovieComments.query().iter(keys_only=True):
+            taskqueue.add(
+                url='/tasks/refresh_sources',
+                queue_name='refreshSources',
+                params={'imdb_id': key.id()}
             )
 
+    def post(self):
+        imdb_id = self.request.get('imdb_id')
+        comments = live_comments(imdb_id)
+        if not comments:
+            logging.info("No live comments mention %s" % imdb_id)
+            return
+        movie = repository.get_movie(imdb_id)
+        if not movie or not movie.mhid:
+            logging.info("No MediaHound id for %s. Nothing to refresh" % imdb_id)
+            return
+        mh_sources = mh.graph_media(movie.mhid,'sources')
+        if mh_sources is None:
+            logging.error("Couldn't get the MediaHound sources for %s" % imdb_id)
+            return
+        snapshot = update_snapshot(imdb_id, movie.mhid, mh_sources['content'])
+        previous_version = set_snapshot_version(imdb_id, snapshot.version)
+        if previous_version is not None and previous_version != snapshot.version:
+            logging.info("Availability of %s changed to version %d. Queueing review of %d comments" % (imdb_id,snapshot.version,len(comments)))
+            for comment_key in comments:
+                queue_review(comment_key)
+        else:
+            logging.info("Sources of %s are unchanged" % imdb_id)
+
 class update_wiki_lists(webapp2.RequestHandler):
     def get(self):
-        subreddit = config.subreddit
-        lists = {'white':Whitelisted,'black':Blacklisted}
-        for list_type in lists:
-            entity = lists[list_type]
-            listed_subreddits = []
-            for item in entity.query().fetch():
-                listed_subreddits.append("/r/%s/" % item.subreddit)
-            content = '\n\n'.join(listed_subreddits)
-            page = "%slisted" % list_type
-            reason = "Automated update of %slisted subreddits" % list_type
-            if reddit.update_wiki(subreddit,page,content,reason):
-                logging.info("Sucessfully updated the %slisted wiki in /r/%s" % (list_type,subreddit))
-            else:
-                logging.error("Error updating the %slisted wiki in /r/%s" % (list_type,subreddit))
+        list_types = [l for l in self.request.get('lists').split(',') if l in ['white','black']]
+        force = self.request.get('force') == 'True'
+        publish_wiki_lists(list_types,force)
+
+class rollup_stats(webapp2.RequestHandler):
+    def get(self):
+        rollup_mentions()
+        rollup_latencies()
+
+# Post to comment latency percentiles per stage, site wide
+# and per subreddit, or for a single subreddit
+class latency_stats(webapp2.RequestHandler):
+    def get(self):
+        window = self.request.get('window', 'day')
+        if window not in LATENCY_WINDOWS:
+            window = 'day'
+        subreddit = self.request.get('subreddit')
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'window'    : window,
+            'subreddit' : subreddit or None,
+            'latencies' : latency_report(window, subreddit)
+        }))
+
+"""
+Returns the integer query parameter clamped to the range, or
+aborts with a 400 if it isn't a number
+"""
+def int_param(handler,name,default,minimum,maximum):
+    try:
+        value = int(handler.request.get(name, default))
+    except ValueError:
+        handler.abort(400, "%s must be a number" % name)
+    return min(max(value, minimum), maximum)
+
+# Posts per second of the single post and batch handlers, to
+# tell whether batching pays off for the current post_batch_size
+class throughput_stats(webapp2.RequestHandler):
+    def get(self):
+        hours = int_param(self, 'hours', 24, 1, 48)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(throughput_report(hours)))
+
+class skipped_stats(webapp2.RequestHandler):
+    def get(self):
+        hours = int_param(self, 'hours', 24, 1, 48)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(skipped_report(hours)))
 
-class delete_all_posts(webapp2.RequestHandler):
+class top_movies(webapp2.RequestHandler):
     def get(self):
-        ndb.delete_multi(
-            Post.query().fetch(keys_only=True)
+        window = self.request.get('window', 'day')
+        if window not in MENTION_WINDOWS:
+            self.abort(400, "window must be one of %s" % ', '.join(sorted(MENTION_WINDOWS)))
+        subreddit = self.request.get('subreddit')
+        k = int_param(self, 'k', 10, 1, ROLLUP_SIZE)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'window'    : window,
+            'subreddit' : subreddit or None,
+            'movies'    : get_top_movies(window, subreddit, k)
+        }))
+
+def queue_retention_sweep(kind,cursor=None):
+    policy = getattr(config, 'retention', {})
+    taskqueue.add(
+        url='/tasks/retention/sweep',
+        queue_name='retentionSweep',
+        params={
+            'kind'       : kind,
+            'cursor'     : cursor or '',
+            'batch_size' : policy.get('batch_size', retention.DEFAULT_BATCH_SIZE)
+        }
+    )
+
+# Starts a retention sweep for every kind with a retention policy
+class start_retention_sweep(webapp2.RequestHandler):
+    def get(self):
+        policy = getattr(config, 'retention', {})
+        now = datetime.datetime.now()
+        for kind in retention.DEFAULT_RETENTION_DAYS:
+            days = retention.retention_days(kind, policy)
+            cutoff = now - datetime.timedelta(days=days)
+            logging.info("Starting retention sweep of %s older than %d days (%s)" % (kind,days,cutoff))
+            retention.start_sweep(kind, cutoff)
+            queue_retention_sweep(kind)
+
+# Sweeps one page of a kind and chains the next page to a new task
+class retention_sweep(webapp2.RequestHandler):
+    def post(self):
+        kind = self.request.get('kind')
+        cursor = self.request.get('cursor') or None
+        batch_size = int(self.request.get('batch_size', retention.DEFAULT_BATCH_SIZE))
+        sweep = RetentionSweep.get_by_id(kind)
+        if sweep is None or sweep.done:
+            logging.warning("No retention sweep of %s in progress" % kind)
+            return
+        next_cursor = retention.sweep_batch(kind, sweep.cutoff, cursor, batch_size)
+        if next_cursor:
+            queue_retention_sweep(kind, next_cursor)
+        else:
+            logging.info("Retention sweep of %s is finished" % kind)
+
+class retention_status(webapp2.RequestHandler):
+    def get(self):
+        status = {}
+        for sweep in RetentionSweep.query():
+            status[sweep.key.id()] = {
+                'cutoff'      : str(sweep.cutoff),
+                'started'     : str(sweep.started),
+                'updated'     : str(sweep.updated),
+                'batches'     : sweep.batches,
+                'scanned'     : sweep.scanned,
+                'deleted'     : sweep.deleted,
+                'kept'        : sweep.kept,
+                'deletes_sec' : round(sweep.deleted / max(sweep.elapsed, 0.001), 1),
+                'done'        : sweep.done
+            }
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(status))
+
+def queue_migration(name,cursor=None,batch_size=migrations.DEFAULT_BATCH_SIZE):
+    taskqueue.add(
+        url='/tasks/migrate/%s' % name,
+        queue_name='migration',
+        params={
+            'cursor'     : cursor or '',
+            'batch_size' : batch_size
+        }
+    )
+
+# GET starts a migration, and each POST migrates
+# one batch and chains the next one to a new task
+class run_migration(webapp2.RequestHandler):
+    def get(self,name):
+        if name not in migrations.MIGRATIONS:
+            self.abort(404)
+        logging.info("Starting migration %s" % name)
+        migrations.start_migration(name)
+        queue_migration(name,batch_size=int(self.request.get('batch_size', migrations.DEFAULT_BATCH_SIZE)))
+
+    def post(self,name):
+        if name not in migrations.MIGRATIONS:
+            logging.error("Unknown migration %s" % name)
+            return
+        batch_size = int(self.request.get('batch_size', migrations.DEFAULT_BATCH_SIZE))
+        next_cursor = migrations.run_batch(name, self.request.get('cursor') or None, batch_size)
+        if next_cursor:
+            queue_migration(name, next_cursor, batch_size)
+        else:
+            logging.info("Migration %s is finished" % name)
+
+def queue_export(run,kind,index=0,cursor=None,batch_size=export.DEFAULT_BATCH_SIZE):
+    try:
+        taskqueue.add(
+            # A retried batch doesn't chain its next batch twice
+            name='export-%s-%s-%d' % (run, kind, index),
+            url='/tasks/export',
+            queue_name='export',
+            params={
+                'run'        : run,
+                'kind'       : kind,
+                'index'      : index,
+                'cursor'     : cursor or '',
+                'batch_size' : batch_size
+            }
         )
-        
-application = webapp2.WSGIApplication([
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info("Batch %d of %s in export %s was already queued" % (index, kind, run))
+
+# GET starts an export of the posts, comments and movies into
+# columnar chunks, and each POST exports one page of a kind and
+# chains the next page, or the next kind, to a new task
+class run_export(webapp2.RequestHandler):
+    def get(self):
+        run = export.start_export()
+        logging.info("Starting export %s" % run)
+        queue_export(run,export.EXPORT_KINDS[0],batch_size=int(self.request.get('batch_size', export.DEFAULT_BATCH_SIZE)))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'run': run}))
+
+    def post(self):
+        run = self.request.get('run')
+        kind = self.request.get('kind')
+        if kind not in export.EXPORT_KINDS:
+            logging.error("Unknown export kind %s" % kind)
+            return
+        index = int(self.request.get('index', 0))
+        batch_size = int(self.request.get('batch_size', export.DEFAULT_BATCH_SIZE))
+        next_cursor = export.export_batch(run, kind, index, self.request.get('cursor') or None, batch_size)
+        if next_cursor:
+            queue_export(run, kind, index + 1, next_cursor, batch_size)
+        elif export.next_kind(kind):
+            queue_export(run, export.next_kind(kind), batch_size=batch_size)
+        else:
+            logging.info("Export %s is finished" % run)
+
+class export_status(webapp2.RequestHandler):
+    def get(self):
+        status = {}
+        for run in ExportRun.query():
+            status[run.key.id()] = {
+                'started'  : str(run.started),
+                'updated'  : str(run.updated),
+                'chunks'   : run.chunks,
+                'rows'     : run.rows,
+                'bytes'    : run.size,
+                'elapsed'  : run.elapsed,
+                'done'     : run.done,
+                'download' : ['/tasks/exports/%s/%s.zip' % (run.key.id(), part) for part in export.run_parts(run)]
+            }
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(status))
+
+# One part of an export, a zip of up to export.CHUNKS_PER_PART chunks
+# of a kind, for analysis/load.py. The export status lists the parts.
+# The chunks are compressed already, so the zip only stores them
+class export_download(webapp2.RequestHandler):
+    def get(self,run,kind,part):
+        if kind not in export.EXPORT_KINDS:
+            self.abort(404)
+        chunks = export.part_chunks(run, kind, int(part))
+        if not chunks:
+            self.abort(404)
+        archive = StringIO.StringIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zipped:
+            for chunk in chunks:
+                zipped.writestr(export.chunk_filename(chunk), chunk.data)
+        self.response.headers['Content-Type'] = 'application/zip'
+        self.response.headers['Content-Disposition'] = 'attachment; filename="export-%s-%s.zip"' % (str(run), export.part_name(kind, int(part)))
+        self.response.write(archive.getvalue())
+
+class migration_status(webapp2.RequestHandler):
+    def get(self):
+        status = {}
+        for migration in MigrationStatus.query():
+            status[migration.key.id()] = {
+                'started'   : str(migration.started),
+                'updated'   : str(migration.updated),
+                'batches'   : migration.batches,
+                'processed' : migration.processed,
+                'elapsed'   : migration.elapsed,
+                'stats'     : migration.stats,
+                'done'      : migration.done
+            }
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(status))
+
+# Lists the recent profiles, optionally for one path,
+# or shows the top functions of a single profile
+class profiles(webapp2.RequestHandler):
+    def get(self):
+        profile_id = self.request.get('id')
+        self.response.headers['Content-Type'] = 'application/json'
+        if profile_id:
+            if not profile_id.isdigit():
+                self.abort(400, "id must be a number")
+            profile = Profile.get_by_id(int(profile_id))
+            if profile is None:
+                self.response.set_status(404)
+                self.response.write(json.dumps({'error': 'No profile %s' % profile_id}))
+                return
+            profile_list = [profile]
+        else:
+            path = self.request.get('path')
+            limit = int_param(self, 'limit', 20, 1, 100)
+            query = Profile.query(Profile.path == path) if path else Profile.query()
+            profile_list = query.order(-Profile.started).fetch(limit)
+        ret = []
+        for profile in profile_list:
+            summary = {
+                'id'          : profile.key.id(),
+                'path'        : profile.path,
+                'method'      : profile.method,
+                'trigger'     : profile.trigger,
+                'started'     : str(profile.started),
+                'elapsed'     : profile.elapsed,
+                'total_calls' : profile.total_calls
+            }
+            if profile_id:
+                summary['top'] = profile.top
+            else:
+                summary['slowest'] = profile.top[0]['function'] if profile.top else None
+            ret.append(summary)
+        self.response.write(json.dumps(ret[0] if profile_id else ret))
+
+application = ProfilingMiddleware(webapp2.WSGIApplication([
     ('/tasks/search/imdb', search_imdb),
     ('/tasks/search/user', search_usermention),
+    ('/tasks/poll/whitelisted', poll_whitelisted),
     ('/tasks/manual/(\w+)', manual_process),
     ('/tasks/review_comment', review_comment),
+    ('/tasks/index_comment', index_comment_later),
+    ('/tasks/record_latencies', record_latencies_later),
     ('/tasks/process_post', process_post),
-    ('/tasks/delete_all_posts', delete_all_posts),
+    ('/tasks/process_posts', process_posts),
+    ('/tasks/retention', start_retention_sweep),
+    ('/tasks/retention/sweep', retention_sweep),
+    ('/tasks/retention/status', retention_status),
+    ('/tasks/migrations', migration_status),
+    ('/tasks/export', run_export),
+    ('/tasks/exports', export_status),
+    ('/tasks/exports/([\w-]+)/(\w+)-(\d+)\.zip', export_download),
+    ('/tasks/migrate/(\w+)', run_migration),
     ('/tasks/inbox', read_messages),
+    ('/tasks/process_message', process_message),
     ('/tasks/check_comments',check_comments),
-    ('/tasks/wiki', update_wiki_lists)
+    ('/tasks/refresh_sources', refresh_sources),
+    ('/tasks/wiki', update_wiki_lists),
+    ('/tasks/stats/rollup', rollup_stats),
+    ('/tasks/stats/top', top_movies),
+    ('/tasks/stats/latency', latency_stats),
+    ('/tasks/stats/skipped', skipped_stats),
+    ('/tasks/stats/throughput', throughput_stats),
+    ('/tasks/profiles', profiles)
 ],
     debug=True
-)
+))
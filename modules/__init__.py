@@ -1,2 +1,2 @@
-from .utilities import parse_text_for_imdb_ids, parse_text_for_rt_ids, rotten_tomatoes_2_imdb
+from .utilities import parse_text_for_imdb_ids, parse_text_for_rt_ids, rotten_tomatoes_2_imdb, make_post_digest, is_post_digest
 
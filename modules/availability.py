@@ -0,0 +1,45 @@
+import logging
+import datetime
+import hashlib
+import json
+
+from storage import get_repository
+from parsing import normalize_sources
+
+# Snapshots older than this are rebuilt when a movie is rendered.
+# Movies with live comments are kept fresh by the refresh job
+SNAPSHOT_MAX_AGE = datetime.timedelta(days=1)
+
+def is_fresh(snapshot, mhid, now=None):
+    if snapshot is None or snapshot.built is None or snapshot.mhid != mhid:
+        return False
+    if now is None:
+        now = datetime.datetime.now()
+    return now - snapshot.built < SNAPSHOT_MAX_AGE
+
+"""
+Rebuilds the snapshot of the movie from the content of its MediaHound
+sources. The version only goes up when the normalized table changes
+"""
+def update_snapshot(imdb_id, mhid, content):
+    repository = get_repository()
+    snapshot = repository.get_snapshot(imdb_id)
+    if snapshot is None:
+        snapshot = repository.new('AvailabilitySnapshot', id=imdb_id)
+    media_types, friendly_names, method_types = normalize_sources(content)
+    exclude = not content
+    content_hash = hashlib.sha1(json.dumps(
+        [mhid, media_types, friendly_names, method_types, exclude], sort_keys=True
+    )).hexdigest()
+    if content_hash != snapshot.content_hash:
+        snapshot.version += 1
+        snapshot.mhid = mhid
+        snapshot.media_types = media_types
+        snapshot.friendly_names = friendly_names
+        snapshot.method_types = method_types
+        snapshot.exclude = exclude
+        snapshot.content_hash = content_hash
+        logging.info("Availability of %s changed. Snapshot is now version %d" % (imdb_id, snapshot.version))
+    snapshot.built = datetime.datetime.now()
+    repository.put(snapshot)
+    return snapshot
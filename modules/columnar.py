@@ -0,0 +1,159 @@
+"""
+A compact columnar file format for the analytics export. A chunk holds
+a batch of rows of one kind, stored column by column as little endian
+typed arrays, and the whole chunk is zlib compressed:
+
+    MAGIC, header length (uint32), header JSON, column blocks
+
+The header has the kind, the number of rows, and for every column its
+type and the offset, length and dtype of its blocks in the body. The
+column types are
+
+    int    int64 values, and a uint8 null mask when a value is missing
+    float  float64 values, NaN when missing
+    bool   int8 values, -1 when missing
+    time   int64 unix seconds (UTC), and a uint8 null mask
+    str    int32 codes into the dictionary in the header, -1 when missing
+    strs   a list of strings per row: int32 offsets (rows + 1) into
+           int32 codes into the dictionary in the header
+
+Nothing here depends on App Engine, so the analysis scripts use it too
+"""
+
+import json
+import math
+import struct
+import zlib
+import calendar
+import datetime
+
+MAGIC = b'MBCOL1'
+COLUMN_TYPES = ['int', 'float', 'bool', 'time', 'str', 'strs']
+# Block dtype -> struct format character
+STRUCT_FORMATS = {
+    '<i8' : 'q',
+    '<f8' : 'd',
+    '<i4' : 'i',
+    'i1'  : 'b',
+    'u1'  : 'B'
+}
+
+def pack(dtype, values):
+    return struct.pack('<%d%s' % (len(values), STRUCT_FORMATS[dtype]), *values)
+
+def unpack(dtype, data):
+    size = struct.calcsize('<' + STRUCT_FORMATS[dtype])
+    return list(struct.unpack('<%d%s' % (len(data) // size, STRUCT_FORMATS[dtype]), data))
+
+def to_timestamp(value):
+    return calendar.timegm(value.utctimetuple())
+
+class Dictionary(object):
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        if value is None:
+            return -1
+        if value not in self.codes:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+        return self.codes[value]
+
+"""
+Returns the blocks of a column as a list of (name, dtype, values), and
+the string dictionary of the column or None
+"""
+def encode_column(column_type, values):
+    if column_type in ['int', 'time']:
+        if column_type == 'time':
+            values = [to_timestamp(value) if value is not None else None for value in values]
+        blocks = [('values', '<i8', [value if value is not None else 0 for value in values])]
+        if None in values:
+            blocks.append(('nulls', 'u1', [1 if value is None else 0 for value in values]))
+        return blocks, None
+    if column_type == 'float':
+        return [('values', '<f8', [float(value) if value is not None else float('nan') for value in values])], None
+    if column_type == 'bool':
+        return [('values', 'i1', [-1 if value is None else int(bool(value)) for value in values])], None
+    dictionary = Dictionary()
+    if column_type == 'str':
+        return [('codes', '<i4', [dictionary.code(value) for value in values])], dictionary.values
+    if column_type == 'strs':
+        offsets = [0]
+        codes = []
+        for value in values:
+            codes.extend(dictionary.code(item) for item in value or [])
+            offsets.append(len(codes))
+        return [('offsets', '<i4', offsets), ('codes', '<i4', codes)], dictionary.values
+    raise ValueError("Unknown column type %s" % column_type)
+
+"""
+Encodes the rows, a list of dicts, into a chunk with the columns,
+a list of (name, type)
+"""
+def encode_chunk(kind, columns, rows, level=9):
+    header = {'kind': kind, 'rows': len(rows), 'columns': []}
+    body = []
+    offset = 0
+    for name, column_type in columns:
+        blocks, dictionary = encode_column(column_type, [row.get(name) for row in rows])
+        column = {'name': name, 'type': column_type, 'blocks': {}}
+        if dictionary is not None:
+            column['dictionary'] = dictionary
+        for block_name, dtype, values in blocks:
+            data = pack(dtype, values)
+            column['blocks'][block_name] = [offset, len(data), dtype]
+            body.append(data)
+            offset += len(data)
+        header['columns'].append(column)
+    # Non ASCII is escaped, so the header is ASCII on any Python
+    header = json.dumps(header, separators=(',', ':')).encode('ascii')
+    return zlib.compress(MAGIC + struct.pack('<I', len(header)) + header + b''.join(body), level)
+
+"""
+Returns the header and the uncompressed body of a chunk
+"""
+def read_chunk(data):
+    data = zlib.decompress(data)
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a columnar export chunk")
+    start = len(MAGIC) + 4
+    header_length = struct.unpack('<I', data[len(MAGIC):start])[0]
+    header = json.loads(data[start:start + header_length].decode('ascii'))
+    return header, data[start + header_length:]
+
+def block(body, column, name):
+    offset, length, dtype = column['blocks'][name]
+    return unpack(dtype, body[offset:offset + length])
+
+"""
+Decodes a chunk into the kind and a dict of column name -> list of
+Python values. The NumPy loader reads the blocks directly instead
+"""
+def decode_chunk(data):
+    header, body = read_chunk(data)
+    ret = {}
+    for column in header['columns']:
+        column_type = column['type']
+        if column_type in ['int', 'time']:
+            values = block(body, column, 'values')
+            if 'nulls' in column['blocks']:
+                values = [None if null else value for value, null in zip(values, block(body, column, 'nulls'))]
+            if column_type == 'time':
+                values = [datetime.datetime.utcfromtimestamp(value) if value is not None else None for value in values]
+        elif column_type == 'float':
+            values = [None if math.isnan(value) else value for value in block(body, column, 'values')]
+        elif column_type == 'bool':
+            values = [None if value == -1 else bool(value) for value in block(body, column, 'values')]
+        elif column_type == 'str':
+            dictionary = column['dictionary']
+            values = [dictionary[code] if code >= 0 else None for code in block(body, column, 'codes')]
+        else:
+            dictionary = column['dictionary']
+            offsets = block(body, column, 'offsets')
+            codes = block(body, column, 'codes')
+            values = [[dictionary[code] for code in codes[offsets[i]:offsets[i + 1]]] for i in range(header['rows'])]
+        ret[column['name']] = values
+    return header['kind'], ret
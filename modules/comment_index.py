@@ -0,0 +1,92 @@
+import logging
+import datetime
+
+from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+
+from models import MovieComments
+from storage import get_repository
+
+# Comments older than this are no longer re-rendered
+LIVE_COMMENT_DAYS = 7
+
+@ndb.transactional(retries=5)
+def add_to_index(imdb_id, comment_key, version=None):
+    index = MovieComments.get_by_id(imdb_id) or MovieComments(id=imdb_id)
+    if comment_key not in index.comments:
+        index.comments.append(comment_key)
+        # The comment was rendered from this version, so the first
+        # refresh can tell whether the sources changed since
+        if index.snapshot_version is None:
+            index.snapshot_version = version
+        index.put()
+
+@ndb.transactional
+def remove_from_index(imdb_id, comment_keys):
+    index = MovieComments.get_by_id(imdb_id)
+    if index is None:
+        return
+    index.comments = [key for key in index.comments if key not in comment_keys]
+    if index.comments:
+        index.put()
+    else:
+        index.key.delete()
+
+"""
+Records that the comment mentions each of the movies. Returns the
+movies it couldn't be indexed under because of contention
+"""
+def index_comment(movies, comment_key):
+    movies = list(set(movies))
+    snapshots = get_repository().get_multi('AvailabilitySnapshot', movies)
+    failed = []
+    for imdb_id, snapshot in zip(movies, snapshots):
+        try:
+            add_to_index(imdb_id, comment_key, snapshot.version if snapshot else None)
+        except datastore_errors.TransactionFailedError:
+            logging.warning("Couldn't index comment %s under %s" % (comment_key.id(), imdb_id))
+            failed.append(imdb_id)
+    logging.debug("Indexed comment %s under %s" % (comment_key.id(), movies))
+    return failed
+
+"""
+Removes the comment from the index of each of the movies
+"""
+def unindex_comment(movies, comment_key):
+    for imdb_id in set(movies):
+        remove_from_index(imdb_id, [comment_key])
+
+"""
+Returns the keys of the live comments that mention the movie,
+and drops comments that are deleted or too old to re-render
+"""
+def live_comments(imdb_id):
+    index = MovieComments.get_by_id(imdb_id)
+    if index is None:
+        return []
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=LIVE_COMMENT_DAYS)
+    live = []
+    stale = []
+    for key, comment in zip(index.comments, ndb.get_multi(index.comments)):
+        if comment is None or comment.deleted or comment.post_date < cutoff:
+            stale.append(key)
+        else:
+            live.append(key)
+    if stale:
+        remove_from_index(imdb_id, stale)
+    return live
+
+"""
+Records the snapshot version the comments of the movie were
+reviewed against, and returns the version recorded before
+"""
+@ndb.transactional
+def set_snapshot_version(imdb_id, version):
+    index = MovieComments.get_by_id(imdb_id)
+    if index is None:
+        return None
+    previous = index.snapshot_version
+    index.snapshot_version = version
+    index.checked = datetime.datetime.now()
+    index.put()
+    return previous
@@ -0,0 +1,82 @@
+import logging
+import datetime
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    # Off App Engine the skipped lookups are only logged
+    memcache = None
+
+from storage import get_repository
+from stats import bucket_name, recent_buckets
+from imdb import movie_is_fresh
+
+COUNTERS = ['posts', 'lookups', 'calls']
+# Keep the counters around for a day after the hour is over
+COUNTER_SECONDS = 60 * 60 * 48
+
+def counter_key(bucket, counter):
+    return 'skipped-%s-%s' % (counter, bucket)
+
+"""
+Estimates the OMDb and MediaHound calls lookup_movie_data would have
+made for the movies: OMDb when the data is missing or a week old, and
+MediaHound when there's no MediaHound id yet. Calls that another task
+would have made at the same time are counted too, so it's an upper bound
+"""
+def upstream_calls(movies, now=None):
+    calls = 0
+    for movie in movies:
+        if not movie_is_fresh(movie, now):
+            calls += 1
+        if movie is None:
+            # graph_enter, then graph_media for the metadata
+            calls += 2
+        elif not movie.mhid:
+            calls += 1
+    return calls
+
+"""
+Counts the posts found ineligible before their movies were looked up,
+the movie lookups that were skipped because of it, and the upstream
+calls those lookups would have made, in this hour's counters
+"""
+def record_skipped(posts, imdb_ids, now=None):
+    if not posts:
+        return
+    if now is None:
+        now = datetime.datetime.now()
+    imdb_ids = list(set(imdb_ids))
+    calls = upstream_calls(get_repository().get_movies(imdb_ids), now) if imdb_ids else 0
+    logging.info("Skipped %d ineligible posts before looking up %d movies, saving about %d upstream calls" % (
+        posts, len(imdb_ids), calls
+    ))
+    if memcache is None:
+        return
+    bucket = bucket_name('hour', now)
+    for counter, value in zip(COUNTERS, [posts, len(imdb_ids), calls]):
+        if value:
+            key = counter_key(bucket, counter)
+            # incr can't set an expiry, so the counter is created first
+            memcache.add(key, 0, time=COUNTER_SECONDS)
+            memcache.incr(key, value, initial_value=0)
+
+"""
+Returns the skipped posts, lookups and upstream calls of each of
+the last hours, newest first, and their totals
+"""
+def skipped_report(hours=24, now=None):
+    if now is None:
+        now = datetime.datetime.now()
+    buckets = recent_buckets('hour', hours, now)
+    counts = {}
+    if memcache is not None:
+        counts = memcache.get_multi([counter_key(bucket, counter) for bucket in buckets for counter in COUNTERS])
+    report = {'hours': [], 'total': dict((counter, 0) for counter in COUNTERS)}
+    for bucket in buckets:
+        hour = {'hour': bucket}
+        for counter in COUNTERS:
+            hour[counter] = int(counts.get(counter_key(bucket, counter)) or 0)
+            report['total'][counter] += hour[counter]
+        report['hours'].append(hour)
+    return report
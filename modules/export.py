@@ -0,0 +1,190 @@
+import logging
+import datetime
+
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+from models import Comment, ExportRun, ExportChunk
+from columnar import encode_chunk
+from storage import get_repository
+
+# Rows per chunk. Chunks are stored as single entities,
+# so they have to stay well under the 1MB entity limit
+DEFAULT_BATCH_SIZE = 500
+MAX_BATCH_SIZE = 1000
+# Chunks per downloaded zip. At under 1MB a chunk, a zip stays
+# well under the 32MB limit of a response
+CHUNKS_PER_PART = 20
+
+def post_row(post):
+    timings = post.timings or {}
+    latency = None
+    if timings.get('created') is not None and timings.get('commented') is not None:
+        latency = timings['commented'] - timings['created']
+    return {
+        'name'        : post.key.id(),
+        'kind'        : post.post_kind,
+        'author'      : post.author,
+        'subreddit'   : post.subreddit.lower() if post.subreddit else None,
+        'post_date'   : post.post_date,
+        'added'       : post.added,
+        'commented'   : post.commented,
+        'stage'       : post.stage,
+        'movies'      : post.movies_list,
+        'movie_count' : len(post.movies_list),
+        'latency'     : latency
+    }
+
+def comment_row(comment):
+    return {
+        'name'       : comment.key.id(),
+        'post'       : comment.key.parent().id() if comment.key.parent() else None,
+        'post_date'  : comment.post_date,
+        'updated'    : comment.updated,
+        'score'      : comment.score,
+        'revision'   : comment.revision,
+        'deleted'    : comment.deleted,
+        'next_check' : comment.next_check
+    }
+
+def movie_row(movie, snapshot):
+    return {
+        'imdb_id'      : movie.key.id(),
+        'title'        : movie.Title,
+        'year'         : movie.Year,
+        'type'         : movie.Type.name if movie.Type is not None else None,
+        'imdb_rating'  : movie.imdbRating,
+        'imdb_votes'   : movie.imdbVotes,
+        'tomato_meter' : movie.tomatoMeter,
+        'metascore'    : movie.Metascore,
+        'mhid'         : movie.mhid,
+        'fetched'      : movie.fetched,
+        'providers'    : snapshot.friendly_names if snapshot else [],
+        'method_types' : snapshot.method_types if snapshot else [],
+        'excluded'     : snapshot.exclude if snapshot else None
+    }
+
+def post_rows(posts):
+    return [post_row(post) for post in posts]
+
+def comment_rows(comments):
+    return [comment_row(comment) for comment in comments]
+
+def movie_rows(movies):
+    # Where the movies can be watched comes from their snapshots
+    snapshots = get_repository().get_multi('AvailabilitySnapshot', [movie.key.id() for movie in movies])
+    return [movie_row(movie, snapshot) for movie, snapshot in zip(movies, snapshots)]
+
+"""
+Returns a function reading a page of the kind from the repository,
+where the posts and movies are stored with either backend
+"""
+def repository_pages(kind):
+    return lambda cursor, limit: get_repository().page(kind, cursor, limit)
+
+# Comments are always in the datastore
+def ndb_pages(model):
+    def page(cursor, limit):
+        entities, next_cursor, more = model.query().fetch_page(
+            limit, start_cursor=Cursor(urlsafe=cursor) if cursor else None
+        )
+        return entities, (next_cursor.urlsafe() if more and next_cursor else None)
+    return page
+
+# Kind -> (function returning a page of entities and the next cursor,
+# function turning a page of entities into rows, the columns as
+# (name, type)), exported in this order
+EXPORTS = [
+    ('Post', repository_pages('Post'), post_rows, [
+        ('name', 'str'), ('kind', 'str'), ('author', 'str'), ('subreddit', 'str'),
+        ('post_date', 'time'), ('added', 'time'), ('commented', 'bool'), ('stage', 'str'),
+        ('movies', 'strs'), ('movie_count', 'int'), ('latency', 'float')
+    ]),
+    ('Comment', ndb_pages(Comment), comment_rows, [
+        ('name', 'str'), ('post', 'str'), ('post_date', 'time'), ('updated', 'time'),
+        ('score', 'int'), ('revision', 'int'), ('deleted', 'bool'), ('next_check', 'time')
+    ]),
+    ('Movies', repository_pages('Movies'), movie_rows, [
+        ('imdb_id', 'str'), ('title', 'str'), ('year', 'int'), ('type', 'str'),
+        ('imdb_rating', 'float'), ('imdb_votes', 'int'), ('tomato_meter', 'int'), ('metascore', 'int'),
+        ('mhid', 'str'), ('fetched', 'time'), ('providers', 'strs'), ('method_types', 'strs'),
+        ('excluded', 'bool')
+    ])
+]
+EXPORT_KINDS = [kind for kind, _, _, _ in EXPORTS]
+
+def chunk_id(run, kind, index):
+    return "%s|%s|%05d" % (run, kind, index)
+
+def next_kind(kind):
+    index = EXPORT_KINDS.index(kind) + 1
+    return EXPORT_KINDS[index] if index < len(EXPORT_KINDS) else None
+
+def start_export(now=None):
+    if now is None:
+        now = datetime.datetime.now()
+    run = now.strftime('%Y%m%d-%H%M%S')
+    ExportRun(id=run, started=now, chunks={}, rows={}, size={}).put()
+    return run
+
+"""
+Streams one page of the kind from the cursor into a chunk of the run.
+Returns the cursor for the next page of the kind, or None when the
+kind is finished. Retries of a batch overwrite the same chunk
+"""
+def export_batch(run, kind, index, cursor=None, batch_size=DEFAULT_BATCH_SIZE):
+    batch_size = min(batch_size, MAX_BATCH_SIZE)
+    _, fetch_page, make_rows, columns = EXPORTS[EXPORT_KINDS.index(kind)]
+    start = datetime.datetime.now()
+    entities, next_cursor = fetch_page(cursor, batch_size)
+    rows = make_rows(entities)
+    data = encode_chunk(kind, columns, rows)
+    key = ndb.Key(ExportChunk, chunk_id(run, kind, index))
+    previous = key.get()
+    ExportChunk(key=key, run=run, kind=kind, index=index, rows=len(rows), data=data).put()
+    elapsed = (datetime.datetime.now() - start).total_seconds()
+    status = update_progress(run, kind, previous, len(rows), len(data), elapsed, next_cursor is None and next_kind(kind) is None)
+    logging.info("Export %s wrote chunk %d of %s: %d rows in %d bytes in %.2fs. Totals: %s rows" % (
+        run, index, kind, len(rows), len(data), elapsed, status.rows
+    ))
+    return next_cursor
+
+def update_progress(run, kind, previous, rows, size, elapsed, done):
+    status = ExportRun.get_by_id(run)
+    if status is None:
+        status = ExportRun(id=run, started=datetime.datetime.now(), chunks={}, rows={}, size={})
+    # A retried batch replaces its chunk instead of adding one
+    if previous is not None:
+        status.chunks[kind] = status.chunks.get(kind, 0) - 1
+        status.rows[kind] = status.rows.get(kind, 0) - previous.rows
+        status.size[kind] = status.size.get(kind, 0) - len(previous.data)
+    status.chunks[kind] = status.chunks.get(kind, 0) + 1
+    status.rows[kind] = status.rows.get(kind, 0) + rows
+    status.size[kind] = status.size.get(kind, 0) + size
+    status.elapsed += elapsed
+    status.done = done
+    status.put()
+    return status
+
+def chunk_filename(chunk):
+    return "%s-%05d.col" % (chunk.kind, chunk.index)
+
+def part_name(kind, part):
+    return "%s-%03d" % (kind, part)
+
+"""
+Returns the names of the parts the export is downloaded in: every
+CHUNKS_PER_PART chunks of a kind, in order
+"""
+def run_parts(status):
+    return [part_name(kind, part) for kind in EXPORT_KINDS
+        for part in range((status.chunks.get(kind, 0) + CHUNKS_PER_PART - 1) // CHUNKS_PER_PART)]
+
+"""
+Returns the chunks of a part, read by key so only the
+part is ever in memory
+"""
+def part_chunks(run, kind, part):
+    indexes = range(part * CHUNKS_PER_PART, (part + 1) * CHUNKS_PER_PART)
+    chunks = ndb.get_multi([ndb.Key(ExportChunk, chunk_id(run, kind, index)) for index in indexes])
+    return [chunk for chunk in chunks if chunk is not None]
@@ -0,0 +1,96 @@
+"""
+Rendering of the comment table. Pure Python, like modules/parsing.py
+"""
+
+import logging
+
+def sort_method_types(method_types):
+    ret = []
+    # These are method types we care about
+    ordered_types = ['Subscription', 'Rent', 'Purchase']
+    for i in ordered_types:
+        if i in method_types:
+            ret.append(i.title())
+    # Append any unmatched methods:
+    unmatched = [x.title() for x in method_types if x not in ordered_types]
+    if unmatched:
+        logging.debug(unmatched)
+        ret.extend(list(set(unmatched)))
+    return ret
+
+def format_new_post(movies_data):
+    media_types = movies_data['media_types']
+    friendly_names = movies_data['friendly_names']
+    pulral = ''
+    if len(movies_data['movies']) > 1:
+        pulral = 's'
+    if len(friendly_names) == 0:
+        ret_line = ["Sorry, no streaming, rental, or purchase links found for the following movies:\n\n"]
+    else:
+        ret_line = [
+            "Here's where you can %s the movie%s listed:\n\n" %
+                ('/'.join(friendly_names),pulral)
+        ]
+    heading = ['Title','IMDB','Rotten Tomatoes']
+    heading += media_types
+    seperator = []
+    actual_links = False
+    for index, w in enumerate(heading):
+        sep = "---"
+        if index > 1:
+            sep+=":"
+        seperator.append(sep)
+    ret_line.append(" | ".join(heading))
+    ret_line.append("|".join(seperator))
+    for movie in movies_data['movies']:
+        # If we have details about the movie, but no 
+        # links, then just add a message
+        if movie['exclude'] and 'imdb_title' not in movie:
+            logging.info("We don't have any info, so tell the user we excluded the title")
+#            line.append("No %s options for: %s" % ( ' , '.join(media_types), title ))
+            continue
+        actual_links = True
+        rt_rating = movie['tomatoMeter']
+        if rt_rating is None:
+            rt_rating = 'N/A'
+        else:
+            rt_rating = "{0}%".format(rt_rating)
+        rt_link = movie['rottentomatoes']
+        imdb_rating = movie['imdb_rating']
+        if imdb_rating is None:
+            imdb_rating = 'N/A'
+        imdb_link = "http://www.imdb.com/title/%s/" % movie['imdb_id']
+        if 'mhid' in movie:
+            short_url = "https://nextqueue.com/movie/%s" % movie['mh_altId'][6:]
+            title = movie['mh_title']
+        else:
+            short_url = imdb_link
+            title = movie['imdb_title']
+        line = ["**[%s](%s)**" % (title, short_url)]
+        line.append("[%s](%s)" % (imdb_rating,imdb_link))
+        if rt_link is not None:
+            line.append("[{0}]({1})".format(rt_rating,rt_link))
+        else:
+            line.append(rt_rating)
+        logging.debug(line)
+        for media_type in media_types:
+            if media_type in movie['media_types']:
+                type_strings = []
+                for provider,details in movie['media_types'][media_type].items():
+                    name = provider
+                    if details['price'] > 0:
+                        name = "%s - $%s" % (provider, details['price'])
+                    type_strings.append(
+                        ("[%s](%s)" % ( name, details['url'] )).replace(' ','&nbsp;')
+                    )
+                type_joined = ' &#183; '.join(type_strings)
+            else:
+                type_joined = ''
+            line.append(type_joined)
+        ret_line.append('|'.join(line))
+    # If we don't have streams for any movies, we shouldn't comment
+    # Only return the formatted text if we have useful info
+    if actual_links:
+        return "\n".join(ret_line)
+    else:
+        return False
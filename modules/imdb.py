@@ -1,42 +1,88 @@
 # -*- coding: utf-8 -*- 
 
 import logging
-import urllib2
 import datetime
 import json
+import zlib
 
-from google.appengine.api import urlfetch
-from google.appengine.ext import ndb
+from models import MovieTypes
+from parsing import parse_movie_fields
+from storage import get_repository
+from singleflight import single_flight
+import transport
 
-from models import Movies, MovieTypes
+MOVIE_MAX_AGE = datetime.timedelta(days=7)
+FETCH_TRIES = 5
+# The longest fetch_response can take, so tasks waiting on it
+# don't give up or take over while it still runs
+FETCH_SECONDS = FETCH_TRIES * transport.DEFAULT_DEADLINE + 15
+
+def parse_type(value):
+    return getattr(MovieTypes, value, None)
+
+"""
+Converts an OMDb response into the typed Movies fields
+"""
+def derive_movie_fields(response):
+    fields = parse_movie_fields(response)
+    if fields['Type'] is not None:
+        fields['Type'] = parse_type(fields['Type'])
+    return fields
+
+def archive_response(imdb_id, response, fetched):
+    return get_repository().new('MovieArchive',
+        id = imdb_id,
+        raw = zlib.compress(json.dumps(response), 9),
+        fetched = fetched
+    )
+
+def load_archive(archive):
+    return json.loads(zlib.decompress(archive.raw))
+
+"""
+A movie is looked up again on OMDb when its data is a week old
+"""
+def movie_is_fresh(movie, now=None):
+    if now is None:
+        now = datetime.datetime.now()
+    return movie is not None and (movie.fetched or movie.updated) >= now - MOVIE_MAX_AGE
 
 class IMDB:
 
     def __init__(self, imdb_id=None):
         self.imdb_id = imdb_id
         if self.imdb_id is not None:
-            date_search = datetime.datetime.now() - datetime.timedelta(days=7)
             imdb_data = self.get_imdb_data()
-            if imdb_data is None or imdb_data.updated < date_search:
-                urlfetch.set_default_fetch_deadline(45)
-                tries = 5
-                while tries > 0:
-                    self.response = self.api_call("http://omdbapi.com/?i=%s&plot=short&r=json&tomatoes=true" % imdb_id)
-                    logging.debug("Response is %s" % self.response)
-                    if self.response is not None:
-                        break
-                    tries -= 1
+            if not self.is_fresh(imdb_data):
+                # Tasks looking up the same movie at the same time share one OMDb call
+                self.response = single_flight('omdb-%s' % imdb_id, self.fetch_response, lease_seconds=FETCH_SECONDS)
+                # The task that made the call may have stored it already
+                imdb_data = self.get_imdb_data(use_cache=False)
+                if self.is_fresh(imdb_data):
+                    self.movie_data = imdb_data
                 else:
-                    raise Exception("Couldn't get movie data after 5 tries")
-                self.movie_data = self.add_movie_data()
+                    self.movie_data = self.add_movie_data(imdb_data)
                 logging.debug("Type of this is %s" % self.movie_data.Type)
             else:
                 logging.debug("Movie is already in NDB and data is less than 7 days old")
                 self.movie_data = imdb_data
 
+    def is_fresh(self, imdb_data):
+        return movie_is_fresh(imdb_data)
+
+    def fetch_response(self):
+        tries = FETCH_TRIES
+        while tries > 0:
+            response = self.api_call("http://omdbapi.com/?i=%s&plot=short&r=json&tomatoes=true" % self.imdb_id)
+            logging.debug("Response is %s" % response)
+            if response is not None:
+                return response
+            tries -= 1
+        raise Exception("Couldn't get movie data after %d tries" % FETCH_TRIES)
 
-    def get_imdb_data(self):
-        key = ndb.Key(Movies, self.imdb_id).get()
+
+    def get_imdb_data(self, use_cache=True):
+        key = get_repository().get_movie(self.imdb_id, use_cache)
         if key:
             logging.debug("IMDB key in DB")
             logging.debug(key)
@@ -45,67 +91,32 @@ class IMDB:
             logging.debug("IMDB key is not in the DB")
             return None
 
-    def add_movie_data(self):
-        movie = Movies (id=self.imdb_id)
-        for thing, process_type in {
-            'Title' : 'default',
-            'Year' : 'int',
-            'Poster' : 'default',
-            'Released' : 'date',
-            'DVD' : 'date',
-            'Type' : 'type',
-            'Season' : 'int',
-            'Episode' : 'int',
-            'seriesID' : 'default',
-            'imdbID' : 'default',
-            'imdbRating' : 'float',
-            'imdbVotes' : 'int',
-            'tomatoMeter' : 'int',
-            'tomatoURL' : 'default',
-            'tomatoRating' : 'float',
-            'tomatoReviews' : 'int',
-            'tomatoFresh' : 'int',
-            'tomatoRotten' : 'int',
-            'tomatoUserMeter' : 'int',
-            'tomatoUserRating' : 'float',
-            'tomatoUserReviews' : 'int',
-            'Metascore' : 'int'
-        }.iteritems():
-            logging.debug("Need to process %s as type %s" % (thing,process_type))
-            if process_type is 'default':
-                thing_value = self.get_thing(thing)
-            elif process_type is 'int':
-                thing_value = self.get_thing(thing)
-                if thing_value:
-                    thing_value = int(thing_value.replace(',','').split(u"–", 1)[0])
-            elif process_type is 'float':
-                thing_value = self.get_thing(thing)
-                if thing_value:
-                    thing_value = float(thing_value)
-            elif process_type is 'date':
-                thing_value = self.get_thing_date(thing)
-            elif process_type is 'type':
-                thing_value = self.get_thing_type(thing)
-            else:
-                thing_value = None
+    def add_movie_data(self,movie=None):
+        fetched = datetime.datetime.now()
+        # Keep what we know about the movie that doesn't come from OMDb
+        if movie is None:
+            movie = get_repository().new('Movies', id=self.imdb_id)
+        for thing, thing_value in derive_movie_fields(self.response).items():
             logging.debug("Setting self.%s to be %s" % (thing,thing_value))
             setattr(movie,thing,thing_value)
-        movie.put()
+        movie.fetched = fetched
+        # Archive the raw response, so fields can be rederived without refetching
+        get_repository().put_multi([movie, archive_response(self.imdb_id, self.response, fetched)])
         return movie
 
     def add_metadata(self,metadata):
-        movie = ndb.Key(Movies, self.imdb_id).get()
+        movie = get_repository().get_movie(self.imdb_id)
         for key, value in metadata.items():
             logging.debug("%s:%s" % (key,value))
             setattr(movie,key,value)
-        movie.put()
+        get_repository().put(movie)
         return movie
 
     def api_call(self,url):
         logging.info("Calling OMDB API with the following URL: %s" % url)
         try:
-            result = urlfetch.fetch(url)
-        except urllib2.URLError, e:
+            result = transport.fetch(url)
+        except transport.TransportError, e:
             logging.error("Couldn't fetch info from OMDB")
             return None
         if result.status_code == 200:
@@ -115,26 +126,23 @@ class IMDB:
             logging.error("The IMDB Api call returned with status code %d" % result.status_code)
             return None
 
-    def get_thing_type(self,thing):
-        movie_type = self.get_thing(thing)
-        if movie_type:
-            return getattr(MovieTypes, movie_type)
-        else:
-            return None
-
-    def get_thing_date(self,thing):
-        date_string = self.get_thing(thing)
-        if date_string:
-            imdb_date = datetime.datetime.strptime(date_string, '%d %b %Y')
-            return imdb_date
-        else:
-            return None
-
-    def get_thing(self,thing):
-        if thing in self.response and self.response[thing] != 'N/A':
-            ret = self.response[thing]
-            logging.debug("Looked up %s in the response. Returning back %s" % (thing, ret))
-            return ret 
-        else:
-            logging.debug("Unable to find %s in the response, or it was set to N/A" % thing)
-            return None
\ No newline at end of file
+"""
+Rebuilds the typed fields of one page of movies from their
+archived OMDb responses, without any network calls
+"""
+def rederive_batch(cursor, batch_size):
+    repository = get_repository()
+    archives, next_cursor = repository.page('MovieArchive', cursor, batch_size)
+    movies = repository.get_movies([archive.key.id() for archive in archives])
+    updated = []
+    stats = {'rederived': 0, 'missing': 0}
+    for archive, movie in zip(archives, movies):
+        if archive is None or movie is None:
+            stats['missing'] += 1
+            continue
+        for thing, thing_value in derive_movie_fields(load_archive(archive)).items():
+            setattr(movie,thing,thing_value)
+        updated.append(movie)
+    repository.put_multi(updated)
+    stats['rederived'] = len(updated)
+    return next_cursor, len(archives), stats
@@ -0,0 +1,189 @@
+import logging
+import random
+import time
+import datetime
+
+from google.appengine.ext import ndb
+
+from models import LatencyHistogram, LatencyHour, LatencyRollup
+from stats import ALL_SUBREDDITS, NUM_SHARDS, bucket_name, recent_buckets
+
+# Stage name -> the timestamps it runs between
+STAGES = [
+    ('discovery', 'created', 'discovered'),
+    ('queue', 'discovered', 'started'),
+    ('lookup', 'started', 'looked_up'),
+    ('submit', 'looked_up', 'commented'),
+    ('total', 'created', 'commented')
+]
+# Upper bounds in seconds of the histogram buckets. One more
+# bucket at the end counts everything slower than the last bound
+BUCKET_BOUNDS = [1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, 28800, 86400]
+WINDOWS = {
+    'hour' : 1,
+    'day'  : 24,
+    'week' : 24 * 7
+}
+# How many shards a post's latencies are tried on before giving up
+RECORD_TRIES = 3
+
+"""
+Starts the stage timestamps of a post from its digest. The
+discovered time is set on the digest when the post is queued
+"""
+def start_timings(digest=None, post_date=None):
+    timings = {'started': time.time()}
+    if digest is not None:
+        timings['created'] = digest.get('created_utc')
+        timings['discovered'] = digest.get('discovered')
+    elif post_date is not None:
+        timings['created'] = time.mktime(post_date.timetuple())
+    return timings
+
+def stage_latencies(timings):
+    latencies = {}
+    for stage, start, end in STAGES:
+        if timings.get(start) is not None and timings.get(end) is not None:
+            latencies[stage] = max(timings[end] - timings[start], 0)
+    return latencies
+
+def bucket_index(seconds):
+    for index, bound in enumerate(BUCKET_BOUNDS):
+        if seconds <= bound:
+            return index
+    return len(BUCKET_BOUNDS)
+
+# Histograms written before they were sharded have no shard
+def histogram_id(bucket, scope, shard=None):
+    if shard is None:
+        return "%s|%s" % (bucket, scope)
+    return "%s|%s|%d" % (bucket, scope, shard)
+
+@ndb.transactional(xg=True)
+def add_to_histograms(keys, hour, latencies):
+    histograms = ndb.get_multi(keys)
+    for index, histogram in enumerate(histograms):
+        if histogram is None:
+            scope = keys[index].id().split('|')[1]
+            histogram = LatencyHistogram(key=keys[index], hour=hour, scope=scope, counts={})
+            histograms[index] = histogram
+        for stage, seconds in latencies.items():
+            counts = histogram.counts.setdefault(stage, [0] * (len(BUCKET_BOUNDS) + 1))
+            counts[bucket_index(seconds)] += 1
+    ndb.put_multi(histograms)
+
+"""
+Adds the stage latencies of a commented post to a random shard of this
+hour's histograms, both site wide and for the subreddit of the post.
+Another shard is tried when one is contended. Returns False when none
+of them worked, so the caller can record them later
+"""
+def record_latencies(timings, subreddit, now=None):
+    if now is None:
+        now = datetime.datetime.now()
+    latencies = stage_latencies(timings)
+    if not latencies:
+        return True
+    bucket = bucket_name('hour', now)
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    for shard in random.sample(range(NUM_SHARDS), RECORD_TRIES):
+        keys = [ndb.Key(LatencyHistogram, histogram_id(bucket, scope, shard)) for scope in [ALL_SUBREDDITS, subreddit.lower()]]
+        try:
+            add_to_histograms(keys, hour, latencies)
+            break
+        except Exception, e:
+            logging.warning("Couldn't record latencies %s on shard %d: %s" % (latencies, shard, e))
+    else:
+        # Metrics should never stop a comment from being recorded
+        logging.error("Couldn't record latencies %s on %d shards" % (latencies, RECORD_TRIES))
+        return False
+    logging.info("Post to comment latencies in /r/%s: %s" % (subreddit, ', '.join(
+        "%s %.1fs" % (stage, latencies[stage]) for stage, _, _ in STAGES if stage in latencies
+    )))
+    return True
+
+"""
+Estimates the q quantile of the histogram counts, interpolating
+within the bucket. None when it falls past the last bound
+"""
+def percentile(counts, q):
+    total = sum(counts)
+    if total == 0:
+        return None
+    target = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= target:
+            if index == len(BUCKET_BOUNDS):
+                return None
+            lower = BUCKET_BOUNDS[index - 1] if index > 0 else 0
+            return round(lower + (BUCKET_BOUNDS[index] - lower) * (target - seen) / float(count), 1)
+        seen += count
+    return None
+
+def summarize(counts):
+    return {
+        'count' : sum(counts),
+        'p50'   : percentile(counts, 0.5),
+        'p90'   : percentile(counts, 0.9),
+        'p99'   : percentile(counts, 0.99)
+    }
+
+def add_counts(totals, stage_counts):
+    for stage, counts in stage_counts.items():
+        stage_totals = totals.setdefault(stage, [0] * len(counts))
+        for index, count in enumerate(counts):
+            stage_totals[index] += count
+
+"""
+Adds up the shards of every scope of an hour into its LatencyHour
+"""
+def total_hour(hour):
+    counts = {}
+    for histogram in LatencyHistogram.query(LatencyHistogram.hour == hour):
+        add_counts(counts.setdefault(histogram.scope, {}), histogram.counts)
+    LatencyHour(id=bucket_name('hour', hour), hour=hour, counts=counts).put()
+    return counts
+
+"""
+Retotals the open (and just closed) hours, then writes the histograms
+of every window and scope, so a report only reads the rollups
+"""
+def rollup_latencies(now=None):
+    if now is None:
+        now = datetime.datetime.now()
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    for previous in range(2):
+        total_hour(hour - datetime.timedelta(hours=previous))
+    rollups = []
+    stale = []
+    for window, hours in WINDOWS.items():
+        totals = {}
+        for hour_total in ndb.get_multi([ndb.Key(LatencyHour, bucket) for bucket in recent_buckets('hour', hours, now)]):
+            if hour_total is not None:
+                for scope, stage_counts in hour_total.counts.items():
+                    add_counts(totals.setdefault(scope, {}), stage_counts)
+        for scope, counts in totals.items():
+            rollups.append(LatencyRollup(id="%s|%s" % (window, scope), window=window, scope=scope, counts=counts))
+        # Scopes without a commented post in the window drop out of it
+        stale.extend(key for key in LatencyRollup.query(LatencyRollup.window == window).fetch(keys_only=True)
+            if key.id().split('|', 1)[1] not in totals)
+    ndb.put_multi(rollups)
+    ndb.delete_multi(stale)
+    logging.info("Wrote %d latency rollups and deleted %d stale ones" % (len(rollups), len(stale)))
+
+"""
+Returns {scope: {stage: {count, p50, p90, p99}}} for the window,
+for one subreddit or, with subreddit None, for every scope. It's
+read from the rollups, so it's as fresh as the last rollup
+"""
+def latency_report(window='day', subreddit=None):
+    if subreddit:
+        rollups = [ndb.Key(LatencyRollup, "%s|%s" % (window, subreddit.lower())).get()]
+    else:
+        rollups = LatencyRollup.query(LatencyRollup.window == window).fetch()
+    report = {}
+    for rollup in rollups:
+        if rollup is not None:
+            report[rollup.scope] = dict((stage, summarize(counts)) for stage, counts in rollup.counts.items())
+    return report
@@ -4,7 +4,12 @@ import json
 import time
 import logging
 import config
-from google.appengine.api import urlfetch
+import transport
+from singleflight import single_flight
+
+# The longest a graph call can take, so tasks waiting on
+# it don't give up or take over while it still runs
+FETCH_SECONDS = transport.DEFAULT_DEADLINE + 15
 
 class MediaHound:
 
@@ -21,9 +26,9 @@ class MediaHound:
             "Authorization": "Basic %s" % base64creds,
             "User-Agent": "moviesbot version 0.0.1 by /u/moviesbot"
         }
-        result = urlfetch.fetch("https://api.mediahound.com/1.2/security/oauth/token",
+        result = transport.fetch("https://api.mediahound.com/1.2/security/oauth/token",
             payload=request_payload_encoded,
-            method=urlfetch.POST,
+            method='POST',
             headers=headers,
         )
         if result.status_code == 200:
@@ -44,13 +49,17 @@ class MediaHound:
             self.auth_token = False
             return False
 
+    # Tasks entering the same ids at the same time share one call
     def graph_enter(self,raw_ids):
+        return single_flight('mh-enter-%s' % ','.join(sorted(raw_ids)), lambda: self.fetch_graph_enter(raw_ids), lease_seconds=FETCH_SECONDS)
+
+    def fetch_graph_enter(self,raw_ids):
         # Take the raw_ids and make into URL Format
         logging.debug(raw_ids)
         ids = '&'.join(['ids={0}'.format(i) for i in raw_ids])
         base_url = "https://api.mediahound.com/1.2/graph/enter/raw?%s" % ids
         logging.info("Going to request graph media from the following address: %s" % base_url)
-        result = urlfetch.fetch(
+        result = transport.fetch(
             url="%s&access_token=%s" % (base_url, self.auth_token)
         )
         if result.status_code == 200:
@@ -60,14 +69,18 @@ class MediaHound:
             logging.error("The MediaHound call returned with status code %d" % result.status_code)
             return None
     
+    # Tasks asking for the same media at the same time share one call
     def graph_media(self, mhid, media_type='metadata'):
+        return single_flight('mh-media-%s-%s' % (mhid, media_type), lambda: self.fetch_graph_media(mhid, media_type), lease_seconds=FETCH_SECONDS)
+
+    def fetch_graph_media(self, mhid, media_type='metadata'):
         base_url = "https://api.mediahound.com/1.2/graph/media/%s" % mhid
         params = ["access_token=%s" % self.auth_token]
         if media_type == 'sources':
             base_url += "/sources"
         params_string = '&'.join(params)
         logging.info("Going to request graph media from the following address: %s" % base_url)
-        result = urlfetch.fetch(
+        result = transport.fetch(
             url="%s?%s" % (base_url,params_string)
         )
         if result.status_code == 200:
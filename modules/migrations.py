@@ -0,0 +1,157 @@
+import logging
+import datetime
+
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+import revisions
+import imdb
+from models import MigrationStatus, Post, Movies, IgnoreList, Whitelisted, Blacklisted
+
+DEFAULT_BATCH_SIZE = 100
+
+# Properties that no longer exist in the model and get dropped on rewrite
+REMOVED_PROPERTIES = {
+    'Post'   : ['movies', 'processing'],
+    'Movies' : []
+}
+
+"""
+Returns the datastore write ops for putting the entity fresh:
+2 for the entity, plus 2 (ascending and descending) for every
+indexed property value. With legacy=True every property that
+isn't a Text or Blob counts as indexed, like it used to
+"""
+def write_ops(entity, legacy=False):
+    ops = 2
+    for name, prop in entity._properties.items():
+        if legacy:
+            indexed = not isinstance(prop, (ndb.TextProperty, ndb.BlobProperty))
+        else:
+            indexed = prop._indexed
+        if not indexed:
+            continue
+        value = prop._get_user_value(entity)
+        if prop._repeated:
+            ops += 2 * len(value or [])
+        else:
+            ops += 2
+    return ops
+
+"""
+Rewrites one page of entities of the model with the current schema,
+so unused indexes are removed and dropped properties go away
+"""
+def rewrite_batch(model, cursor, batch_size):
+    keys, next_cursor, more = model.query().fetch_page(
+        batch_size, start_cursor=Cursor(urlsafe=cursor) if cursor else None, keys_only=True
+    )
+    entities = [entity for entity in ndb.get_multi(keys) if entity is not None]
+    stats = {'write_ops_before': 0, 'write_ops_after': 0}
+    for entity in entities:
+        stats['write_ops_before'] += write_ops(entity, legacy=True)
+        for name in REMOVED_PROPERTIES[model._get_kind()]:
+            # Only present as a per entity property when it was stored on the entity
+            entity._properties.pop(name, None)
+            entity._values.pop(name, None)
+        stats['write_ops_after'] += write_ops(entity)
+    ndb.put_multi(entities)
+    return (next_cursor.urlsafe() if more and next_cursor else None), len(entities), stats
+
+def rewrite_posts(cursor, batch_size):
+    return rewrite_batch(Post, cursor, batch_size)
+
+def rewrite_movies(cursor, batch_size):
+    return rewrite_batch(Movies, cursor, batch_size)
+
+# Model -> (the property the entities are keyed by now, the date
+# that decides which entry is kept when an author or subreddit has
+# more than one)
+KEYED_BY = {
+    'IgnoreList'  : ('author', 'update_date'),
+    'Whitelisted' : ('subreddit', 'updated'),
+    'Blacklisted' : ('subreddit', 'updated')
+}
+
+"""
+Moves one page of the entities that still have an automatic id to
+the key the repository uses now, the author or the subreddit. When
+there's more than one entry for it, the newest one is kept. Entities
+that are keyed already come after the automatic ids and are skipped
+"""
+def rekey_batch(model, cursor, batch_size):
+    entities, next_cursor, more = model.query().fetch_page(
+        batch_size, start_cursor=Cursor(urlsafe=cursor) if cursor else None
+    )
+    field, date = KEYED_BY[model._get_kind()]
+    old = [entity for entity in entities if isinstance(entity.key.id(), (int, long))]
+    ids = list(set(getattr(entity, field) for entity in old if getattr(entity, field)))
+    keyed = dict(zip(ids, ndb.get_multi([ndb.Key(model, id) for id in ids])))
+    changed = {}
+    stats = {'rekeyed': 0, 'merged': 0}
+    for entity in old:
+        id = getattr(entity, field)
+        current = keyed.get(id)
+        if id and (current is None or (getattr(entity, date) or datetime.datetime.min) > (getattr(current, date) or datetime.datetime.min)):
+            keyed[id] = changed[id] = model(id=id, **entity.to_dict())
+            stats['rekeyed'] += 1
+        else:
+            stats['merged'] += 1
+    ndb.put_multi(changed.values())
+    ndb.delete_multi([entity.key for entity in old])
+    return (next_cursor.urlsafe() if more and next_cursor else None), len(old), stats
+
+def rekey_ignored(cursor, batch_size):
+    return rekey_batch(IgnoreList, cursor, batch_size)
+
+def rekey_whitelisted(cursor, batch_size):
+    return rekey_batch(Whitelisted, cursor, batch_size)
+
+def rekey_blacklisted(cursor, batch_size):
+    return rekey_batch(Blacklisted, cursor, batch_size)
+
+# The posts, movies and list migrations rewrite datastore entities,
+# so with the sqlite backend they finish without finding any.
+# Migration name -> function taking (cursor, batch_size) and returning
+# (next cursor or None, entities processed, dict of counters to add up)
+MIGRATIONS = {
+    'revisions' : revisions.migrate_batch,
+    'posts'     : rewrite_posts,
+    'movies'    : rewrite_movies,
+    'rederive'  : imdb.rederive_batch,
+    'ignored'   : rekey_ignored,
+    'whitelist' : rekey_whitelisted,
+    'blacklist' : rekey_blacklisted
+}
+
+def start_migration(name):
+    if name not in MIGRATIONS:
+        raise ValueError("Unknown migration %s" % name)
+    MigrationStatus(
+        id = name,
+        started = datetime.datetime.now(),
+        stats = {}
+    ).put()
+
+"""
+Runs one batch of the migration and records the progress.
+Returns the cursor for the next batch, or None when finished
+"""
+def run_batch(name, cursor=None, batch_size=DEFAULT_BATCH_SIZE):
+    start = datetime.datetime.now()
+    next_cursor, processed, stats = MIGRATIONS[name](cursor, batch_size)
+    elapsed = (datetime.datetime.now() - start).total_seconds()
+    status = MigrationStatus.get_by_id(name)
+    if status is None:
+        status = MigrationStatus(id=name, started=start, stats={})
+    status.batches += 1
+    status.processed += processed
+    status.elapsed += elapsed
+    for counter, value in stats.items():
+        status.stats[counter] = status.stats.get(counter, 0) + value
+    status.done = next_cursor is None
+    status.put()
+    logging.info("Migration %s processed %d entities in %.2fs. Totals: %d processed, %s" % (
+        name, processed, elapsed, status.processed, status.stats
+    ))
+    return next_cursor
@@ -5,17 +5,26 @@ from google.appengine.ext import ndb
 from google.appengine.ext.ndb import msgprop
 
 class Post(ndb.Model):
-    post_id = ndb.IntegerProperty()
-    post_kind = ndb.StringProperty()
-    name = ndb.StringProperty(indexed=True)
-    author = ndb.StringProperty()
-    permalink = ndb.StringProperty()
-    subreddit = ndb.StringProperty()
-    movies = ndb.KeyProperty(repeated=True)
-    movies_list = ndb.StringProperty(repeated=True)
-    post_date = ndb.DateTimeProperty()
-    processing = ndb.BooleanProperty(default=False)
-    commented = ndb.BooleanProperty(default=False)
+    post_id = ndb.IntegerProperty(indexed=False)
+    post_kind = ndb.StringProperty(indexed=False)
+    name = ndb.StringProperty(indexed=False)
+    author = ndb.StringProperty(indexed=False)
+    permalink = ndb.StringProperty(indexed=False)
+    subreddit = ndb.StringProperty(indexed=False)
+    movies_list = ndb.StringProperty(repeated=True, indexed=False)
+    post_date = ndb.DateTimeProperty(indexed=False)
+    # The task processing the post, and when its lease runs out
+    # so another task may take the post over
+    processing_owner = ndb.StringProperty(indexed=False)
+    processing_until = ndb.DateTimeProperty(indexed=False)
+    commented = ndb.BooleanProperty(default=False, indexed=False)
+    # Unix timestamps of the stages from creation to our comment
+    timings = ndb.JsonProperty(indexed=False)
+    # The last finished stage of the comment pipeline, and what the
+    # stages produced, so a retried task resumes where it stopped
+    stage = ndb.StringProperty(indexed=False, choices=['parsed', 'resolved', 'rendered', 'submitted', 'recorded'])
+    checkpoint = ndb.JsonProperty(indexed=False, compressed=True)
+    # Used by the retention sweeper
     added = ndb.DateTimeProperty(auto_now_add=True)
 
 class Comment(ndb.Model):
@@ -25,11 +34,31 @@ class Comment(ndb.Model):
     deleted = ndb.BooleanProperty(default=False)
     updated = ndb.DateTimeProperty(auto_now=True)
     revision = ndb.IntegerProperty()
+    # The movies the comment lists, which it is indexed under
+    movies = ndb.StringProperty(repeated=True, indexed=False)
+    # When the comment is due for its next checkup
+    scheduled = ndb.BooleanProperty(default=False)
+    next_check = ndb.DateTimeProperty()
+    # Checkups in a row that couldn't get the comment from reddit
+    failed_checks = ndb.IntegerProperty(default=0, indexed=False)
 
 class CommentRevisions(ndb.Model):
+    # Only set on revisions written before they were compressed
     body = ndb.TextProperty()
+    # 'base' for a compressed full copy, 'delta' for a compressed
+    # delta against the previous revision
+    encoding = ndb.StringProperty(indexed=False)
+    data = ndb.BlobProperty()
+    size = ndb.IntegerProperty(indexed=False)
     reply_date = ndb.DateTimeProperty(auto_now_add=True)
 
+class MovieComments(ndb.Model):
+    # Live comments that mention the movie, keyed by IMDB id
+    comments = ndb.KeyProperty(repeated=True, indexed=False)
+    # Version of the availability snapshot the comments were last reviewed against
+    snapshot_version = ndb.IntegerProperty(indexed=False)
+    checked = ndb.DateTimeProperty(indexed=False)
+
 class IgnoreList(ndb.Model):
     author = ndb.StringProperty()
     ignored = ndb.BooleanProperty(default=True)
@@ -38,6 +67,12 @@ class IgnoreList(ndb.Model):
     message_date = ndb.DateTimeProperty()
     update_date = ndb.DateTimeProperty(auto_now_add=True)
 
+class InboxMessage(ndb.Model):
+    author = ndb.StringProperty()
+    response = ndb.TextProperty()
+    replied = ndb.BooleanProperty(default=False)
+    handled = ndb.DateTimeProperty(auto_now_add=True)
+
 class Whitelisted(ndb.Model):
     subreddit = ndb.StringProperty()
     updated = ndb.DateTimeProperty(auto_now_add=True)
@@ -48,6 +83,94 @@ class Blacklisted(ndb.Model):
     updated = ndb.DateTimeProperty(auto_now_add=True)
     updated_by = ndb.StringProperty()
 
+class ListingCheckpoint(ndb.Model):
+    # Keyed by listing and subreddit. Newest created_utc seen in the
+    # subreddit's listing, and the things seen at that time
+    created_utc = ndb.FloatProperty(indexed=False)
+    names = ndb.StringProperty(repeated=True, indexed=False)
+    # While a poll that was cut short is resumed: the listing cursor
+    # to page on from, and the newest things seen since the checkpoint
+    after = ndb.StringProperty(indexed=False)
+    pending_created_utc = ndb.FloatProperty(indexed=False)
+    pending_names = ndb.StringProperty(repeated=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+class WikiPage(ndb.Model):
+    content_hash = ndb.StringProperty(indexed=False)
+    published = ndb.DateTimeProperty(auto_now=True)
+
+class RetentionSweep(ndb.Model):
+    cutoff = ndb.DateTimeProperty()
+    started = ndb.DateTimeProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+    batches = ndb.IntegerProperty(default=0)
+    scanned = ndb.IntegerProperty(default=0)
+    deleted = ndb.IntegerProperty(default=0)
+    kept = ndb.IntegerProperty(default=0)
+    elapsed = ndb.FloatProperty(default=0.0)
+    done = ndb.BooleanProperty(default=False)
+
+class MigrationStatus(ndb.Model):
+    started = ndb.DateTimeProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+    batches = ndb.IntegerProperty(default=0)
+    processed = ndb.IntegerProperty(default=0)
+    elapsed = ndb.FloatProperty(default=0.0)
+    stats = ndb.JsonProperty()
+    done = ndb.BooleanProperty(default=False)
+
+class LatencyHistogram(ndb.Model):
+    # Keyed by hour bucket and scope, like the mention stats
+    hour = ndb.DateTimeProperty()
+    scope = ndb.StringProperty(indexed=False)
+    # Stage -> count per latency bucket
+    counts = ndb.JsonProperty(indexed=False)
+
+class LatencyHour(ndb.Model):
+    # The shards of an hour added up, keyed by hour bucket.
+    # Scope -> stage -> count per latency bucket
+    hour = ndb.DateTimeProperty()
+    counts = ndb.JsonProperty(compressed=True)
+
+class LatencyRollup(ndb.Model):
+    # Keyed by window and scope. Stage -> count per latency
+    # bucket over the window, so a report is a few gets
+    window = ndb.StringProperty()
+    scope = ndb.StringProperty(indexed=False)
+    counts = ndb.JsonProperty(indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+class ExportRun(ndb.Model):
+    started = ndb.DateTimeProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+    # Kind -> number of chunks, rows and compressed bytes written
+    chunks = ndb.JsonProperty()
+    rows = ndb.JsonProperty()
+    size = ndb.JsonProperty()
+    elapsed = ndb.FloatProperty(default=0.0)
+    done = ndb.BooleanProperty(default=False)
+
+class ExportChunk(ndb.Model):
+    # Keyed by run, kind and chunk index
+    run = ndb.StringProperty()
+    kind = ndb.StringProperty(indexed=False)
+    index = ndb.IntegerProperty(indexed=False)
+    rows = ndb.IntegerProperty(indexed=False)
+    # A compressed columnar chunk, see modules/columnar.py
+    data = ndb.BlobProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+class Profile(ndb.Model):
+    path = ndb.StringProperty()
+    method = ndb.StringProperty(indexed=False)
+    # header, query or sampled
+    trigger = ndb.StringProperty(indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    elapsed = ndb.FloatProperty(indexed=False)
+    total_calls = ndb.IntegerProperty(indexed=False)
+    # Top functions by cumulative time
+    top = ndb.JsonProperty(compressed=True)
+
 class MovieTypes(messages.Enum):
     movie   = 1
     series  = 2
@@ -55,30 +178,69 @@ class MovieTypes(messages.Enum):
     game    = 4
 
 class Movies(ndb.Model):
-    Title = ndb.StringProperty()
-    Year = ndb.IntegerProperty()
-    Poster = ndb.StringProperty()
-    Released = ndb.DateTimeProperty()
-    DVD = ndb.DateTimeProperty()
-    Type = msgprop.EnumProperty(MovieTypes)
-    Season = ndb.IntegerProperty()
-    Episode = ndb.IntegerProperty()
-    seriesID = ndb.StringProperty()
-    imdbID = ndb.StringProperty()
-    imdbRating = ndb.FloatProperty()
-    imdbVotes = ndb.IntegerProperty()
-    tomatoURL = ndb.StringProperty()
-    tomatoMeter = ndb.IntegerProperty()
-    tomatoRating = ndb.FloatProperty()
-    tomatoReviews = ndb.IntegerProperty()
-    tomatoFresh = ndb.IntegerProperty()
-    tomatoRotten = ndb.IntegerProperty()
-    tomatoUserMeter = ndb.IntegerProperty()
-    tomatoUserRating = ndb.FloatProperty()
-    tomatoUserReviews = ndb.IntegerProperty()
-    Metascore = ndb.IntegerProperty()
-    mhid = ndb.StringProperty()
-    mh_name = ndb.StringProperty()
-    mh_altId = ndb.StringProperty()
-    added = ndb.DateTimeProperty(auto_now_add=True)
-    updated = ndb.DateTimeProperty(auto_now=True)
\ No newline at end of file
+    # Movies are only ever read by key, so nothing is indexed
+    Title = ndb.StringProperty(indexed=False)
+    Year = ndb.IntegerProperty(indexed=False)
+    Poster = ndb.StringProperty(indexed=False)
+    Released = ndb.DateTimeProperty(indexed=False)
+    DVD = ndb.DateTimeProperty(indexed=False)
+    Type = msgprop.EnumProperty(MovieTypes, indexed=False)
+    Season = ndb.IntegerProperty(indexed=False)
+    Episode = ndb.IntegerProperty(indexed=False)
+    seriesID = ndb.StringProperty(indexed=False)
+    imdbID = ndb.StringProperty(indexed=False)
+    imdbRating = ndb.FloatProperty(indexed=False)
+    imdbVotes = ndb.IntegerProperty(indexed=False)
+    tomatoURL = ndb.StringProperty(indexed=False)
+    tomatoMeter = ndb.IntegerProperty(indexed=False)
+    tomatoRating = ndb.FloatProperty(indexed=False)
+    tomatoReviews = ndb.IntegerProperty(indexed=False)
+    tomatoFresh = ndb.IntegerProperty(indexed=False)
+    tomatoRotten = ndb.IntegerProperty(indexed=False)
+    tomatoUserMeter = ndb.IntegerProperty(indexed=False)
+    tomatoUserRating = ndb.FloatProperty(indexed=False)
+    tomatoUserReviews = ndb.IntegerProperty(indexed=False)
+    Metascore = ndb.IntegerProperty(indexed=False)
+    mhid = ndb.StringProperty(indexed=False)
+    mh_name = ndb.StringProperty(indexed=False)
+    mh_altId = ndb.StringProperty(indexed=False)
+    added = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+    # When the OMDb data was last fetched
+    fetched = ndb.DateTimeProperty(indexed=False)
+
+class AvailabilitySnapshot(ndb.Model):
+    # Where the movie can be watched, keyed by IMDB id. The version
+    # goes up every time the normalized sources change
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    mhid = ndb.StringProperty(indexed=False)
+    # Method type -> provider -> {'url': ..., 'price': ...}
+    media_types = ndb.JsonProperty(indexed=False)
+    friendly_names = ndb.StringProperty(repeated=True, indexed=False)
+    method_types = ndb.StringProperty(repeated=True, indexed=False)
+    exclude = ndb.BooleanProperty(default=True, indexed=False)
+    content_hash = ndb.StringProperty(indexed=False)
+    built = ndb.DateTimeProperty(indexed=False)
+
+class MovieArchive(ndb.Model):
+    # zlib compressed OMDb JSON response
+    raw = ndb.BlobProperty()
+    fetched = ndb.DateTimeProperty(indexed=False)
+
+class MovieMentionShard(ndb.Model):
+    bucket = ndb.StringProperty()
+    scope = ndb.StringProperty(indexed=False)
+    movie = ndb.StringProperty(indexed=False)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+class MentionBucket(ndb.Model):
+    counts = ndb.JsonProperty(compressed=True)
+    # Closed buckets are final, and their shards are deleted
+    closed = ndb.BooleanProperty(default=False, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+class MentionRollup(ndb.Model):
+    window = ndb.StringProperty()
+    scope = ndb.StringProperty()
+    top = ndb.JsonProperty(indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
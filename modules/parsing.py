@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pure parsing of the reddit, OMDb and MediaHound payloads. Nothing
+in here touches App Engine, so it can be benchmarked anywhere
+"""
+
+import re
+import logging
+import datetime
+
+def parse_text_for_imdb_ids(text):
+    return re.findall(r'imdb.com/[\w\/]*title/(tt[\d]{7})/?',text)
+
+"""
+Given a reddit listing child (a post or a comment), return a compact
+digest with only the fields PostObject needs. The IMDB ids are extracted
+here so the task payload doesn't have to carry the selftext or body
+"""
+def make_post_digest(post):
+    data = post['data']
+    kind = post.get('kind', data.get('kind'))
+    if kind == 't3':
+        link_sources = [data['selftext'], data['url'], data['title']]
+        permalink = data['permalink']
+    else:
+        link_sources = [data['body']]
+        permalink = None
+    movies = []
+    for link_source in link_sources:
+        movies += parse_text_for_imdb_ids(link_source)
+    return {
+        'kind'        : kind,
+        'name'        : data['name'],
+        'author'      : data['author'],
+        'created_utc' : int(data['created_utc']),
+        'subreddit'   : data['subreddit'],
+        'permalink'   : permalink,
+        # Cast the list to a set, and then back to a list to get unique movie ids
+        'movies'      : list(set(movies))
+    }
+
+def is_post_digest(post):
+    return 'data' not in post and 'movies' in post
+
+# OMDb field -> how to convert it onto the Movies entity
+MOVIE_FIELDS = {
+    'Title' : 'default',
+    'Year' : 'int',
+    'Poster' : 'default',
+    'Released' : 'date',
+    'DVD' : 'date',
+    'Type' : 'type',
+    'Season' : 'int',
+    'Episode' : 'int',
+    'seriesID' : 'default',
+    'imdbID' : 'default',
+    'imdbRating' : 'float',
+    'imdbVotes' : 'int',
+    'tomatoMeter' : 'int',
+    'tomatoURL' : 'default',
+    'tomatoRating' : 'float',
+    'tomatoReviews' : 'int',
+    'tomatoFresh' : 'int',
+    'tomatoRotten' : 'int',
+    'tomatoUserMeter' : 'int',
+    'tomatoUserRating' : 'float',
+    'tomatoUserReviews' : 'int',
+    'Metascore' : 'int'
+}
+
+def get_thing(response, thing):
+    if thing in response and response[thing] != 'N/A':
+        ret = response[thing]
+        logging.debug("Looked up %s in the response. Returning back %s" % (thing, ret))
+        return ret
+    else:
+        logging.debug("Unable to find %s in the response, or it was set to N/A" % thing)
+        return None
+
+"""
+Takes the leading number of the value, so "1,234" is 1234
+and a year range like "2011–2014" or "2011-" is 2011
+"""
+def parse_int(value):
+    match = re.match(r'\s*(\d[\d,]*)', value)
+    if match:
+        return int(match.group(1).replace(',',''))
+    return None
+
+def parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%d %b %Y')
+    except ValueError:
+        logging.warning("Couldn't parse date %s" % value)
+        return None
+
+"""
+Converts an OMDb response into the typed Movies fields. The
+Type is left as its name, for the caller to turn into a MovieTypes
+"""
+def parse_movie_fields(response):
+    fields = {}
+    for thing, process_type in MOVIE_FIELDS.iteritems():
+        thing_value = get_thing(response, thing)
+        if thing_value is not None:
+            if process_type == 'int':
+                thing_value = parse_int(thing_value)
+            elif process_type == 'float':
+                thing_value = parse_float(thing_value)
+            elif process_type == 'date':
+                thing_value = parse_date(thing_value)
+        fields[thing] = thing_value
+    return fields
+
+def uniform_types(method_type):
+    ret = method_type
+    if method_type == 'broker':
+        ret ='subscription'
+    elif method_type == 'rental':
+        ret ='rent'
+    elif method_type == 'adSupported':
+        ret ='subscription'
+    return ret.title()
+
+"""
+Turns the content of the MediaHound sources into the method type ->
+provider -> cheapest {url, price} table, the friendly medium names
+and the method types, in the order they were first found
+"""
+def normalize_sources(content):
+    media_types = {}
+    friendly_names = set()
+    method_types = []
+    for mh_object in content:
+        if 'allMediums' in mh_object['object'] and mh_object['object']['allMediums']:
+            friendly_names.update(mh_object['object']['allMediums'])
+            media_provider = mh_object['object']['metadata']['name']
+            logging.debug("Found media from: %s" % media_provider)
+            for medium in mh_object['context']['mediums']:
+                for method in medium['methods']:
+                    method_type = uniform_types(method['type'])
+                    if method_type not in media_types:
+                        media_types[method_type] = {}
+                        method_types.append(method_type)
+                    providers = media_types[method_type]
+                    for format in method['formats']:
+                        url = format['launchInfo']['view']['http']
+                        price = format.get('price', 0)
+                        if media_provider not in providers or price < providers[media_provider]['price']:
+                            providers[media_provider] = {
+                                'url'  : url,
+                                'price': price
+                            }
+    return media_types, sorted(friendly_names), method_types
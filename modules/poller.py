@@ -0,0 +1,168 @@
+import logging
+import time
+
+from google.appengine.ext import ndb
+
+from models import ListingCheckpoint
+from parsing import make_post_digest
+from reddit import BudgetExhausted
+
+# Keep the whole URL well under what reddit and urlfetch accept
+MAX_PATH_LENGTH = 1800
+MAX_SUBREDDITS_PER_LISTING = 100
+# How far back to look in a listing that has no checkpoint yet
+INITIAL_WINDOW = 3600
+# Most pages of a listing read in one poll
+MAX_PAGES = 10
+
+"""
+Splits the subreddits into groups small enough to
+request as one /r/sub1+sub2+... listing
+"""
+def chunk_subreddits(subreddits):
+    chunks = []
+    chunk = []
+    length = 0
+    for subreddit in subreddits:
+        if chunk and (length + len(subreddit) + 1 > MAX_PATH_LENGTH or len(chunk) >= MAX_SUBREDDITS_PER_LISTING):
+            chunks.append(chunk)
+            chunk = []
+            length = 0
+        chunk.append(subreddit)
+        length += len(subreddit) + 1
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def listing_path(subreddits, listing):
+    return "/r/%s/%s" % ('+'.join(subreddits), listing)
+
+def checkpoint_id(listing, subreddit):
+    return "%s|%s" % (listing, subreddit.lower())
+
+"""
+Returns the checkpoints of the subreddits in the listing. Subreddits
+without one start INITIAL_WINDOW seconds back
+"""
+def get_checkpoints(listing, subreddits):
+    keys = [ndb.Key(ListingCheckpoint, checkpoint_id(listing, subreddit)) for subreddit in subreddits]
+    checkpoints = {}
+    for key, checkpoint in zip(keys, ndb.get_multi(keys)):
+        if checkpoint is None:
+            checkpoint = ListingCheckpoint(key=key, created_utc=time.time() - INITIAL_WINDOW, names=[])
+        checkpoints[key.id()] = checkpoint
+    return checkpoints
+
+def is_new(child, checkpoint):
+    created = child['data']['created_utc']
+    return created > checkpoint.created_utc or (
+        created == checkpoint.created_utc and child['data']['name'] not in checkpoint.names)
+
+def checkpoint_state(checkpoint):
+    return (checkpoint.created_utc, list(checkpoint.names), checkpoint.after,
+        checkpoint.pending_created_utc, list(checkpoint.pending_names))
+
+"""
+Returns the cursor the last poll of the subreddits stopped at, or None
+to start at the newest things. A cursor is only good for the listing it
+came from, so it's dropped when the subreddits were grouped differently
+"""
+def resume_cursor(path, checkpoints):
+    cursors = set(checkpoint.after for checkpoint in checkpoints.values())
+    if len(cursors) == 1:
+        return cursors.pop()
+    logging.warning("The subreddits of %s stopped at different places. Paging from the newest things again" % path)
+    return None
+
+"""
+Records the newest things seen in each subreddit. Once the listing was
+read down to the checkpoints (after is None) they move there. Until
+then they stay put and keep the cursor to resume at, so the things
+between the cursor and the checkpoints are still read next poll
+"""
+def advance_checkpoints(listing, checkpoints, new, after=None):
+    before = dict((key, checkpoint_state(checkpoint)) for key, checkpoint in checkpoints.items())
+    for checkpoint in checkpoints.values():
+        if checkpoint.pending_created_utc is None:
+            checkpoint.pending_created_utc = checkpoint.created_utc
+            checkpoint.pending_names = list(checkpoint.names)
+    for child in new:
+        checkpoint = checkpoints.get(checkpoint_id(listing, child['data']['subreddit']))
+        if checkpoint is None:
+            continue
+        created = child['data']['created_utc']
+        if created > checkpoint.pending_created_utc:
+            checkpoint.pending_created_utc = created
+            checkpoint.pending_names = []
+        if created == checkpoint.pending_created_utc:
+            checkpoint.pending_names.append(child['data']['name'])
+    for checkpoint in checkpoints.values():
+        checkpoint.after = after
+        if after is None:
+            checkpoint.created_utc = checkpoint.pending_created_utc
+            checkpoint.names = checkpoint.pending_names
+            checkpoint.pending_created_utc = None
+            checkpoint.pending_names = []
+    ndb.put_multi([checkpoint for key, checkpoint in checkpoints.items()
+        if checkpoint_state(checkpoint) != before[key]])
+
+"""
+Returns the things in the listing of the subreddits that are newer
+than their subreddit's checkpoint. Pages back until a page reaches
+the oldest checkpoint, so nothing is skipped when more than a page
+of things came in since the last poll. A poll cut short by MAX_PAGES,
+the reddit budget or a failed fetch leaves the checkpoints where they
+were, and the next poll resumes paging where this one stopped
+"""
+def poll_listing(reddit, subreddits, listing):
+    path = listing_path(subreddits, listing)
+    checkpoints = get_checkpoints(listing, subreddits)
+    oldest = min(checkpoint.created_utc for checkpoint in checkpoints.values())
+    new = []
+    after = resume_cursor(path, checkpoints)
+    if after is not None:
+        logging.info("Resuming %s at %s" % (path, after))
+    pages = 0
+    complete = False
+    for page in range(MAX_PAGES):
+        try:
+            result = reddit.get_listing(path, after=after)
+        except BudgetExhausted as e:
+            logging.warning("Stopped paging %s: %s" % (path, e))
+            break
+        if not result:
+            logging.error("Couldn't get listing %s" % path)
+            break
+        pages += 1
+        children = result['data']['children']
+        for child in children:
+            checkpoint = checkpoints.get(checkpoint_id(listing, child['data']['subreddit']))
+            if checkpoint is not None and is_new(child, checkpoint):
+                new.append(child)
+        after = result['data'].get('after')
+        if not children or after is None or min(child['data']['created_utc'] for child in children) <= oldest:
+            complete = True
+            break
+    else:
+        logging.warning("Stopped paging %s after %d pages. The next poll resumes at %s" % (path, MAX_PAGES, after))
+    if complete or pages:
+        advance_checkpoints(listing, checkpoints, new, None if complete else after)
+    return new
+
+"""
+Polls the new posts and new comments of the subreddits, and returns
+digests of the things that link to IMDB and haven't been seen yet
+"""
+def poll_subreddits(reddit, subreddits):
+    digests = []
+    fetched = 0
+    for chunk in chunk_subreddits(subreddits):
+        for listing in ['new', 'comments']:
+            children = poll_listing(reddit, chunk, listing)
+            fetched += len(children)
+            for child in children:
+                digest = make_post_digest(child)
+                if digest['movies']:
+                    digests.append(digest)
+    logging.info("Polled %d subreddits. %d new things, %d with IMDB links" % (len(subreddits), fetched, len(digests)))
+    return digests
@@ -0,0 +1,78 @@
+import logging
+import cProfile
+import pstats
+import random
+import time
+
+import config
+from models import Profile
+
+PROFILE_HEADER = 'X-Moviesbot-Profile'
+PROFILE_PARAM = 'profile=1'
+DEFAULT_TOP_N = 25
+
+"""
+Returns the top_n functions of the profile by cumulative time
+"""
+def top_functions(profiler, top_n=DEFAULT_TOP_N):
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, function), (cc, calls, tottime, cumtime, callers) in stats.stats.items():
+        rows.append({
+            'function' : "%s:%d(%s)" % (filename, line, function),
+            'calls'    : calls,
+            'tottime'  : round(tottime, 6),
+            'cumtime'  : round(cumtime, 6)
+        })
+    rows.sort(key=lambda row: row['cumtime'], reverse=True)
+    return stats.total_calls, rows[:top_n]
+
+def should_profile(environ):
+    if environ.get('HTTP_' + PROFILE_HEADER.upper().replace('-', '_')) == '1':
+        return 'header'
+    if PROFILE_PARAM in environ.get('QUERY_STRING', '').split('&'):
+        return 'query'
+    if random.random() < getattr(config, 'profile_sample_rate', 0):
+        return 'sampled'
+    return None
+
+"""
+Wraps a WSGI application and runs requests under cProfile when asked
+to with the profile header or query parameter, or when sampled. The
+top functions by cumulative time are stored as a Profile entity.
+Everything under /tasks/ is admin only, so only admins can ask
+"""
+class ProfilingMiddleware:
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        trigger = should_profile(environ)
+        if trigger is None:
+            return self.application(environ, start_response)
+        profiler = cProfile.Profile()
+        start = time.time()
+        try:
+            return profiler.runcall(self.application, environ, start_response)
+        finally:
+            elapsed = time.time() - start
+            try:
+                self.save_profile(environ, trigger, profiler, elapsed)
+            except Exception, e:
+                logging.error("Couldn't save the profile of %s: %s" % (environ.get('PATH_INFO'), e))
+
+    def save_profile(self, environ, trigger, profiler, elapsed):
+        total_calls, top = top_functions(profiler, getattr(config, 'profile_top_n', DEFAULT_TOP_N))
+        profile_key = Profile(
+            path = environ.get('PATH_INFO'),
+            method = environ.get('REQUEST_METHOD'),
+            trigger = trigger,
+            elapsed = elapsed,
+            total_calls = total_calls,
+            top = top
+        ).put()
+        logging.info("Profiled %s %s in %.3fs with %d calls. Profile %d, slowest: %s" % (
+            environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'), elapsed, total_calls,
+            profile_key.id(), ', '.join(row['function'] for row in top[:3])
+        ))
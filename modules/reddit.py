@@ -1,12 +1,76 @@
+import re
 import urllib
 import base64
 import json
 import time
 import logging
+import threading
+import contextlib
 import config
-from google.appengine.api import urlfetch
-from google.appengine.api.urlfetch_errors import *
-from google.appengine import runtime
+import transport
+from transport import TransportError
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    # Off App Engine the moderator lists are only cached per instance
+    memcache = None
+
+# How long a moderator list is trusted before it is revalidated
+MODERATOR_CACHE_TTL = 3600
+# How long a moderator list (and its ETag) is kept around for revalidation
+MODERATOR_CACHE_LIFETIME = 86400
+# Per instance copy of the moderator lists, keyed by subreddit
+moderator_cache = {}
+# Requests per minute reddit allows an OAuth client, and how
+# many of them are held back for the summon lane
+DEFAULT_RATE_LIMIT = 60
+DEFAULT_SUMMON_RESERVE = 15
+# Most replies to a thing read when looking for our own
+REPLY_SEARCH_LIMIT = 500
+PASSIVE_LANE = 'passive'
+SUMMON_LANE = 'summon'
+
+# The lane of the work running on this thread
+lanes = threading.local()
+
+@contextlib.contextmanager
+def reddit_lane(lane):
+    previous = current_lane()
+    lanes.lane = lane
+    try:
+        yield
+    finally:
+        lanes.lane = previous
+
+def current_lane():
+    return getattr(lanes, 'lane', PASSIVE_LANE)
+
+class BudgetExhausted(Exception):
+    pass
+
+"""
+Takes one request out of this minute's reddit rate budget, shared by
+all instances. Passive work stops short of the share reserved for the
+summon lane. Raises BudgetExhausted once the lane used up its share,
+instead of waiting inside the request, so the caller stops paging or
+its task is retried later
+"""
+def reserve_budget():
+    if memcache is None:
+        return
+    lane = current_lane()
+    limit = getattr(config, 'reddit_rate_limit', DEFAULT_RATE_LIMIT)
+    if lane != SUMMON_LANE:
+        limit -= getattr(config, 'summon_reserve', DEFAULT_SUMMON_RESERVE)
+    now = time.time()
+    budget_key = 'reddit-budget-%d' % (now // 60)
+    memcache.add(budget_key, 0, time=120)
+    used = memcache.incr(budget_key)
+    if used is None or used <= limit:
+        return
+    # Give the request back, so the refusal doesn't eat into the reserve
+    memcache.decr(budget_key)
+    raise BudgetExhausted("The %s lane used its share of this minute's reddit budget. %.1fs left in the minute" % (lane, 60 - now % 60))
 
 class Reddit:
 
@@ -35,9 +99,9 @@ class Reddit:
             "Authorization": "Basic %s" % base64creds,
             "User-Agent": "moviesbot version 0.0.1 by /u/moviesbot"
         }
-        result = urlfetch.fetch("https://ssl.reddit.com/api/v1/access_token",
+        result = transport.fetch("https://ssl.reddit.com/api/v1/access_token",
             payload=request_payload_encoded,
-            method=urlfetch.POST,
+            method='POST',
             headers=headers,
         )
         if result.status_code == 200:
@@ -70,37 +134,46 @@ class Reddit:
         return headers
 
 
-    def api_call(self,url,payload=None,recursive=True):
+    def api_call(self,url,payload=None,recursive=True,headers=None,raw=False):
         if not self.auth_token:
             logging.warning("Woah, not authenticated. Will try to get auth_token")
             if not self.get_token():
                 logging.error("Couldn't get auth token. Aborting API Call")
                 return False
+        extra_headers = headers
         headers = self.make_headers()
+        if extra_headers:
+            headers.update(extra_headers)
         if payload is not None:
-            method=urlfetch.POST
+            method='POST'
         else:
-            method=urlfetch.GET
+            method='GET'
         logging.info("Making Reddit API call to the following URL: %s" % url)
+        reserve_budget()
         try:
-            result = urlfetch.fetch(url, method=method, payload=payload, headers=headers)
-        except (runtime.DeadlineExceededError, urlfetch.ConnectionClosedError) as e:
+            result = transport.fetch(url, method=method, payload=payload, headers=headers)
+        except TransportError as e:
             if recursive:
                 logging.info("Got error: %s. Retrying request in 2 seconds" % e)
                 time.sleep(2)
-                return self.api_call(url,payload,recursive=False)
+                return self.api_call(url,payload,recursive=False,headers=extra_headers,raw=raw)
             else:
                 logging.warning("Connection closed during retry. Aborting this API call")
                 return False
         if result.status_code == 200:
             logging.debug(result.content)
+            if raw:
+                return result
             return json.loads(result.content)
+        elif result.status_code == 304 and raw:
+            logging.debug("Got 304 Not Modified for %s" % url)
+            return result
         elif result.status_code == 401:
             logging.info("Looks like the token expired. Getting new token")
             # Get a new token here
             # Call the api call function again
             if self.get_token() and recursive:
-                 return self.api_call(url,payload,recursive=False)
+                 return self.api_call(url,payload,recursive=False,headers=extra_headers,raw=raw)
             else:
                 logging.error("Unauthorized error after renewing auth token")
                 return False
@@ -108,7 +181,7 @@ class Reddit:
             logging.info("HTTP 429 error. Retrying request in 2 seconds")
             time.sleep(2)
             if recursive:
-                return self.api_call(url,payload,recursive=False)
+                return self.api_call(url,payload,recursive=False,headers=extra_headers,raw=raw)
             else:
                 logging.warning("Still getting 429 error after sleeping")
                 return False
@@ -120,19 +193,67 @@ class Reddit:
         return self.api_call("https://oauth.reddit.com/api/v1/me")
 
     def is_user_moderator(self,subreddit,user):
+        moderators = self.get_moderators(subreddit)
+        if moderators is None:
+            logging.error("Couldn't get the moderators of %s" % subreddit)
+            return False
+        return user in moderators
+
+    """
+    Returns the set of moderator names for the subreddit. The set is
+    cached in the instance and in memcache, and once it is older than
+    MODERATOR_CACHE_TTL it is revalidated with the ETag reddit gave us
+    """
+    def get_moderators(self,subreddit):
+        cache_key = "moderators:%s" % subreddit.lower()
+        now = time.time()
+        cached = moderator_cache.get(cache_key)
+        if cached is None and memcache is not None:
+            cached = memcache.get(cache_key)
+        if cached is not None and cached['checked'] + MODERATOR_CACHE_TTL > now:
+            moderator_cache[cache_key] = cached
+            return cached['moderators']
         url = "https://oauth.reddit.com/r/%s/about/moderators.json" % (subreddit)
-        moderators = self.api_call(url)
-        for moderator in moderators['data']['children']:
-            if moderator['name'] == user:
-                return True
-        return False
+        headers = None
+        if cached is not None and cached['etag']:
+            headers = {'If-None-Match': cached['etag']}
+        result = self.api_call(url,headers=headers,raw=True)
+        if result is False:
+            if cached is not None:
+                logging.warning("Couldn't revalidate the moderators of %s. Using the cached list" % subreddit)
+                return cached['moderators']
+            return None
+        if result.status_code == 304:
+            logging.debug("Moderators of %s have not changed" % subreddit)
+            cached['checked'] = now
+        else:
+            moderators = json.loads(result.content)
+            cached = {
+                'moderators' : frozenset(moderator['name'] for moderator in moderators['data']['children']),
+                'etag'       : result.headers.get('ETag'),
+                'checked'    : now
+            }
+            logging.info("Cached %d moderators of %s" % (len(cached['moderators']),subreddit))
+        moderator_cache[cache_key] = cached
+        if memcache is not None:
+            memcache.set(cache_key, cached, time=MODERATOR_CACHE_LIFETIME)
+        return cached['moderators']
 
     def search_reddit(self,query,sort='new',time='hour'):
         url = "https://oauth.reddit.com/search.json?q=%s&sort=%s&t=%s" % (query,sort,time)
         logging.info("Performing search on Reddit for: %s" % query)
         return self.api_call (url)
 
-    def post_to_reddit(self,thing_id,text,post_type='comment'):
+    def get_listing(self,path,limit=100,after=None):
+        url = "https://oauth.reddit.com%s.json?limit=%d" % (path,limit)
+        if after is not None:
+            url += "&after=%s" % after
+        logging.info("Getting Reddit listing: %s" % path)
+        return self.api_call (url)
+
+    # Pass recursive=False when posting twice would be worse than failing.
+    # A request that errored in transit may still have gone through
+    def post_to_reddit(self,thing_id,text,post_type='comment',recursive=True):
         logging.info("Posting comment to reddit post %s" % thing_id)
         logging.debug("Text is %s" % text)
         url = "https://oauth.reddit.com/api/%s/.json" % post_type
@@ -140,7 +261,36 @@ class Reddit:
                     'text':text.encode('utf-8'),
                     'api_type':'json'
         }
-        return self.api_call(url,urllib.urlencode(payload))
+        return self.api_call(url,urllib.urlencode(payload),recursive=recursive)
+
+    """
+    Returns the name of our comment replying to the thing, or None.
+    The direct replies of the thing are read from its thread, newest
+    first, however many comments we posted elsewhere since
+    """
+    def find_reply(self,parent_name,permalink):
+        link_id = re.search(r'/comments/(\w+)', permalink).group(1)
+        url = "https://oauth.reddit.com/comments/%s.json?sort=new&limit=%d" % (link_id,REPLY_SEARCH_LIMIT)
+        if parent_name.startswith('t1_'):
+            # The comment and its replies
+            url += "&comment=%s&depth=2" % parent_name[3:]
+        else:
+            url += "&depth=1"
+        thread = self.api_call(url)
+        if not thread:
+            return None
+        # The post, then the listing of the comments
+        things = list(thread[1]['data']['children'])
+        while things:
+            thing = things.pop()
+            if thing['kind'] != 't1':
+                continue
+            data = thing['data']
+            if data.get('parent_id') == parent_name and data.get('author', '').lower() == config.reddit['user'].lower():
+                return data['name']
+            if data.get('replies'):
+                things.extend(data['replies']['data']['children'])
+        return None
 
     def delete_from_reddit(self,thing_id):
         url = "https://oauth.reddit.com/api/del"
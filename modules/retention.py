@@ -0,0 +1,164 @@
+import logging
+import datetime
+
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+from models import Post, Comment, CommentRevisions, Profile, LatencyHistogram, LatencyHour, MentionBucket, ExportChunk, RetentionSweep
+from revisions import rebase_revision
+from storage import get_repository
+
+# Comments younger than this are still being reviewed, so they
+# (and everything they point at) are never swept
+COMMENT_REVIEW_DAYS = 7
+DEFAULT_RETENTION_DAYS = {
+    'Post'             : 90,
+    'Comment'          : 30,
+    'CommentRevisions' : 30,
+    'Profile'          : 7,
+    'LatencyHistogram' : 30,
+    'LatencyHour'      : 30,
+    'MentionBucket'    : 14,
+    'ExportChunk'      : 14
+}
+DEFAULT_BATCH_SIZE = 200
+MAX_BATCH_SIZE = 500
+# Datastore limit on the number of keys per delete_multi call
+MAX_DELETE_KEYS = 500
+
+def retention_days(kind, policy):
+    days = policy.get(kind, DEFAULT_RETENTION_DAYS[kind])
+    # Never sweep anything that a comment under review may still need
+    return max(days, COMMENT_REVIEW_DAYS)
+
+def is_live_comment(comment, now):
+    if comment is None or comment.deleted:
+        return False
+    return comment.post_date > now - datetime.timedelta(days=COMMENT_REVIEW_DAYS)
+
+# Posts come from the repository, see candidate_page
+def candidate_query(kind, cutoff):
+    if kind == 'Comment':
+        return Comment.query(Comment.post_date < cutoff)
+    elif kind == 'CommentRevisions':
+        return CommentRevisions.query(CommentRevisions.reply_date < cutoff)
+    elif kind == 'Profile':
+        return Profile.query(Profile.started < cutoff)
+    elif kind == 'LatencyHistogram':
+        return LatencyHistogram.query(LatencyHistogram.hour < cutoff)
+    elif kind == 'LatencyHour':
+        return LatencyHour.query(LatencyHour.hour < cutoff)
+    elif kind == 'MentionBucket':
+        return MentionBucket.query(MentionBucket.updated < cutoff)
+    elif kind == 'ExportChunk':
+        return ExportChunk.query(ExportChunk.created < cutoff)
+    raise ValueError("No retention policy for kind %s" % kind)
+
+# Kindless ancestor query, which includes the key itself and
+# everything under it (a post's comments and their revisions)
+def subtree_keys(key):
+    return ndb.Query(ancestor=key).fetch(keys_only=True)
+
+"""
+Returns a keys-only page of the candidates older than the cutoff,
+and the cursor of the next page or None. Posts are read through the
+repository, so they're swept with either storage backend, and their
+keys are the datastore keys their comments are under
+"""
+def candidate_page(kind, cutoff, cursor, batch_size):
+    if kind == 'Post':
+        posts, next_cursor = get_repository().page('Post', cursor, batch_size, field='added', before=cutoff)
+        return [ndb.Key(Post, post.key.id()) for post in posts], next_cursor
+    keys, next_cursor, more = candidate_query(kind, cutoff).fetch_page(
+        batch_size, start_cursor=Cursor(urlsafe=cursor) if cursor else None, keys_only=True
+    )
+    return keys, (next_cursor.urlsafe() if more and next_cursor else None)
+
+"""
+Given a page of candidate keys, returns the keys to delete
+(including descendants) and the number of candidates kept. The
+posts themselves are deleted through the repository, in sweep_batch
+"""
+def select_deletions(kind, keys, now):
+    deletions = []
+    kept = 0
+    if kind == 'Post':
+        for key in keys:
+            live = [c for c in Comment.query(Comment.deleted == False, ancestor=key).fetch()
+                if is_live_comment(c, now)]
+            if live:
+                kept += 1
+                continue
+            # With the sqlite backend the post isn't in its own subtree
+            deletions.extend(subtree_keys(key) + [key])
+    elif kind == 'Comment':
+        for key, comment in zip(keys, ndb.get_multi(keys)):
+            if is_live_comment(comment, now):
+                kept += 1
+                continue
+            deletions.extend(subtree_keys(key))
+    elif kind == 'CommentRevisions':
+        comments = ndb.get_multi([key.parent() for key in keys])
+        rebased = set()
+        for key, comment in zip(keys, comments):
+            # Keep the revision that is currently posted on reddit
+            if comment is not None and (is_live_comment(comment, now) or key.id() == str(comment.revision)):
+                kept += 1
+                continue
+            if comment is not None and comment.key not in rebased:
+                # The current revision may be a delta against the ones being deleted
+                rebase_revision(comment.key, comment.revision)
+                rebased.add(comment.key)
+            deletions.append(key)
+    elif kind in ['Profile', 'LatencyHistogram', 'LatencyHour', 'MentionBucket', 'ExportChunk']:
+        deletions = list(keys)
+    return deletions, kept
+
+"""
+Sweeps one keys-only page of the kind. Returns the cursor for the
+next page, or None when the sweep is finished
+"""
+def sweep_batch(kind, cutoff, cursor=None, batch_size=DEFAULT_BATCH_SIZE):
+    batch_size = min(batch_size, MAX_BATCH_SIZE)
+    start = datetime.datetime.now()
+    keys, next_cursor = candidate_page(kind, cutoff, cursor, batch_size)
+    deletions, kept = select_deletions(kind, keys, start)
+    # Descendants of different candidates can overlap
+    deletions = list(set(deletions))
+    if kind == 'Post':
+        repository = get_repository()
+        posts = set(key for key in deletions if key.kind() == 'Post')
+        for post in repository.get_posts([key.id() for key in posts]):
+            if post is not None:
+                repository.delete(post)
+        deletions = [key for key in deletions if key not in posts]
+    for i in range(0, len(deletions), MAX_DELETE_KEYS):
+        ndb.delete_multi(deletions[i:i+MAX_DELETE_KEYS])
+    elapsed = (datetime.datetime.now() - start).total_seconds()
+    sweep = update_progress(kind, len(keys), len(deletions), kept, elapsed, next_cursor is None)
+    logging.info("Retention sweep of %s: scanned %d, deleted %d, kept %d in %.2fs. "
+        "Totals: scanned %d, deleted %d at %.1f deletes/s" % (
+        kind, len(keys), len(deletions), kept, elapsed,
+        sweep.scanned, sweep.deleted, sweep.deleted / max(sweep.elapsed, 0.001)
+    ))
+    return next_cursor
+
+def start_sweep(kind, cutoff):
+    RetentionSweep(
+        id = kind,
+        cutoff = cutoff,
+        started = datetime.datetime.now()
+    ).put()
+
+def update_progress(kind, scanned, deleted, kept, elapsed, done):
+    sweep = RetentionSweep.get_by_id(kind)
+    if sweep is None:
+        sweep = RetentionSweep(id=kind, started=datetime.datetime.now())
+    sweep.batches += 1
+    sweep.scanned += scanned
+    sweep.deleted += deleted
+    sweep.kept += kept
+    sweep.elapsed += elapsed
+    sweep.done = done
+    sweep.put()
+    return sweep
@@ -0,0 +1,169 @@
+import logging
+import difflib
+import json
+import zlib
+
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+from models import Comment, CommentRevisions
+
+# Every Nth revision is stored in full, so rebuilding a revision
+# never has to apply more than N-1 deltas
+BASE_INTERVAL = 5
+
+def compress(text):
+    return zlib.compress(text.encode('utf-8'), 9)
+
+def decompress(data):
+    return zlib.decompress(data).decode('utf-8')
+
+"""
+Returns a delta that turns old into new. The delta is a list of ops,
+either [start, end] to copy lines from old, or a string of new text.
+Diffing is done per line since edits replace whole table rows
+"""
+def make_delta(old, new):
+    old_lines = old.splitlines(True)
+    new_lines = new.splitlines(True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(new_lines[j1:j2]))
+    return ops
+
+def apply_delta(old, ops):
+    old_lines = old.splitlines(True)
+    ret = []
+    for op in ops:
+        if isinstance(op, list):
+            ret.extend(old_lines[op[0]:op[1]])
+        else:
+            ret.append(op)
+    return ''.join(ret)
+
+def encode_revision(revision, body, previous_body=None):
+    if previous_body is None:
+        revision.encoding = 'base'
+        revision.data = compress(body)
+    else:
+        revision.encoding = 'delta'
+        revision.data = compress(json.dumps(make_delta(previous_body, body)))
+    revision.size = len(body)
+    revision.body = None
+    return revision
+
+def revision_key(comment_key, rev):
+    return ndb.Key(CommentRevisions, str(rev), parent=comment_key)
+
+"""
+Returns the full text of revision rev of the comment,
+or None if the revision (or one it depends on) is missing
+"""
+def get_revision_body(comment_key, rev):
+    first = rev - rev % BASE_INTERVAL
+    revisions = ndb.get_multi([revision_key(comment_key, r) for r in range(first, rev + 1)])
+    if revisions[-1] is None:
+        return None
+    # Start from the newest revision that doesn't depend on an older one
+    start = len(revisions) - 1
+    while start > 0 and revisions[start] is not None and revisions[start].encoding == 'delta':
+        start -= 1
+    if revisions[start] is None:
+        return None
+    if revisions[start].encoding == 'delta':
+        # Only happens if this revision was written with another interval
+        body = get_revision_body(comment_key, first - 1)
+        if body is None:
+            return None
+    else:
+        body = None
+    for revision in revisions[start:]:
+        if revision is None:
+            return None
+        if revision.encoding == 'delta':
+            body = apply_delta(body, json.loads(decompress(revision.data)))
+        elif revision.encoding == 'base':
+            body = decompress(revision.data)
+        else:
+            # Written before revisions were compressed
+            body = revision.body
+    return body
+
+"""
+Stores the body as revision rev of the comment, as a delta
+against the previous revision unless a full copy is due
+"""
+def add_revision(comment_key, rev, body):
+    previous_body = None
+    if rev % BASE_INTERVAL != 0:
+        previous_body = get_revision_body(comment_key, rev - 1)
+    revision = encode_revision(CommentRevisions(id=str(rev), parent=comment_key), body, previous_body)
+    revision.put()
+    logging.info("Stored revision %d of %s as %s: %d bytes of text in %d bytes" % (
+        rev, comment_key.id(), revision.encoding, len(body.encode('utf-8')), len(revision.data)
+    ))
+    return revision
+
+"""
+Rewrites revision rev as a full copy so older
+revisions of the comment can be deleted
+"""
+def rebase_revision(comment_key, rev):
+    revision = revision_key(comment_key, rev).get()
+    if revision is None or revision.encoding != 'delta':
+        return
+    body = get_revision_body(comment_key, rev)
+    if body is not None:
+        encode_revision(revision, body).put()
+
+"""
+Re-encodes all revisions of a comment that are still stored as plain
+text. Returns the bytes of text and the bytes stored after encoding
+"""
+def migrate_comment_revisions(comment_key):
+    revisions = CommentRevisions.query(ancestor=comment_key).fetch()
+    revisions.sort(key=lambda revision: int(revision.key.id()))
+    if all(revision.encoding for revision in revisions):
+        return 0, 0
+    bodies = []
+    for revision in revisions:
+        if revision.encoding:
+            bodies.append(get_revision_body(comment_key, int(revision.key.id())))
+        else:
+            bodies.append(revision.body)
+    raw_bytes = 0
+    stored_bytes = 0
+    previous = None
+    for revision, body in zip(revisions, bodies):
+        rev = int(revision.key.id())
+        if body is None:
+            logging.warning("Revision %d of %s can't be rebuilt. Leaving it alone" % (rev, comment_key.id()))
+            previous = None
+            continue
+        raw_bytes += len(body.encode('utf-8'))
+        if previous is not None and rev % BASE_INTERVAL != 0 and previous[0] == rev - 1:
+            encode_revision(revision, body, previous[1])
+        else:
+            encode_revision(revision, body)
+        stored_bytes += len(revision.data)
+        previous = (rev, body)
+    ndb.put_multi(revisions)
+    return raw_bytes, stored_bytes
+
+"""
+Migrates the revisions of one page of comments
+"""
+def migrate_batch(cursor, batch_size):
+    keys, next_cursor, more = Comment.query().fetch_page(
+        batch_size, start_cursor=Cursor(urlsafe=cursor) if cursor else None, keys_only=True
+    )
+    stats = {'raw_bytes': 0, 'stored_bytes': 0}
+    for key in keys:
+        raw_bytes, stored_bytes = migrate_comment_revisions(key)
+        stats['raw_bytes'] += raw_bytes
+        stats['stored_bytes'] += stored_bytes
+    return (next_cursor.urlsafe() if more and next_cursor else None), len(keys), stats
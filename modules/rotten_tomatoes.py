@@ -1,24 +1,23 @@
 import logging
 import json
 import config
-from google.appengine.api import urlfetch
+import transport
 
 class RottenTomatoes:
 
     def __init__(self, rottentomatoes_id=None):
         if rottentomatoes_id:
-            urlfetch.set_default_fetch_deadline(45)
             self.response = self.api_call('movies',rottentomatoes_id)
             logging.debug("Response is %s" % self.response)
 
     def api_call(self,endpoint,rottentomatoes_id):
         try:
-            result = urlfetch.fetch("http://api.rottentomatoes.com/api/public/v1.0/%s/%s.json?apikey=%s" % (
+            result = transport.fetch("http://api.rottentomatoes.com/api/public/v1.0/%s/%s.json?apikey=%s" % (
                 endpoint,
                 rottentomatoes_id,
                 config.rottentomatoes['key']
             ))
-        except urllib2.URLError, e:
+        except transport.TransportError, e:
             logging.error("Couldn't fetch info from OMDB")
             return None
         if result.status_code == 200:
@@ -0,0 +1,67 @@
+import math
+import datetime
+
+# Comments scoring below this get deleted
+DELETE_THRESHOLD = -2
+# Comments older than this are no longer checked
+REVIEW_DAYS = 7
+MIN_INTERVAL = datetime.timedelta(minutes=10)
+MAX_INTERVAL = datetime.timedelta(hours=12)
+
+"""
+Returns how long to wait before checking the comment again.
+The wait doubles every time the age of the comment doubles, and
+drops back to the minimum when the score is falling or is close
+to the delete threshold
+"""
+def check_interval(post_date, score, previous_score, now):
+    if score <= 0 or (previous_score is not None and score < previous_score):
+        return MIN_INTERVAL
+    age_hours = max((now - post_date).total_seconds(), 0) / 3600
+    doublings = int(math.log(age_hours + 1, 2))
+    return min(MIN_INTERVAL * (2 ** doublings), MAX_INTERVAL)
+
+"""
+Sets when the comment should be checked next, or takes it off
+the schedule when it's deleted or too old to be checked
+"""
+def schedule_comment(comment, previous_score=None, now=None):
+    if now is None:
+        now = datetime.datetime.now()
+    post_date = comment.post_date or now
+    review_end = post_date + datetime.timedelta(days=REVIEW_DAYS)
+    if comment.deleted or now >= review_end:
+        comment.scheduled = False
+        return comment
+    score = comment.score if comment.score is not None else 1
+    interval = check_interval(post_date, score, previous_score, now)
+    comment.scheduled = True
+    comment.next_check = min(now + interval, review_end)
+    comment.failed_checks = 0
+    return comment
+
+"""
+Schedules the next checkup after one that couldn't get the comment
+from reddit. The wait doubles with every failure in a row, and the
+comment still comes off the schedule at the end of its review
+"""
+def schedule_retry(comment, now=None):
+    if now is None:
+        now = datetime.datetime.now()
+    post_date = comment.post_date or now
+    review_end = post_date + datetime.timedelta(days=REVIEW_DAYS)
+    comment.failed_checks = (comment.failed_checks or 0) + 1
+    if comment.deleted or now >= review_end:
+        comment.scheduled = False
+        return comment
+    interval = min(MIN_INTERVAL * (2 ** min(comment.failed_checks, 10)), MAX_INTERVAL)
+    comment.scheduled = True
+    comment.next_check = min(now + interval, review_end)
+    return comment
+
+"""
+Takes the comment off the schedule
+"""
+def unschedule_comment(comment):
+    comment.scheduled = False
+    return comment
@@ -0,0 +1,79 @@
+import logging
+import time
+import uuid
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    # Off App Engine every caller fetches for itself
+    memcache = None
+
+# How long a holder may take before the lease is up for grabs again.
+# Callers whose fetch can take longer pass their own
+LEASE_SECONDS = 30
+# How long a result is handed to the tasks that asked for the same key
+RESULT_SECONDS = 60
+POLL_SECONDS = 0.2
+# A released lease is swapped for this marker, which any task may take
+RELEASED = 'released'
+RELEASED_SECONDS = 5
+
+"""
+Takes the lease when nobody holds it, or when its holder released it
+"""
+def take_lease(client, lease_key, token, lease_seconds):
+    if client.add(lease_key, token, time=lease_seconds):
+        return True
+    return client.gets(lease_key) == RELEASED and client.cas(lease_key, token, time=lease_seconds)
+
+"""
+Releases the lease if it's still the one this task took. The compare
+and set makes sure a lease that expired and was taken by another task
+in the meantime is left alone
+"""
+def release_lease(client, lease_key, token):
+    if client.gets(lease_key) == token:
+        client.cas(lease_key, RELEASED, time=RELEASED_SECONDS)
+
+"""
+Returns fetch(), sharing the result between the tasks on every
+instance that ask for the same key at about the same time. The first
+task takes a memcache lease and fetches, and the others wait for its
+result. If the holder fails without a result, or dies and its lease
+expires, a waiting task takes the lease and fetches. So the lease has
+to outlast the slowest fetch, and a task waits at most wait_seconds,
+by default as long as a lease, before fetching for itself. None
+results aren't shared
+"""
+def single_flight(key, fetch, lease_seconds=LEASE_SECONDS, result_seconds=RESULT_SECONDS, wait_seconds=None):
+    if memcache is None:
+        return fetch()
+    if wait_seconds is None:
+        wait_seconds = lease_seconds
+    result_key = 'singleflight-result-%s' % key
+    lease_key = 'singleflight-lease-%s' % key
+    result = memcache.get(result_key)
+    if result is not None:
+        logging.debug("Using the shared result for %s" % key)
+        return result
+    # gets and cas need the same client
+    client = memcache.Client()
+    deadline = time.time() + wait_seconds
+    while True:
+        token = uuid.uuid4().hex
+        if take_lease(client, lease_key, token, lease_seconds):
+            try:
+                result = fetch()
+                if result is not None:
+                    memcache.set(result_key, result, time=result_seconds)
+                return result
+            finally:
+                release_lease(client, lease_key, token)
+        if time.time() >= deadline:
+            logging.warning("Waited %ds on another fetch of %s. Fetching it here" % (wait_seconds, key))
+            return fetch()
+        time.sleep(POLL_SECONDS)
+        result = memcache.get(result_key)
+        if result is not None:
+            logging.info("Coalesced the fetch of %s with another task" % key)
+            return result
@@ -0,0 +1,161 @@
+import logging
+import random
+import datetime
+
+from google.appengine.ext import ndb
+
+from models import MovieMentionShard, MentionBucket, MentionRollup
+from storage import get_repository
+
+NUM_SHARDS = 10
+ALL_SUBREDDITS = '*'
+ROLLUP_SIZE = 100
+# Most shards of closed buckets folded in and deleted per rollup
+CLOSE_BATCH_SIZE = 1000
+# Window name -> (bucket type, number of buckets)
+WINDOWS = {
+    'hour' : ('hour', 1),
+    'day'  : ('hour', 24),
+    'week' : ('day', 7)
+}
+
+def bucket_name(bucket_type, when):
+    if bucket_type == 'hour':
+        return when.strftime('hour:%Y%m%d%H')
+    return when.strftime('day:%Y%m%d')
+
+def recent_buckets(bucket_type, count, now):
+    step = datetime.timedelta(hours=1) if bucket_type == 'hour' else datetime.timedelta(days=1)
+    return [bucket_name(bucket_type, now - step * i) for i in range(count)]
+
+def shard_id(bucket, scope, movie, shard):
+    return "%s|%s|%s|%d" % (bucket, scope, movie, shard)
+
+@ndb.transactional(xg=True)
+def increment_shards(keys):
+    shards = ndb.get_multi(keys)
+    for index, shard in enumerate(shards):
+        if shard is None:
+            bucket, scope, movie, _ = keys[index].id().split('|')
+            shard = MovieMentionShard(key=keys[index], bucket=bucket, scope=scope, movie=movie)
+            shards[index] = shard
+        shard.count += 1
+    ndb.put_multi(shards)
+
+"""
+Records one mention of each movie in the hourly and daily buckets,
+both site wide and for the subreddit the mention came from
+"""
+def record_mentions(movies, subreddit, when=None):
+    if when is None:
+        when = datetime.datetime.now()
+    buckets = [bucket_name('hour', when), bucket_name('day', when)]
+    scopes = [ALL_SUBREDDITS, subreddit.lower()]
+    for movie in movies:
+        shard = random.randint(0, NUM_SHARDS - 1)
+        keys = [ndb.Key(MovieMentionShard, shard_id(bucket, scope, movie, shard))
+            for bucket in buckets for scope in scopes]
+        try:
+            increment_shards(keys)
+        except Exception, e:
+            # Stats should never stop a post from being processed
+            logging.error("Couldn't record mention of %s: %s" % (movie, e))
+
+"""
+Sums the shards of a bucket into a MentionBucket entity
+of the form {scope: {movie: count}}
+"""
+def total_bucket(bucket):
+    counts = {}
+    for shard in MovieMentionShard.query(MovieMentionShard.bucket == bucket):
+        add_shard(counts, shard)
+    MentionBucket(id=bucket, counts=counts).put()
+    logging.info("Totaled mention bucket %s across %d scopes" % (bucket, len(counts)))
+    return counts
+
+def add_shard(counts, shard):
+    scope_counts = counts.setdefault(shard.scope, {})
+    scope_counts[shard.movie] = scope_counts.get(shard.movie, 0) + shard.count
+
+"""
+Folds the shards of the buckets of the type that closed before the
+open one into their MentionBucket, which is then final, and deletes
+them. A closed bucket is added to rather than retotaled, so shards
+written late or left for the next rollup are still counted
+"""
+def close_buckets(bucket_type, open_bucket):
+    keys = MovieMentionShard.query(
+        MovieMentionShard.bucket >= bucket_type + ':',
+        MovieMentionShard.bucket < open_bucket
+    ).fetch(CLOSE_BATCH_SIZE, keys_only=True)
+    shards_by_bucket = {}
+    for shard in ndb.get_multi(keys):
+        if shard is not None:
+            shards_by_bucket.setdefault(shard.bucket, []).append(shard)
+    for bucket, shards in shards_by_bucket.items():
+        total = MentionBucket.get_by_id(bucket)
+        counts = total.counts if total is not None and total.closed else {}
+        for shard in shards:
+            add_shard(counts, shard)
+        MentionBucket(id=bucket, counts=counts, closed=True).put()
+        ndb.delete_multi([shard.key for shard in shards])
+        logging.info("Closed mention bucket %s and deleted %d shards" % (bucket, len(shards)))
+
+"""
+Closes the buckets that ended and retotals the open ones, then
+writes the top movies for every window and scope so reads are a
+single get
+"""
+def rollup_mentions(now=None):
+    if now is None:
+        now = datetime.datetime.now()
+    for bucket_type in ['hour', 'day']:
+        open_bucket = bucket_name(bucket_type, now)
+        close_buckets(bucket_type, open_bucket)
+        total_bucket(open_bucket)
+    rollups = []
+    stale = []
+    for window, (bucket_type, count) in WINDOWS.items():
+        buckets = [b for b in ndb.get_multi(
+            [ndb.Key(MentionBucket, name) for name in recent_buckets(bucket_type, count, now)]
+        ) if b is not None]
+        window_counts = {}
+        for bucket in buckets:
+            for scope, scope_counts in bucket.counts.items():
+                totals = window_counts.setdefault(scope, {})
+                for movie, mentions in scope_counts.items():
+                    totals[movie] = totals.get(movie, 0) + mentions
+        for scope, totals in window_counts.items():
+            top = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:ROLLUP_SIZE]
+            rollups.append(MentionRollup(
+                id = "%s|%s" % (window, scope),
+                window = window,
+                scope = scope,
+                top = top
+            ))
+        # Scopes that weren't mentioned in the window drop out of it
+        stale.extend(key for key in MentionRollup.query(MentionRollup.window == window).fetch(keys_only=True)
+            if key.id().split('|', 1)[1] not in window_counts)
+    ndb.put_multi(rollups)
+    ndb.delete_multi(stale)
+    logging.info("Wrote %d mention rollups and deleted %d stale ones" % (len(rollups), len(stale)))
+
+"""
+Returns the top k most mentioned movies for the window,
+optionally limited to a subreddit
+"""
+def get_top_movies(window='day', subreddit=None, k=10):
+    scope = subreddit.lower() if subreddit else ALL_SUBREDDITS
+    rollup = ndb.Key(MentionRollup, "%s|%s" % (window, scope)).get()
+    if not rollup:
+        return []
+    top = rollup.top[:k]
+    movies = get_repository().get_movies([movie for movie, _ in top])
+    ret = []
+    for (movie, mentions), movie_data in zip(top, movies):
+        ret.append({
+            'imdb_id'  : movie,
+            'title'    : movie_data.Title if movie_data else None,
+            'mentions' : mentions
+        })
+    return ret
@@ -0,0 +1,480 @@
+"""
+Repository layer for the posts, movies, availability snapshots,
+ignore list and subreddit lists
+
+The ndb backend stores them in the datastore like always. The sqlite
+backend stores them in a local SQLite file, so the pipeline can read
+and write them on a single box and in local benchmarks. Pick one with
+the storage key in config.yaml. The App Engine modules are only
+imported by the ndb backend, so the sqlite one works off App Engine
+
+Comments and their revisions, the movie comment index, the mention
+stats, latency histograms, wiki pages, inbox messages and the job
+status kinds aren't in the repository. They use transactions, ancestor
+queries and cursors, and stay on ndb with either backend
+"""
+
+import abc
+import logging
+import datetime
+import threading
+import base64
+import json
+
+LIST_KINDS = {
+    'white' : 'Whitelisted',
+    'black' : 'Blacklisted'
+}
+
+# The most values the datastore takes in one IN filter
+MAX_IN_VALUES = 30
+
+class Repository(object):
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def new(self, kind, id=None, **values):
+        pass
+
+    # use_cache=False skips the cache of the current request, to
+    # see what another task may have written since it was read
+    @abc.abstractmethod
+    def get_multi(self, kind, ids, use_cache=True):
+        pass
+
+    @abc.abstractmethod
+    def put_multi(self, entities):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, entity):
+        pass
+
+    """
+    Calls change with the entity, or None when it doesn't exist, and
+    saves the entity if change returns True, without another write to
+    it in between. Returns what change returned
+    """
+    @abc.abstractmethod
+    def update(self, kind, id, change):
+        pass
+
+    """
+    Returns the entities of the kind where field is one of values
+    (any value when values is None) and the other fields are equal.
+    With projection, only the named fields need to be read. A field
+    filtered on can't be projected
+    """
+    @abc.abstractmethod
+    def find(self, kind, field, values=None, projection=None, **equals):
+        pass
+
+    """
+    Returns a page of the entities of the kind from the cursor, and the
+    cursor of the next page or None after the last one. With field and
+    before, only the entities whose field is older than before
+    """
+    @abc.abstractmethod
+    def page(self, kind, cursor=None, limit=100, field=None, before=None):
+        pass
+
+    def put(self, entity):
+        self.put_multi([entity])
+        return entity
+
+    def get_posts(self, names):
+        return self.get_multi('Post', names)
+
+    def get_post(self, name):
+        return self.get_posts([name])[0]
+
+    def get_movies(self, imdb_ids, use_cache=True):
+        return self.get_multi('Movies', imdb_ids, use_cache)
+
+    def get_movie(self, imdb_id, use_cache=True):
+        return self.get_movies([imdb_id], use_cache)[0]
+
+    def get_snapshot(self, imdb_id, use_cache=True):
+        return self.get_multi('AvailabilitySnapshot', [imdb_id], use_cache)[0]
+
+    def ignored_authors(self, authors):
+        return set(item.author for item in self.find('IgnoreList', 'author', authors, ignored=True))
+
+    def ignore_entry(self, author):
+        entries = self.find('IgnoreList', 'author', [author])
+        return entries[0] if entries else None
+
+    def listed_subreddits(self, list_type, subreddits=None):
+        # A whole list is read as a projection, from the index alone
+        projection = None if subreddits is not None else ['subreddit']
+        return set(item.subreddit for item in self.find(LIST_KINDS[list_type], 'subreddit', subreddits, projection))
+
+    """
+    Adds the subreddit to the list, and takes it off the
+    other list since it can't be on both
+    """
+    def add_listed(self, list_type, subreddit, updated_by):
+        self.put(self.new(LIST_KINDS[list_type], id=subreddit, subreddit=subreddit, updated_by=updated_by))
+        for other_type, kind in LIST_KINDS.items():
+            if other_type != list_type:
+                for entity in self.find(kind, 'subreddit', [subreddit]):
+                    self.delete(entity)
+
+def ndb_model(kind):
+    import models
+    return getattr(models, kind)
+
+class NdbRepository(Repository):
+
+    def __init__(self):
+        from google.appengine.ext import ndb
+        from google.appengine.datastore.datastore_query import Cursor
+        self.ndb = ndb
+        self.Cursor = Cursor
+
+    def new(self, kind, id=None, **values):
+        return ndb_model(kind)(id=id, **values)
+
+    def get_multi(self, kind, ids, use_cache=True):
+        return self.ndb.get_multi([self.ndb.Key(ndb_model(kind), id) for id in ids], use_cache=use_cache)
+
+    def put_multi(self, entities):
+        self.ndb.put_multi(entities)
+
+    def delete(self, entity):
+        entity.key.delete()
+
+    def update(self, kind, id, change):
+        def update_entity():
+            entity = self.ndb.Key(ndb_model(kind), id).get()
+            changed = change(entity)
+            if changed:
+                entity.put()
+            return changed
+        return self.ndb.transaction(update_entity, retries=5)
+
+    def find(self, kind, field, values=None, projection=None, **equals):
+        model = ndb_model(kind)
+        filters = [model._properties[name] == value for name, value in equals.items()]
+        if projection is not None:
+            projection = [model._properties[name] for name in projection]
+        if values is None:
+            return model.query(*filters).fetch(projection=projection)
+        # The datastore takes at most MAX_IN_VALUES values in an IN
+        values = list(set(values))
+        futures = [model.query(*(filters + [model._properties[field].IN(values[start:start + MAX_IN_VALUES])])).fetch_async(projection=projection)
+            for start in range(0, len(values), MAX_IN_VALUES)]
+        return [entity for future in futures for entity in future.get_result()]
+
+    def page(self, kind, cursor=None, limit=100, field=None, before=None):
+        model = ndb_model(kind)
+        if field is not None:
+            query = model.query(model._properties[field] < before)
+        else:
+            query = model.query().order(model._key)
+        entities, next_cursor, more = query.fetch_page(
+            limit, start_cursor=self.Cursor(urlsafe=cursor) if cursor else None
+        )
+        return entities, (next_cursor.urlsafe() if more and next_cursor else None)
+
+class RecordKey:
+    def __init__(self, kind, id):
+        self._kind = kind
+        self._id = id
+
+    def kind(self):
+        return self._kind
+
+    def id(self):
+        return self._id
+
+class Field(object):
+    def __init__(self, type, default=None, repeated=False, auto_now=False, auto_now_add=False):
+        self.type = type
+        self.default = default
+        self.repeated = repeated
+        self.auto_now = auto_now
+        self.auto_now_add = auto_now_add
+
+# Kind -> property -> Field, the properties of the ndb model of the
+# kind, so the sqlite backend doesn't need the App Engine modules.
+# Types: str, int, float, bool, datetime, json, blob and enum (the
+# name of a MovieTypes value)
+SQLITE_SCHEMA = {
+    'Post' : {
+        'post_id'          : Field('int'),
+        'post_kind'        : Field('str'),
+        'name'             : Field('str'),
+        'author'           : Field('str'),
+        'permalink'        : Field('str'),
+        'subreddit'        : Field('str'),
+        'movies_list'      : Field('str', repeated=True),
+        'post_date'        : Field('datetime'),
+        'processing_owner' : Field('str'),
+        'processing_until' : Field('datetime'),
+        'commented'        : Field('bool', default=False),
+        'timings'          : Field('json'),
+        'stage'            : Field('str'),
+        'checkpoint'       : Field('json'),
+        'added'            : Field('datetime', auto_now_add=True)
+    },
+    'Movies' : dict([(name, Field('str')) for name in [
+        'Title', 'Poster', 'seriesID', 'imdbID', 'tomatoURL', 'mhid', 'mh_name', 'mh_altId'
+    ]] + [(name, Field('int')) for name in [
+        'Year', 'Season', 'Episode', 'imdbVotes', 'tomatoMeter', 'tomatoReviews', 'tomatoFresh',
+        'tomatoRotten', 'tomatoUserMeter', 'tomatoUserReviews', 'Metascore'
+    ]] + [(name, Field('float')) for name in [
+        'imdbRating', 'tomatoRating', 'tomatoUserRating'
+    ]] + [(name, Field('datetime')) for name in [
+        'Released', 'DVD', 'fetched'
+    ]] + [
+        ('Type', Field('enum')),
+        ('added', Field('datetime', auto_now_add=True)),
+        ('updated', Field('datetime', auto_now=True))
+    ]),
+    'MovieArchive' : {
+        'raw'     : Field('blob'),
+        'fetched' : Field('datetime')
+    },
+    'AvailabilitySnapshot' : {
+        'version'        : Field('int', default=0),
+        'mhid'           : Field('str'),
+        'media_types'    : Field('json'),
+        'friendly_names' : Field('str', repeated=True),
+        'method_types'   : Field('str', repeated=True),
+        'exclude'        : Field('bool', default=True),
+        'content_hash'   : Field('str'),
+        'built'          : Field('datetime')
+    },
+    'IgnoreList' : {
+        'author'       : Field('str'),
+        'ignored'      : Field('bool', default=True),
+        'body'         : Field('str'),
+        'message_id'   : Field('int'),
+        'message_date' : Field('datetime'),
+        'update_date'  : Field('datetime', auto_now_add=True)
+    },
+    'Whitelisted' : {
+        'subreddit'  : Field('str'),
+        'updated'    : Field('datetime', auto_now_add=True),
+        'updated_by' : Field('str')
+    },
+    'Blacklisted' : {
+        'subreddit'  : Field('str'),
+        'updated'    : Field('datetime', auto_now_add=True),
+        'updated_by' : Field('str')
+    }
+}
+
+"""
+An enum value read off App Engine, where the protorpc enum of the
+models can't be imported. It has the name like the enum value does
+"""
+class EnumName(str):
+    @property
+    def name(self):
+        return str(self)
+
+def enum_value(name):
+    try:
+        from models import MovieTypes
+    except ImportError:
+        return EnumName(name)
+    return getattr(MovieTypes, name)
+
+"""
+An entity of the sqlite backend. It has the same properties and
+defaults as the ndb model of its kind
+"""
+class Record(object):
+    def __init__(self, kind, id, **values):
+        self.key = RecordKey(kind, id)
+        for name, field in SQLITE_SCHEMA[kind].items():
+            setattr(self, name, [] if field.repeated else field.default)
+        for name, value in values.items():
+            setattr(self, name, value)
+
+# Kind -> columns copied out of the record so they can be queried.
+# Each kind gets an index over its columns
+SQLITE_COLUMNS = {
+    'Post'                 : ['added'],
+    'Movies'               : [],
+    'MovieArchive'         : [],
+    'AvailabilitySnapshot' : [],
+    'IgnoreList'           : ['author', 'ignored'],
+    'Whitelisted'          : ['subreddit'],
+    'Blacklisted'          : ['subreddit']
+}
+
+# Largest number of ids or values bound in one statement
+SQLITE_BATCH_SIZE = 500
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+def encode_value(field, value):
+    if value is None:
+        return None
+    if field.type == 'enum':
+        return value.name
+    if field.type == 'datetime':
+        return value.strftime(DATETIME_FORMAT)
+    if field.type == 'blob':
+        return base64.b64encode(value)
+    return value
+
+def decode_value(field, value):
+    if value is None:
+        return None
+    if field.type == 'enum':
+        return enum_value(value)
+    if field.type == 'datetime':
+        return datetime.datetime.strptime(value, DATETIME_FORMAT)
+    if field.type == 'blob':
+        return base64.b64decode(value)
+    return value
+
+def encode_record(record):
+    data = {}
+    for name, field in SQLITE_SCHEMA[record.key.kind()].items():
+        value = getattr(record, name)
+        if field.repeated:
+            data[name] = [encode_value(field, item) for item in value or []]
+        else:
+            data[name] = encode_value(field, value)
+    return json.dumps(data)
+
+def decode_record(kind, id, data):
+    values = {}
+    fields = SQLITE_SCHEMA[kind]
+    for name, value in json.loads(data).items():
+        field = fields.get(name)
+        if field is None:
+            continue
+        if field.repeated:
+            values[name] = [decode_value(field, item) for item in value]
+        else:
+            values[name] = decode_value(field, value)
+    return Record(kind, id, **values)
+
+def chunks(items, size=SQLITE_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+class SqliteRepository(Repository):
+
+    def __init__(self, path):
+        # Imported here, since the App Engine sandbox may not have it
+        import sqlite3
+        # Reentrant, so update can read and write under it
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            for kind, columns in SQLITE_COLUMNS.items():
+                self.connection.execute('CREATE TABLE IF NOT EXISTS %s (id TEXT PRIMARY KEY, data TEXT%s)' % (
+                    kind, ''.join(', %s' % column for column in columns)
+                ))
+                if columns:
+                    self.connection.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)' % (
+                        kind, '_'.join(columns), kind, ', '.join(columns)
+                    ))
+
+    def new(self, kind, id=None, **values):
+        if id is None:
+            raise ValueError("%s records need an id" % kind)
+        return Record(kind, id, **values)
+
+    def get_multi(self, kind, ids, use_cache=True):
+        found = {}
+        with self.lock:
+            for chunk in chunks(list(ids)):
+                rows = self.connection.execute('SELECT id, data FROM %s WHERE id IN (%s)' % (
+                    kind, ','.join('?' * len(chunk))
+                ), chunk)
+                for id, data in rows:
+                    found[id] = data
+        return [decode_record(kind, id, found[id]) if id in found else None for id in ids]
+
+    def put_multi(self, entities):
+        now = datetime.datetime.now()
+        by_kind = {}
+        for entity in entities:
+            kind = entity.key.kind()
+            for name, field in SQLITE_SCHEMA[kind].items():
+                if field.auto_now or (field.auto_now_add and getattr(entity, name) is None):
+                    setattr(entity, name, now)
+            columns = SQLITE_COLUMNS[kind]
+            row = [entity.key.id(), encode_record(entity)]
+            row.extend(encode_value(SQLITE_SCHEMA[kind][column], getattr(entity, column)) for column in columns)
+            by_kind.setdefault(kind, []).append(row)
+        with self.lock:
+            with self.connection:
+                for kind, rows in by_kind.items():
+                    self.connection.executemany('INSERT OR REPLACE INTO %s VALUES (%s)' % (
+                        kind, ','.join('?' * len(rows[0]))
+                    ), rows)
+
+    def delete(self, entity):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM %s WHERE id = ?' % entity.key.kind(), [entity.key.id()])
+
+    def update(self, kind, id, change):
+        with self.lock:
+            entity = self.get_multi(kind, [id])[0]
+            changed = change(entity)
+            if changed:
+                self.put_multi([entity])
+        return changed
+
+    # The fields are stored together, so a projection reads whole records
+    def find(self, kind, field, values=None, projection=None, **equals):
+        fields = SQLITE_SCHEMA[kind]
+        where = ['%s = ?' % name for name in equals]
+        params = [encode_value(fields[name], value) for name, value in equals.items()]
+        if values is None:
+            batches = [None]
+        else:
+            batches = list(chunks(list(values)))
+        ret = []
+        with self.lock:
+            for batch in batches:
+                clauses = list(where)
+                batch_params = list(params)
+                if batch is not None:
+                    clauses.append('%s IN (%s)' % (field, ','.join('?' * len(batch))))
+                    batch_params.extend(encode_value(fields[field], value) for value in batch)
+                query = 'SELECT id, data FROM %s' % kind
+                if clauses:
+                    query += ' WHERE ' + ' AND '.join(clauses)
+                for id, data in self.connection.execute(query, batch_params):
+                    ret.append(decode_record(kind, id, data))
+        return ret
+
+    # The cursor is the last id of the page. The field has to be
+    # one of the columns of the kind
+    def page(self, kind, cursor=None, limit=100, field=None, before=None):
+        query = 'SELECT id, data FROM %s WHERE id > ?' % kind
+        params = [cursor or '']
+        if field is not None:
+            query += ' AND %s < ?' % field
+            params.append(encode_value(SQLITE_SCHEMA[kind][field], before))
+        with self.lock:
+            rows = self.connection.execute(query + ' ORDER BY id LIMIT ?', params + [limit]).fetchall()
+        entities = [decode_record(kind, id, data) for id, data in rows]
+        return entities, (rows[-1][0] if len(rows) == limit else None)
+
+repository = None
+
+def get_repository():
+    global repository
+    if repository is None:
+        import config
+        backend = getattr(config, 'storage', 'ndb')
+        logging.info("Using the %s storage backend" % backend)
+        if backend == 'sqlite':
+            repository = SqliteRepository(getattr(config, 'sqlite_path', 'moviesbot.sqlite'))
+        else:
+            repository = NdbRepository()
+    return repository
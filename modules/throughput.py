@@ -0,0 +1,58 @@
+import logging
+import datetime
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    # Off App Engine the throughput is only logged
+    memcache = None
+
+from stats import bucket_name, recent_buckets
+
+# The task handlers that process posts
+PATHS = ['single', 'batch']
+# Keep the counters around for a day after the hour is over
+COUNTER_SECONDS = 60 * 60 * 48
+
+def counter_key(bucket, path, counter):
+    return 'throughput-%s-%s-%s' % (path, counter, bucket)
+
+"""
+Adds a task's posts and the milliseconds it took to the
+hourly counters of its path
+"""
+def record_throughput(path, posts, elapsed, now=None):
+    logging.info("Processed %d posts in %.2fs (%.2f posts/s)" % (posts, elapsed, posts / max(elapsed, 0.001)))
+    if memcache is None:
+        return
+    if now is None:
+        now = datetime.datetime.now()
+    bucket = bucket_name('hour', now)
+    for counter, value in [('posts', posts), ('tasks', 1), ('ms', int(elapsed * 1000))]:
+        key = counter_key(bucket, path, counter)
+        # incr can't set an expiry, so the counter is created first
+        memcache.add(key, 0, time=COUNTER_SECONDS)
+        memcache.incr(key, value, initial_value=0)
+
+"""
+Compares the posts per second of task time of the single post and
+the batch handlers over the last hours
+"""
+def throughput_report(hours=24, now=None):
+    if now is None:
+        now = datetime.datetime.now()
+    buckets = recent_buckets('hour', hours, now)
+    counts = {}
+    if memcache is not None:
+        counts = memcache.get_multi([counter_key(bucket, path, counter)
+            for bucket in buckets for path in PATHS for counter in ['posts', 'tasks', 'ms']])
+    report = {}
+    for path in PATHS:
+        totals = dict((counter, sum(int(counts.get(counter_key(bucket, path, counter)) or 0) for bucket in buckets))
+            for counter in ['posts', 'tasks', 'ms'])
+        totals['posts_per_sec'] = round(totals['posts'] / (totals['ms'] / 1000.0), 2) if totals['ms'] else None
+        report[path] = totals
+    single = report['single']['posts_per_sec']
+    batch = report['batch']['posts_per_sec']
+    report['batch_speedup'] = round(batch / single, 2) if single and batch else None
+    return report
@@ -0,0 +1,191 @@
+"""
+HTTP transports used by the API clients in modules/
+
+The urlfetch transport is what runs on Google App Engine. The pooled
+transport keeps connections alive per host, asks for gzip and runs
+concurrent requests on a thread pool, so the clients can run on plain
+Linux workers too. Pick one with the transport key in config.yaml
+"""
+
+import logging
+import threading
+import socket
+import zlib
+import httplib
+import urlparse
+import Queue
+from multiprocessing.pool import ThreadPool
+
+import config
+
+DEFAULT_DEADLINE = 45
+
+class TransportError(Exception):
+    pass
+
+# Response headers with case insensitive lookups
+class Headers(dict):
+    def __init__(self, headers=()):
+        dict.__init__(self, ((k.lower(), v) for k, v in headers))
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key.lower())
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key.lower())
+
+    def get(self, key, default=None):
+        return dict.get(self, key.lower(), default)
+
+class Response:
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+class UrlfetchTransport:
+
+    def __init__(self):
+        from google.appengine.api import urlfetch
+        from google.appengine.api import urlfetch_errors
+        from google.appengine import runtime
+        self.urlfetch = urlfetch
+        self.errors = (urlfetch_errors.Error, runtime.DeadlineExceededError)
+
+    def fetch(self, url, method='GET', payload=None, headers=None, deadline=DEFAULT_DEADLINE):
+        try:
+            return self.urlfetch.fetch(url, method=method, payload=payload, headers=headers or {}, deadline=deadline)
+        except self.errors as e:
+            raise TransportError(e)
+
+    """
+    Fetches all the requests concurrently with async urlfetch calls.
+    Each request is a dict of fetch arguments. Returns a response,
+    or the TransportError, for each request
+    """
+    def fetch_many(self, requests):
+        rpcs = []
+        for request in requests:
+            rpc = self.urlfetch.create_rpc(deadline=request.get('deadline', DEFAULT_DEADLINE))
+            self.urlfetch.make_fetch_call(rpc, request['url'],
+                method=request.get('method', 'GET'),
+                payload=request.get('payload'),
+                headers=request.get('headers') or {}
+            )
+            rpcs.append(rpc)
+        ret = []
+        for rpc in rpcs:
+            try:
+                ret.append(rpc.get_result())
+            except self.errors as e:
+                ret.append(TransportError(e))
+        return ret
+
+class PooledTransport:
+
+    def __init__(self, max_connections=10, workers=8, pooled=True):
+        self.max_connections = max_connections
+        self.workers = workers
+        self.pooled = pooled
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.thread_pool = None
+
+    def get_pool(self, scheme, netloc):
+        with self.lock:
+            if (scheme, netloc) not in self.pools:
+                self.pools[(scheme, netloc)] = Queue.LifoQueue(self.max_connections)
+            return self.pools[(scheme, netloc)]
+
+    def new_connection(self, scheme, netloc, deadline):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=deadline)
+        return httplib.HTTPConnection(netloc, timeout=deadline)
+
+    # Returns a kept alive connection if there is one, or a new one
+    def get_connection(self, scheme, netloc, deadline):
+        try:
+            connection = self.get_pool(scheme, netloc).get_nowait()
+        except Queue.Empty:
+            return self.new_connection(scheme, netloc, deadline), False
+        if connection.sock is not None:
+            connection.sock.settimeout(deadline)
+        return connection, True
+
+    def release_connection(self, scheme, netloc, connection):
+        try:
+            self.get_pool(scheme, netloc).put_nowait(connection)
+        except Queue.Full:
+            connection.close()
+
+    def fetch(self, url, method='GET', payload=None, headers=None, deadline=DEFAULT_DEADLINE):
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request_headers = dict(headers or {})
+        request_headers.setdefault('Accept-Encoding', 'gzip')
+        if payload is not None:
+            request_headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        # A kept alive connection may have been closed by the server,
+        # so a failure on a reused connection gets one retry on a new one
+        for attempt in range(2):
+            if self.pooled:
+                connection, reused = self.get_connection(parts.scheme, parts.netloc, deadline)
+            else:
+                connection, reused = self.new_connection(parts.scheme, parts.netloc, deadline), False
+            try:
+                connection.request(method, path, payload, request_headers)
+                result = connection.getresponse()
+                content = result.read()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                if reused and attempt == 0:
+                    logging.debug("Pooled connection to %s failed. Retrying on a new one" % parts.netloc)
+                    continue
+                raise TransportError(e)
+            if result.getheader('content-encoding') == 'gzip':
+                content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+            if self.pooled and not result.will_close:
+                self.release_connection(parts.scheme, parts.netloc, connection)
+            else:
+                connection.close()
+            return Response(result.status, content, Headers(result.getheaders()))
+
+    """
+    Fetches all the requests concurrently on the thread pool.
+    Each request is a dict of fetch arguments. Returns a response,
+    or the TransportError, for each request
+    """
+    def fetch_many(self, requests):
+        with self.lock:
+            if self.thread_pool is None:
+                self.thread_pool = ThreadPool(self.workers)
+        return self.thread_pool.map(self.fetch_or_error, requests)
+
+    def fetch_or_error(self, request):
+        try:
+            return self.fetch(**request)
+        except TransportError as e:
+            return e
+
+TRANSPORTS = {
+    'urlfetch' : UrlfetchTransport,
+    'pooled'   : PooledTransport
+}
+
+transport = None
+
+def get_transport():
+    global transport
+    if transport is None:
+        name = getattr(config, 'transport', 'urlfetch')
+        logging.info("Using the %s HTTP transport" % name)
+        transport = TRANSPORTS[name]()
+    return transport
+
+def fetch(url, method='GET', payload=None, headers=None, deadline=DEFAULT_DEADLINE):
+    return get_transport().fetch(url, method=method, payload=payload, headers=headers, deadline=deadline)
+
+def fetch_many(requests):
+    return get_transport().fetch_many(requests)
@@ -2,10 +2,8 @@ import re
 import logging
 
 from rotten_tomatoes import RottenTomatoes
-from google.appengine.api import urlfetch
-
-def parse_text_for_imdb_ids(text):
-    return re.findall(r'imdb.com/[\w\/]*title/(tt[\d]{7})/?',text)
+from parsing import parse_text_for_imdb_ids, make_post_digest, is_post_digest
+import transport
 
 """
 Given a blob of text, search for RT links and go to URL to 
@@ -17,7 +15,7 @@ def parse_text_for_rt_ids(text):
     for url in rotten_urls:
         logging.debug("Found Rotten Tomatoes URL: %s" % url)
         # URL fetch to get the ID
-        result = urlfetch.fetch(url)
+        result = transport.fetch(url)
         match = re.search(r'<meta name="movieID" content="(\d+)">',result.content)
         if match:
             rt_id = match.group(1)
@@ -0,0 +1,17 @@
+"""
+Puts the modules on the path the way App Engine does, and tells
+whether the App Engine SDK is there for the tests that need ndb
+
+$ python -m unittest discover tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modules'))
+
+try:
+    from google.appengine.ext import ndb
+    APPENGINE = True
+except ImportError:
+    APPENGINE = False
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+import datetime
+import unittest
+
+import support
+from columnar import encode_chunk, decode_chunk, read_chunk, encode_column
+
+COLUMNS = [
+    ('id', 'str'),
+    ('score', 'int'),
+    ('rating', 'float'),
+    ('commented', 'bool'),
+    ('added', 'time'),
+    ('movies', 'strs')
+]
+ROWS = [
+    {'id': 't3_a', 'score': 12, 'rating': 8.5, 'commented': True,
+        'added': datetime.datetime(2017, 6, 1, 12, 0, 5), 'movies': ['tt0111161', 'tt0068646']},
+    {'id': u't3_é', 'score': None, 'rating': None, 'commented': None, 'added': None, 'movies': []},
+    {'id': None, 'score': -2 ** 40, 'rating': -0.25, 'commented': False,
+        'added': datetime.datetime(1999, 12, 31, 23, 59, 59), 'movies': ['tt0111161']},
+    # Missing fields read as None
+    {'movies': None}
+]
+
+class ColumnarTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        kind, columns = decode_chunk(encode_chunk('Post', COLUMNS, ROWS))
+        self.assertEqual(kind, 'Post')
+        self.assertEqual(sorted(columns), sorted(name for name, _ in COLUMNS))
+        self.assertEqual(columns['id'], ['t3_a', u't3_é', None, None])
+        self.assertEqual(columns['score'], [12, None, -2 ** 40, None])
+        self.assertEqual(columns['rating'], [8.5, None, -0.25, None])
+        self.assertEqual(columns['commented'], [True, None, False, None])
+        self.assertEqual(columns['added'], [ROWS[0]['added'], None, ROWS[2]['added'], None])
+        self.assertEqual(columns['movies'], [['tt0111161', 'tt0068646'], [], ['tt0111161'], []])
+
+    def test_header(self):
+        header, body = read_chunk(encode_chunk('Post', COLUMNS, ROWS))
+        self.assertEqual(header['rows'], len(ROWS))
+        columns = dict((column['name'], column) for column in header['columns'])
+        # Repeated strings share a dictionary entry
+        self.assertEqual(columns['movies']['dictionary'], ['tt0111161', 'tt0068646'])
+        # Columns without missing values have no null mask
+        self.assertTrue('nulls' in columns['score']['blocks'])
+        self.assertEqual(sum(length for column in header['columns'] for _, length, _ in column['blocks'].values()), len(body))
+
+    def test_no_nulls(self):
+        blocks, dictionary = encode_column('int', [1, 2, 3])
+        self.assertEqual([name for name, _, _ in blocks], ['values'])
+        self.assertEqual(dictionary, None)
+
+    def test_empty_chunk(self):
+        self.assertEqual(decode_chunk(encode_chunk('Comment', COLUMNS, [])),
+            ('Comment', dict((name, []) for name, _ in COLUMNS)))
+
+    def test_rejects_other_data(self):
+        self.assertRaises(ValueError, read_chunk, zlib.compress(b'not a chunk'))
+        self.assertRaises(ValueError, encode_column, 'complex', [1j])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import datetime
+import unittest
+
+import support
+if support.APPENGINE:
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import ndb, testbed
+    import latency
+    from latency import BUCKET_BOUNDS, bucket_index, percentile, summarize, stage_latencies
+
+NOW = datetime.datetime(2017, 6, 1, 12, 30)
+TIMINGS = {'created': 100.0, 'discovered': 103.0, 'started': 104.0, 'looked_up': 105.0, 'commented': 110.0}
+
+def histogram(**buckets):
+    counts = [0] * (len(BUCKET_BOUNDS) + 1)
+    for index, count in buckets.items():
+        counts[int(index[1:])] = count
+    return counts
+
+@unittest.skipUnless(support.APPENGINE, "needs the App Engine SDK")
+class PercentileTest(unittest.TestCase):
+
+    def test_bucket_index(self):
+        self.assertEqual(bucket_index(0), 0)
+        self.assertEqual(bucket_index(1), 0)
+        self.assertEqual(bucket_index(1.5), 1)
+        self.assertEqual(bucket_index(BUCKET_BOUNDS[-1] + 1), len(BUCKET_BOUNDS))
+
+    def test_interpolates_within_bucket(self):
+        # Ten samples between 2 and 5 seconds
+        counts = histogram(b2=10)
+        self.assertEqual(percentile(counts, 0.5), 3.5)
+        self.assertEqual(percentile(counts, 0.9), 4.7)
+
+    def test_across_buckets(self):
+        counts = histogram(b1=10, b2=10)
+        self.assertEqual(percentile(counts, 0.5), 2.0)
+        self.assertEqual(percentile(counts, 0.9), 4.4)
+
+    def test_empty_and_overflow(self):
+        self.assertEqual(percentile(histogram(), 0.5), None)
+        self.assertEqual(percentile(histogram(**{'b%d' % len(BUCKET_BOUNDS): 3}), 0.5), None)
+
+    def test_summarize(self):
+        self.assertEqual(summarize(histogram(b2=10)), {'count': 10, 'p50': 3.5, 'p90': 4.7, 'p99': 5.0})
+
+    def test_stage_latencies(self):
+        self.assertEqual(stage_latencies(TIMINGS), {'discovery': 3.0, 'queue': 1.0, 'lookup': 1.0, 'submit': 5.0, 'total': 10.0})
+        self.assertEqual(stage_latencies({'started': 5.0, 'looked_up': 4.0}), {'lookup': 0})
+
+@unittest.skipUnless(support.APPENGINE, "needs the App Engine SDK")
+class RollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_report_reads_rollups(self):
+        self.assertTrue(latency.record_latencies(TIMINGS, 'Movies', NOW))
+        self.assertTrue(latency.record_latencies(TIMINGS, 'films', NOW - datetime.timedelta(hours=1)))
+        latency.rollup_latencies(NOW)
+        report = latency.latency_report('hour')
+        self.assertEqual(sorted(report), ['*', 'movies'])
+        self.assertEqual(report['*']['total']['count'], 1)
+        self.assertEqual(sorted(latency.latency_report('day')), ['*', 'films', 'movies'])
+        self.assertEqual(latency.latency_report('day')['*']['submit']['count'], 2)
+        self.assertEqual(sorted(latency.latency_report('day', 'Films')), ['films'])
+
+    def test_stale_rollups_are_deleted(self):
+        latency.record_latencies(TIMINGS, 'movies', NOW)
+        latency.rollup_latencies(NOW)
+        latency.rollup_latencies(NOW + datetime.timedelta(hours=3))
+        self.assertEqual(latency.latency_report('hour'), {})
+        self.assertEqual(sorted(latency.latency_report('day')), ['*', 'movies'])
+
+if __name__ == '__main__':
+    unittest.main()
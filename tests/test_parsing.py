@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import unittest
+
+import support
+from parsing import (parse_text_for_imdb_ids, make_post_digest, is_post_digest,
+    parse_int, parse_float, parse_date, parse_movie_fields, normalize_sources)
+
+def listing_child(kind, **data):
+    data.setdefault('name', '%s_abc' % kind)
+    data.setdefault('author', 'someone')
+    data.setdefault('created_utc', 1500000000.0)
+    data.setdefault('subreddit', 'movies')
+    return {'kind': kind, 'data': data}
+
+class ParseTextTest(unittest.TestCase):
+
+    def test_finds_title_ids(self):
+        text = "See http://www.imdb.com/title/tt0111161/ and imdb.com/title/tt0068646"
+        self.assertEqual(parse_text_for_imdb_ids(text), ['tt0111161', 'tt0068646'])
+
+    def test_ignores_other_links(self):
+        self.assertEqual(parse_text_for_imdb_ids("imdb.com/name/nm0000151/ and example.com/title/tt0111161"), [])
+
+class PostDigestTest(unittest.TestCase):
+
+    def test_post_digest(self):
+        post = listing_child('t3',
+            title="Best movie imdb.com/title/tt0111161/",
+            selftext="Also http://m.imdb.com/title/tt0068646/",
+            url="http://www.imdb.com/title/tt0111161/",
+            permalink="/r/movies/comments/abc/best_movie/")
+        digest = make_post_digest(post)
+        self.assertEqual(digest['kind'], 't3')
+        self.assertEqual(digest['name'], 't3_abc')
+        self.assertEqual(digest['created_utc'], 1500000000)
+        self.assertEqual(digest['permalink'], "/r/movies/comments/abc/best_movie/")
+        self.assertEqual(sorted(digest['movies']), ['tt0068646', 'tt0111161'])
+        self.assertTrue(is_post_digest(digest))
+        self.assertFalse(is_post_digest(post))
+
+    def test_comment_digest(self):
+        digest = make_post_digest(listing_child('t1', body="imdb.com/title/tt0111161"))
+        self.assertEqual(digest['movies'], ['tt0111161'])
+        self.assertEqual(digest['permalink'], None)
+
+class ParseValuesTest(unittest.TestCase):
+
+    def test_parse_int(self):
+        self.assertEqual(parse_int("1,234,567"), 1234567)
+        self.assertEqual(parse_int(u"2011–2014"), 2011)
+        self.assertEqual(parse_int("2011-"), 2011)
+        self.assertEqual(parse_int("N/A"), None)
+
+    def test_parse_float(self):
+        self.assertEqual(parse_float("8.5"), 8.5)
+        self.assertEqual(parse_float("unknown"), None)
+
+    def test_parse_date(self):
+        self.assertEqual(parse_date("14 Oct 1994"), datetime.datetime(1994, 10, 14))
+        self.assertEqual(parse_date("1994"), None)
+
+    def test_parse_movie_fields(self):
+        fields = parse_movie_fields({
+            'Title'      : 'The Shawshank Redemption',
+            'Year'       : '1994',
+            'Released'   : '14 Oct 1994',
+            'imdbRating' : '9.3',
+            'imdbVotes'  : '2,000,000',
+            'Metascore'  : 'N/A',
+            'Type'       : 'movie'
+        })
+        self.assertEqual(fields['Title'], 'The Shawshank Redemption')
+        self.assertEqual(fields['Year'], 1994)
+        self.assertEqual(fields['Released'], datetime.datetime(1994, 10, 14))
+        self.assertEqual(fields['imdbRating'], 9.3)
+        self.assertEqual(fields['imdbVotes'], 2000000)
+        self.assertEqual(fields['Metascore'], None)
+        self.assertEqual(fields['DVD'], None)
+        # Left as its name for the caller
+        self.assertEqual(fields['Type'], 'movie')
+
+class NormalizeSourcesTest(unittest.TestCase):
+
+    def source(self, provider, mediums, methods):
+        return {
+            'object'  : {'allMediums': mediums, 'metadata': {'name': provider}},
+            'context' : {'mediums': [{'methods': methods}]}
+        }
+
+    def method(self, method_type, *prices):
+        return {'type': method_type, 'formats': [
+            {'launchInfo': {'view': {'http': 'http://example.com/%s' % price}}, 'price': price} for price in prices
+        ]}
+
+    def test_keeps_cheapest_per_provider(self):
+        media_types, friendly_names, method_types = normalize_sources([
+            self.source('Netflix', ['Streaming'], [self.method('subscription', 0)]),
+            self.source('Amazon', ['Rental', 'Purchase'], [self.method('rental', 3.99, 2.99), self.method('purchase', 9.99)]),
+            self.source('Nothing', [], [self.method('rental', 1)])
+        ])
+        self.assertEqual(method_types, ['Subscription', 'Rent', 'Purchase'])
+        self.assertEqual(friendly_names, ['Purchase', 'Rental', 'Streaming'])
+        self.assertEqual(media_types['Rent'], {'Amazon': {'url': 'http://example.com/2.99', 'price': 2.99}})
+        self.assertEqual(media_types['Subscription']['Netflix']['price'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import support
+if support.APPENGINE:
+    from google.appengine.ext import ndb, testbed
+    from models import Post, Comment
+    import revisions
+
+def comment_body(rev):
+    rows = ["Movie %d | %d/10 | [Netflix](http://example.com/%d)\n" % (i, (i + rev) % 10, i) for i in range(8)]
+    # Edits replace whole rows, and sometimes add or drop one
+    rows[rev % 8] = u"Édited row %d | ★\n" % rev
+    return u"Title | Rating | Sources\n---|---|---\n" + ''.join(rows[:8 - rev % 3])
+
+@unittest.skipUnless(support.APPENGINE, "needs the App Engine SDK")
+class DeltaTest(unittest.TestCase):
+
+    def test_delta_round_trip(self):
+        for rev in range(1, 12):
+            old, new = comment_body(rev - 1), comment_body(rev)
+            self.assertEqual(revisions.apply_delta(old, revisions.make_delta(old, new)), new)
+
+    def test_delta_from_empty(self):
+        body = comment_body(3)
+        self.assertEqual(revisions.apply_delta(u"", revisions.make_delta(u"", body)), body)
+
+    def test_compress_round_trip(self):
+        body = comment_body(5)
+        self.assertEqual(revisions.decompress(revisions.compress(body)), body)
+
+@unittest.skipUnless(support.APPENGINE, "needs the App Engine SDK")
+class RevisionStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        self.comment_key = ndb.Key(Post, 't3_abc', Comment, 't1_def')
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_encode_decode_round_trip(self):
+        for rev in range(12):
+            revision = revisions.add_revision(self.comment_key, rev, comment_body(rev))
+            self.assertEqual(revision.encoding, 'base' if rev % revisions.BASE_INTERVAL == 0 else 'delta')
+        for rev in range(12):
+            self.assertEqual(revisions.get_revision_body(self.comment_key, rev), comment_body(rev))
+
+    def test_missing_revision(self):
+        revisions.add_revision(self.comment_key, 0, comment_body(0))
+        self.assertEqual(revisions.get_revision_body(self.comment_key, 1), None)
+
+    def test_rebase(self):
+        for rev in range(4):
+            revisions.add_revision(self.comment_key, rev, comment_body(rev))
+        revisions.rebase_revision(self.comment_key, 3)
+        self.assertEqual(revisions.revision_key(self.comment_key, 3).get().encoding, 'base')
+        # Older revisions can go once a later one is a full copy
+        revisions.revision_key(self.comment_key, 2).delete()
+        self.assertEqual(revisions.get_revision_body(self.comment_key, 3), comment_body(3))
+
+if __name__ == '__main__':
+    unittest.main()
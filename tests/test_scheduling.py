@@ -0,0 +1,86 @@
+import datetime
+import unittest
+
+import support
+from scheduling import (check_interval, schedule_comment, schedule_retry, unschedule_comment,
+    MIN_INTERVAL, MAX_INTERVAL, REVIEW_DAYS)
+
+NOW = datetime.datetime(2017, 6, 1, 12, 0)
+
+class FakeComment(object):
+    def __init__(self, post_date, score=1, deleted=False, failed_checks=0):
+        self.post_date = post_date
+        self.score = score
+        self.deleted = deleted
+        self.failed_checks = failed_checks
+        self.scheduled = None
+        self.next_check = None
+
+def hours_ago(hours):
+    return NOW - datetime.timedelta(hours=hours)
+
+class CheckIntervalTest(unittest.TestCase):
+
+    def test_doubles_with_age(self):
+        self.assertEqual(check_interval(NOW, 5, None, NOW), MIN_INTERVAL)
+        self.assertEqual(check_interval(hours_ago(1), 5, None, NOW), MIN_INTERVAL * 2)
+        self.assertEqual(check_interval(hours_ago(3), 5, None, NOW), MIN_INTERVAL * 4)
+        self.assertEqual(check_interval(hours_ago(7), 5, None, NOW), MIN_INTERVAL * 8)
+
+    def test_capped(self):
+        self.assertEqual(check_interval(hours_ago(24 * 6), 5, None, NOW), MAX_INTERVAL)
+
+    def test_low_or_falling_score(self):
+        self.assertEqual(check_interval(hours_ago(24), 0, None, NOW), MIN_INTERVAL)
+        self.assertEqual(check_interval(hours_ago(24), 4, 5, NOW), MIN_INTERVAL)
+        self.assertNotEqual(check_interval(hours_ago(24), 5, 5, NOW), MIN_INTERVAL)
+
+    def test_post_date_in_the_future(self):
+        self.assertEqual(check_interval(NOW + datetime.timedelta(minutes=5), 5, None, NOW), MIN_INTERVAL)
+
+class ScheduleCommentTest(unittest.TestCase):
+
+    def test_schedules_next_check(self):
+        comment = schedule_comment(FakeComment(hours_ago(3), failed_checks=2), now=NOW)
+        self.assertTrue(comment.scheduled)
+        self.assertEqual(comment.next_check, NOW + MIN_INTERVAL * 4)
+        self.assertEqual(comment.failed_checks, 0)
+
+    def test_unknown_score_counts_as_one(self):
+        comment = schedule_comment(FakeComment(hours_ago(1), score=None), now=NOW)
+        self.assertEqual(comment.next_check, NOW + MIN_INTERVAL * 2)
+
+    def test_stops_at_review_end(self):
+        review_end = hours_ago(24 * REVIEW_DAYS - 1) + datetime.timedelta(days=REVIEW_DAYS)
+        comment = schedule_comment(FakeComment(hours_ago(24 * REVIEW_DAYS - 1)), now=NOW)
+        self.assertEqual(comment.next_check, review_end)
+        comment = schedule_comment(FakeComment(hours_ago(24 * REVIEW_DAYS)), now=NOW)
+        self.assertFalse(comment.scheduled)
+
+    def test_deleted(self):
+        self.assertFalse(schedule_comment(FakeComment(hours_ago(1), deleted=True), now=NOW).scheduled)
+
+    def test_unschedule(self):
+        comment = schedule_comment(FakeComment(hours_ago(1)), now=NOW)
+        self.assertFalse(unschedule_comment(comment).scheduled)
+
+class ScheduleRetryTest(unittest.TestCase):
+
+    def test_backs_off(self):
+        comment = FakeComment(hours_ago(1))
+        waits = []
+        for _ in range(8):
+            schedule_retry(comment, now=NOW)
+            waits.append(comment.next_check - NOW)
+        self.assertEqual(comment.failed_checks, 8)
+        self.assertEqual(waits[:3], [MIN_INTERVAL * 2, MIN_INTERVAL * 4, MIN_INTERVAL * 8])
+        self.assertEqual(waits[-1], MAX_INTERVAL)
+        self.assertTrue(comment.scheduled)
+
+    def test_stops_at_review_end(self):
+        comment = schedule_retry(FakeComment(hours_ago(24 * REVIEW_DAYS)), now=NOW)
+        self.assertFalse(comment.scheduled)
+        self.assertEqual(comment.failed_checks, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+import datetime
+import unittest
+
+import support
+import storage
+from storage import NdbRepository, SqliteRepository, SQLITE_SCHEMA, SQLITE_BATCH_SIZE, MAX_IN_VALUES, enum_value
+
+POST_DATE = datetime.datetime(2017, 6, 1, 12, 0, 0, 250000)
+
+class SqliteRepositoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repository = SqliteRepository(':memory:')
+
+    def new_post(self, name, **values):
+        values.setdefault('author', 'someone')
+        values.setdefault('subreddit', 'movies')
+        values.setdefault('post_date', POST_DATE)
+        return self.repository.new('Post', id=name, name=name, **values)
+
+    def test_new_needs_id(self):
+        self.assertRaises(ValueError, self.repository.new, 'Post')
+
+    def test_put_get_round_trip(self):
+        self.repository.put(self.new_post('t3_a',
+            movies_list=['tt0111161', 'tt0068646'],
+            checkpoint={'comment_name': 't1_b', 'submitting': False},
+            processing_until=POST_DATE))
+        post, missing = self.repository.get_multi('Post', ['t3_a', 't3_missing'])
+        self.assertEqual(missing, None)
+        self.assertEqual(post.key.kind(), 'Post')
+        self.assertEqual(post.key.id(), 't3_a')
+        self.assertEqual(post.movies_list, ['tt0111161', 'tt0068646'])
+        self.assertEqual(post.checkpoint, {'comment_name': 't1_b', 'submitting': False})
+        self.assertEqual(post.post_date, POST_DATE)
+        self.assertEqual(post.processing_until, POST_DATE)
+        # Defaults of the model, and the auto_now_add field
+        self.assertEqual(post.commented, False)
+        self.assertEqual(post.timings, None)
+        self.assertTrue(isinstance(post.added, datetime.datetime))
+
+    def test_enum_and_blob(self):
+        self.repository.put_multi([
+            self.repository.new('Movies', id='tt0111161', Title=u'The Shawshank Redemption', Type=enum_value('movie'), imdbRating=9.3),
+            self.repository.new('MovieArchive', id='tt0111161', raw=b'\x78\x9c\x00\xff')
+        ])
+        movie = self.repository.get_movie('tt0111161')
+        self.assertEqual(movie.Type.name, 'movie')
+        self.assertEqual(movie.imdbRating, 9.3)
+        self.assertTrue(isinstance(movie.updated, datetime.datetime))
+        self.assertEqual(self.repository.get_multi('MovieArchive', ['tt0111161'])[0].raw, b'\x78\x9c\x00\xff')
+
+    def test_delete(self):
+        post = self.repository.put(self.new_post('t3_a'))
+        self.repository.delete(post)
+        self.assertEqual(self.repository.get_post('t3_a'), None)
+
+    def test_update(self):
+        self.repository.put(self.new_post('t3_a'))
+        def take(post):
+            if post is None or post.processing_owner is not None:
+                return False
+            post.processing_owner = 'task'
+            return True
+        self.assertTrue(self.repository.update('Post', 't3_a', take))
+        self.assertFalse(self.repository.update('Post', 't3_a', take))
+        self.assertFalse(self.repository.update('Post', 't3_missing', take))
+        self.assertEqual(self.repository.get_post('t3_a').processing_owner, 'task')
+        self.assertEqual(self.repository.get_post('t3_missing'), None)
+
+    def test_find(self):
+        authors = ['author%d' % i for i in range(SQLITE_BATCH_SIZE + 10)]
+        self.repository.put_multi([
+            self.repository.new('IgnoreList', id=author, author=author, ignored=i % 2 == 0)
+            for i, author in enumerate(authors)
+        ])
+        # More values than are bound in one statement
+        self.assertEqual(len(self.repository.find('IgnoreList', 'author', authors)), len(authors))
+        self.assertEqual(len(self.repository.find('IgnoreList', 'author')), len(authors))
+        self.assertEqual(self.repository.ignored_authors(['author0', 'author1', 'nobody']), set(['author0']))
+        self.assertEqual(self.repository.ignore_entry('author1').ignored, False)
+        self.assertEqual(self.repository.ignore_entry('nobody'), None)
+
+    def test_lists(self):
+        self.repository.add_listed('black', 'movies', 'mod')
+        self.repository.add_listed('white', 'films', 'mod')
+        self.assertEqual(self.repository.listed_subreddits('black'), set(['movies']))
+        # A subreddit is only on one list
+        self.repository.add_listed('white', 'movies', 'mod')
+        self.assertEqual(self.repository.listed_subreddits('black'), set())
+        self.assertEqual(self.repository.listed_subreddits('white'), set(['movies', 'films']))
+        self.assertEqual(self.repository.listed_subreddits('white', ['films', 'other']), set(['films']))
+
+    def test_page(self):
+        self.repository.put_multi([self.new_post('t3_%02d' % i) for i in range(25)])
+        names = []
+        cursor = None
+        while True:
+            posts, cursor = self.repository.page('Post', cursor, limit=10)
+            names.extend(post.key.id() for post in posts)
+            if cursor is None:
+                break
+        self.assertEqual(names, ['t3_%02d' % i for i in range(25)])
+
+    def test_page_before(self):
+        old = self.new_post('t3_old', added=POST_DATE)
+        self.repository.put_multi([old, self.new_post('t3_new')])
+        posts, cursor = self.repository.page('Post', field='added', before=POST_DATE + datetime.timedelta(days=1))
+        self.assertEqual([post.key.id() for post in posts], ['t3_old'])
+        self.assertEqual(cursor, None)
+
+class FakeProperty(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, value):
+        return ('==', self.name, value)
+
+    def IN(self, values):
+        return ('IN', self.name, list(values))
+
+class FakeFuture(object):
+    def __init__(self, result):
+        self.result = result
+
+    def get_result(self):
+        return self.result
+
+class FakeQuery(object):
+    def __init__(self, model, filters):
+        self.model = model
+        self.filters = filters
+        self.projection = None
+
+    def matches(self, entity):
+        for op, name, value in self.filters:
+            if (entity[name] not in value) if op == 'IN' else (entity[name] != value):
+                return False
+        return True
+
+    def fetch(self, projection=None):
+        self.projection = projection
+        self.model.queries.append(self)
+        return [entity for entity in self.model.entities if self.matches(entity)]
+
+    def fetch_async(self, projection=None):
+        return FakeFuture(self.fetch(projection))
+
+# Stands in for an ndb model, recording the queries made on it
+class FakeModel(object):
+    def __init__(self, entities):
+        self.entities = entities
+        self.queries = []
+        self._properties = dict((name, FakeProperty(name)) for name in ['author', 'ignored'])
+
+    def query(self, *filters):
+        return FakeQuery(self, list(filters))
+
+class NdbFindTest(unittest.TestCase):
+
+    def setUp(self):
+        self.model = FakeModel([{'author': 'author%d' % i, 'ignored': i % 3 != 0} for i in range(100)])
+        self.ndb_model = storage.ndb_model
+        storage.ndb_model = lambda kind: self.model
+        # The query building doesn't need the App Engine modules __init__ imports
+        self.repository = NdbRepository.__new__(NdbRepository)
+
+    def tearDown(self):
+        storage.ndb_model = self.ndb_model
+
+    def test_splits_in_filters(self):
+        values = ['author%d' % i for i in range(75)] + ['author0', 'nobody']
+        found = self.repository.find('IgnoreList', 'author', values, ignored=True)
+        self.assertEqual(sorted(entity['author'] for entity in found),
+            sorted('author%d' % i for i in range(75) if i % 3 != 0))
+        self.assertEqual([len(query.filters[-1][2]) for query in self.model.queries], [MAX_IN_VALUES, MAX_IN_VALUES, 16])
+        # Every group keeps the equality filters, and duplicates are asked for once
+        for query in self.model.queries:
+            self.assertEqual(query.filters[0], ('==', 'ignored', True))
+        in_values = [value for query in self.model.queries for value in query.filters[-1][2]]
+        self.assertEqual(len(in_values), len(set(in_values)))
+
+    def test_without_values(self):
+        found = self.repository.find('IgnoreList', 'author', ignored=False)
+        self.assertEqual(len(found), 34)
+        self.assertEqual(len(self.model.queries), 1)
+        self.assertEqual(self.model.queries[0].filters, [('==', 'ignored', False)])
+
+    def test_projection(self):
+        self.repository.find('IgnoreList', 'author', projection=['author'])
+        self.assertEqual([prop.name for prop in self.model.queries[0].projection], ['author'])
+
+@unittest.skipUnless(support.APPENGINE, "needs the App Engine SDK")
+class SchemaTest(unittest.TestCase):
+
+    def test_schema_matches_models(self):
+        import models
+        for kind, fields in SQLITE_SCHEMA.items():
+            properties = getattr(models, kind)._properties
+            self.assertEqual(sorted(fields), sorted(properties), kind)
+            for name, field in fields.items():
+                self.assertEqual(field.repeated, properties[name]._repeated, "%s.%s" % (kind, name))
+                self.assertEqual(field.default, properties[name]._default, "%s.%s" % (kind, name))
+                self.assertEqual(field.auto_now, getattr(properties[name], '_auto_now', False), "%s.%s" % (kind, name))
+                self.assertEqual(field.auto_now_add, getattr(properties[name], '_auto_now_add', False), "%s.%s" % (kind, name))
+
+if __name__ == '__main__':
+    unittest.main()